@@ -0,0 +1,426 @@
+import argparse
+import functools
+import json
+import os
+import pathlib
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+import xmp_packet
+
+
+# Benchmark of extract_xmp on a synthetic Lightroom catalog and photo library.
+# A workspace with an "untracked" folder (config.yml, catalog, library) is created
+# and put first on sys.path, so extract_xmp loads its config from there.
+#
+#   python benchmark_extract_xmp.py --rows 2000 --folders 40 --workers 1
+#
+# Results are printed and can be appended as one json line per run with --output
+# to compare versions.
+
+repo_path = pathlib.Path(__file__).resolve().parent
+
+CATALOG_SCHEMA = """
+CREATE TABLE AgLibraryRootFolder (id_local INTEGER PRIMARY KEY, absolutePath, name);
+CREATE TABLE AgLibraryFolder (id_local INTEGER PRIMARY KEY, rootFolder, pathFromRoot);
+CREATE TABLE AgLibraryFile (
+    id_local INTEGER PRIMARY KEY, folder, baseName, extension, originalFilename
+);
+CREATE TABLE Adobe_images (
+    id_local INTEGER PRIMARY KEY, rootFile, captureTime, rating, colorLabels,
+    touchCount, copyName
+);
+CREATE TABLE AgHarvestedExifMetadata (
+    id_local INTEGER PRIMARY KEY, image, focalLength, aperture, shutterSpeed,
+    isoSpeedRating, cameraModelRef, lensRef
+);
+CREATE TABLE AgInternedExifCameraModel (id_local INTEGER PRIMARY KEY, value);
+CREATE TABLE AgInternedExifLens (id_local INTEGER PRIMARY KEY, value);
+CREATE TABLE Adobe_AdditionalMetadata (id_local INTEGER PRIMARY KEY, image, xmp);
+CREATE TABLE Adobe_imageDevelopSettings (
+    id_local INTEGER PRIMARY KEY, image, processversion, text
+);
+"""
+
+root_folder_name = "benchmark"
+catalog_file = "benchmark.lrcat"
+
+
+def lua_value(value) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, str):
+        return '"' + value.replace('"', '\\"') + '"'
+    if isinstance(value, list):
+        return "{ " + "".join(f"{lua_value(v)}, " for v in value) + "}"
+    return str(value)
+
+
+def develop_settings(rng: random.Random) -> dict:
+    """Develop settings like the ones stored by Lightroom Classic."""
+    settings = {
+        "AutoLateralCA": 0,
+        "Blacks2012": rng.randint(-30, 0),
+        "CameraProfile": "Adobe Standard",
+        "Clarity2012": rng.randint(-20, 40),
+        "ColorNoiseReduction": 25,
+        "Contrast2012": rng.randint(-20, 30),
+        "Exposure2012": round(rng.uniform(-1.5, 1.5), 2),
+        "GrainAmount": 0,
+        "HasSettings": True,
+        "Highlights2012": rng.randint(-60, 0),
+        "LensProfileEnable": 1,
+        "ParametricDarks": 0,
+        "ParametricHighlightSplit": 75,
+        "ParametricHighlights": 0,
+        "ParametricLights": 0,
+        "ParametricMidtoneSplit": 50,
+        "ParametricShadowSplit": 25,
+        "ParametricShadows": 0,
+        "PostCropVignetteAmount": rng.choice([0, -12]),
+        "ProcessVersion": "11.0",
+        "RetouchInfo": {},
+        "Shadows2012": rng.randint(0, 60),
+        "SharpenDetail": 25,
+        "SharpenRadius": 1,
+        "Temperature": rng.randint(3000, 7000),
+        "Tint": rng.randint(-10, 20),
+        "ToneCurveName2012": "Linear",
+        "ToneCurvePV2012": [0, 0, 64, rng.randint(50, 80), 192, 200, 255, 255],
+        "WhiteBalance": "As Shot",
+        "Whites2012": rng.randint(0, 30),
+    }
+    for color in ["Red", "Orange", "Yellow", "Green", "Aqua", "Blue", "Purple"]:
+        settings[f"HueAdjustment{color}"] = 0
+        settings[f"LuminanceAdjustment{color}"] = 0
+        settings[f"SaturationAdjustment{color}"] = rng.randint(-10, 10)
+    if rng.random() < 0.3:
+        settings["CropTop"] = round(rng.uniform(0, 0.1), 6)
+        settings["CropLeft"] = round(rng.uniform(0, 0.1), 6)
+        settings["CropBottom"] = round(rng.uniform(0.9, 1), 6)
+        settings["CropRight"] = round(rng.uniform(0.9, 1), 6)
+        settings["CropAngle"] = 0
+    return settings
+
+
+def processtext(settings: dict) -> str:
+    lines = []
+    for key, value in settings.items():
+        value = "{}" if value == {} else lua_value(value)
+        lines.append(f"\t{key} = {value},")
+    return "s = { " + "\n".join(lines).lstrip() + "\n}\n"
+
+
+def catalog_xmp(rng: random.Random, capture_time: str) -> str:
+    """The xmp blob Lightroom keeps in Adobe_AdditionalMetadata."""
+    xmp_dict = {
+        "Xmp.xmp.CreateDate": capture_time,
+        "Xmp.xmp.Rating": str(rng.randint(0, 5)),
+        "Xmp.photoshop.DateCreated": capture_time,
+        "Xmp.xmpMM.DocumentID": f"xmp.did:{rng.getrandbits(64):016x}",
+        "Xmp.xmpMM.History": xmp_packet.XmpArray(
+            "Seq",
+            [
+                xmp_packet.XmpStruct(
+                    {
+                        "Xmp.stEvt.action": "saved",
+                        "Xmp.stEvt.when": capture_time,
+                        "Xmp.stEvt.softwareAgent": "Adobe Photoshop Lightroom",
+                    }
+                )
+            ],
+        ),
+        "Xmp.dc.subject": xmp_packet.XmpArray(
+            "Bag", rng.sample(["family", "travel", "scan", "holiday", "pets"], 2)
+        ),
+    }
+    if rng.random() < 0.2:
+        xmp_dict["Xmp.dc.title"] = xmp_packet.XmpLangAlt({"x-default": "Title"})
+    return xmp_packet.serialize_packet(xmp_dict)
+
+
+def build_catalog(path: pathlib.Path, library: pathlib.Path, rows: int, folders: int):
+    """Create a catalog with the tables img_view.sql joins and the Img view.
+    Returns the catalog rows as (path_from_root, base_name, extension)."""
+    rng = random.Random(1)
+    files = []
+    with sqlite3.connect(path) as cnx:
+        cnx.executescript(CATALOG_SCHEMA)
+        cnx.execute(
+            "INSERT INTO AgLibraryRootFolder VALUES (1, ?, ?)",
+            (library.as_posix() + "/", root_folder_name),
+        )
+        cnx.executemany(
+            "INSERT INTO AgInternedExifCameraModel VALUES (?, ?)",
+            [(1, "Canon EOS 5D"), (2, "Nikon D750")],
+        )
+        cnx.executemany(
+            "INSERT INTO AgInternedExifLens VALUES (?, ?)",
+            [(1, "EF24-105mm f/4L IS USM"), (2, "50.0 mm f/1.8")],
+        )
+        for folder in range(1, folders + 1):
+            cnx.execute(
+                "INSERT INTO AgLibraryFolder VALUES (?, 1, ?)",
+                (folder, f"{2000 + folder // 12}/{folder % 12 + 1:02d}/"),
+            )
+
+        for i in range(1, rows + 1):
+            folder = rng.randint(1, folders)
+            base_name = f"IMG_{i:05d}"
+            extension = "JPG"
+            capture_time = (
+                f"{2000 + folder // 12}-{folder % 12 + 1:02d}-"
+                f"{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:00:00"
+            )
+            cnx.execute(
+                "INSERT INTO AgLibraryFile VALUES (?, ?, ?, ?, ?)",
+                (i, folder, base_name, extension, f"{base_name}.{extension}"),
+            )
+            cnx.execute(
+                "INSERT INTO Adobe_images VALUES (?, ?, ?, ?, ?, ?, NULL)",
+                (i, i, capture_time, rng.randint(0, 5), "", rng.randint(0, 9)),
+            )
+            cnx.execute(
+                "INSERT INTO AgHarvestedExifMetadata VALUES (?, ?, 50, 4.0, 6.0, 400, ?, ?)",
+                (i, i, rng.randint(1, 2), rng.randint(1, 2)),
+            )
+            cnx.execute(
+                "INSERT INTO Adobe_AdditionalMetadata VALUES (?, ?, ?)",
+                (i, i, catalog_xmp(rng, capture_time)),
+            )
+            settings = develop_settings(rng)
+            cnx.execute(
+                "INSERT INTO Adobe_imageDevelopSettings VALUES (?, ?, ?, ?)",
+                (i, i, 11.0, processtext(settings)),
+            )
+            files.append(
+                (f"{2000 + folder // 12}/{folder % 12 + 1:02d}/", base_name, extension)
+            )
+
+        cnx.executescript(pathlib.Path(repo_path, "img_view.sql").read_text())
+    return files
+
+
+def build_library(library: pathlib.Path, files: list, sidecar_ratio: float):
+    """Create a small image for every catalog row and file.xmp sidecars for some."""
+    rng = random.Random(2)
+    image = Image.new("RGB", (64, 48), (90, 90, 90))
+    for path_from_root, base_name, extension in files:
+        folder = pathlib.Path(library, path_from_root)
+        folder.mkdir(parents=True, exist_ok=True)
+        image.save(pathlib.Path(folder, f"{base_name}.{extension}"), quality=70)
+        if rng.random() < sidecar_ratio:
+            sidecar = {
+                "Xmp.tiff.Orientation": "1",
+                "Xmp.xmp.Label": rng.choice(["None", "Red"]),
+                "Xmp.dc.subject": xmp_packet.XmpArray("Bag", ["scan"]),
+            }
+            pathlib.Path(folder, f"{base_name}.xmp").write_text(
+                xmp_packet.serialize_packet(sidecar), encoding="utf-8"
+            )
+
+
+def build_workspace(workspace: pathlib.Path, args) -> None:
+    untracked = pathlib.Path(workspace, "untracked")
+    library = pathlib.Path(workspace, "library")
+    untracked.mkdir(parents=True)
+    library.mkdir()
+
+    files = build_catalog(
+        pathlib.Path(untracked, catalog_file), library, args.rows, args.folders
+    )
+    build_library(library, files, args.sidecar_ratio)
+
+    config_data = {
+        "root_path": library.as_posix(),
+        "update_file": True,
+        "catalog_file": catalog_file,
+        "RootFolderName": root_folder_name,
+        "workers": args.workers,
+        "folder_batch_size": args.folder_batch_size,
+    }
+    with open(pathlib.Path(untracked, "config.yml"), "w") as f:
+        json.dump(config_data, f)  # json is valid yaml
+
+
+class StageTimer:
+    """Wraps functions to accumulate the time spent in them."""
+
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+
+    def wrap(self, owner, name: str, label: str) -> None:
+        func = getattr(owner, name)
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.seconds[label] = (
+                    self.seconds.get(label, 0.0) + time.perf_counter() - start
+                )
+                self.calls[label] = self.calls.get(label, 0) + 1
+
+        setattr(owner, name, timed)
+
+    def reset(self) -> None:
+        self.seconds = {}
+        self.calls = {}
+
+
+def peak_rss_mb() -> dict:
+    # ru_maxrss is in kilobytes on Linux
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=repo_path,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_benchmark(workspace: pathlib.Path, args) -> list[dict]:
+    # the workspace must come first so its untracked/config.yml is the one loaded
+    sys.path.insert(0, workspace.as_posix())
+    # log files are created in the working directory
+    os.chdir(workspace)
+    import extract_xmp
+    import lightroom_settings
+
+    extract_xmp.logger.setLevel(args.log_level)
+
+    timer = StageTimer()
+    if args.workers == 1:
+        # stages are only visible in this process
+        timer.wrap(extract_xmp.lightroom_catalog, "fetch_develop_data", "catalog")
+        timer.wrap(extract_xmp, "read_xmp_packets", "exiftool")
+        timer.wrap(extract_xmp, "parse_lightroom_processtext", "develop settings")
+        timer.wrap(extract_xmp.xmp_packet, "parse_packet", "parse")
+        timer.wrap(extract_xmp, "normalize_xmp", "normalize")
+        timer.wrap(extract_xmp.sidecar_writer.SidecarWriter, "write", "write")
+        timer.wrap(extract_xmp, "process_file", "process_file")
+
+    phases = [
+        # every sidecar is written
+        ("initial", {"resume": True}),
+        # every row is processed again, but the sidecars do not change
+        ("rerun", {"resume": False}),
+        # rows are skipped through the state database
+        ("resume", {"resume": True}),
+    ]
+    results = []
+    for phase, settings in phases:
+        for name, value in settings.items():
+            setattr(extract_xmp, name, value)
+        lightroom_settings._cache.clear()
+        timer.reset()
+
+        start = time.perf_counter()
+        extract_xmp.main()
+        elapsed = time.perf_counter() - start
+
+        results.append(
+            {
+                "revision": git_revision(),
+                "phase": phase,
+                "rows": args.rows,
+                "folders": args.folders,
+                "workers": args.workers,
+                "seconds": round(elapsed, 3),
+                "rows_per_second": round(args.rows / elapsed, 1),
+                "peak_rss_mb": {k: round(v, 1) for k, v in peak_rss_mb().items()},
+                "stages": {
+                    label: {
+                        "seconds": round(seconds, 3),
+                        "calls": timer.calls[label],
+                    }
+                    for label, seconds in timer.seconds.items()
+                },
+            }
+        )
+    return results
+
+
+def print_results(results: list[dict]) -> None:
+    for result in results:
+        print(
+            f"{result['phase']:>8}: {result['rows']} rows in {result['seconds']:.2f} s, "
+            f"{result['rows_per_second']:.1f} rows/s, peak RSS "
+            f"{result['peak_rss_mb']['self']:.0f} MB "
+            f"(children {result['peak_rss_mb']['children']:.0f} MB)"
+        )
+        for label, stage in sorted(
+            result["stages"].items(), key=lambda item: -item[1]["seconds"]
+        ):
+            per_row = 1000 * stage["seconds"] / result["rows"]
+            print(
+                f"{'':>10}{label:<18}{stage['seconds']:8.2f} s "
+                f"{per_row:8.2f} ms/row {stage['calls']:8d} calls"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark extract_xmp on a synthetic catalog and library."
+    )
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--folders", type=int, default=20)
+    parser.add_argument("--sidecar-ratio", type=float, default=0.5)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--folder-batch-size", type=int, default=100)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument(
+        "--workspace", type=pathlib.Path, help="kept after the run if given"
+    )
+    parser.add_argument(
+        "--output", type=pathlib.Path, help="append the results as json lines"
+    )
+    args = parser.parse_args()
+
+    if args.workspace is not None:
+        args.workspace.mkdir(parents=True, exist_ok=True)
+        tempdir = None
+        workspace = args.workspace.resolve()
+    else:
+        tempdir = tempfile.TemporaryDirectory(prefix="xmp_benchmark_")
+        workspace = pathlib.Path(tempdir.name)
+
+    try:
+        start = time.perf_counter()
+        build_workspace(workspace, args)
+        print(f"Built workspace {workspace} in {time.perf_counter() - start:.1f} s")
+        results = run_benchmark(workspace, args)
+    finally:
+        os.chdir(repo_path)
+        if tempdir is not None:
+            tempdir.cleanup()
+
+    print_results(results)
+    if args.output is not None:
+        with open(args.output, "a") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import json
+import pathlib
+import sqlite3
+import time
+
+
+# Local store of the results of check_xmp, so a repeated check only reads the
+# sidecars that changed. A result is reused while both sidecars of the image have
+# the same size and mtime and the mirror setting is unchanged.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS checks (
+    image TEXT PRIMARY KEY,
+    file_stats TEXT,
+    mirror INTEGER,
+    record TEXT,
+    updated REAL
+)
+"""
+
+
+class CheckCache:
+    """SQLite store of the check record of every image. Used from a single thread."""
+
+    def __init__(self, path: pathlib.Path):
+        self.hits = 0
+        self.cnx = sqlite3.connect(pathlib.Path(path))
+        self.cnx.execute("PRAGMA journal_mode=WAL")
+        self.cnx.execute(SCHEMA)
+        self.cnx.commit()
+
+    def get(self, image: pathlib.Path, stats: list, mirror: bool) -> dict | None:
+        """The record of image if it was checked with the same sidecars and mirror
+        setting, None otherwise."""
+        row = self.cnx.execute(
+            "SELECT file_stats, mirror, record FROM checks WHERE image = ?",
+            (image.as_posix(),),
+        ).fetchone()
+        if row is None or json.loads(row[0]) != stats or bool(row[1]) != mirror:
+            return None
+        self.hits += 1
+        return json.loads(row[2])
+
+    def put_many(self, entries) -> None:
+        """Store (image, stats, mirror, record) entries in one transaction."""
+        now = time.time()
+        with self.cnx:
+            self.cnx.executemany(
+                "INSERT OR REPLACE INTO checks VALUES (?, ?, ?, ?, ?)",
+                (
+                    (
+                        image.as_posix(),
+                        json.dumps(stats),
+                        mirror,
+                        json.dumps(record),
+                        now,
+                    )
+                    for image, stats, mirror, record in entries
+                ),
+            )
+
+    def retain(self, root: pathlib.Path, images) -> int:
+        """Remove the records of images under root that are no longer in images."""
+        prefix = pathlib.Path(root).as_posix().rstrip("/") + "/"
+        keep = {image.as_posix() for image in images}
+        stored = [row[0] for row in self.cnx.execute("SELECT image FROM checks")]
+        removed = [
+            (image,)
+            for image in stored
+            if image.startswith(prefix) and image not in keep
+        ]
+        with self.cnx:
+            self.cnx.executemany("DELETE FROM checks WHERE image = ?", removed)
+        return len(removed)
+
+    def close(self) -> None:
+        self.cnx.close()
@@ -1,6 +1,10 @@
+import csv
 import importlib.resources
+import json
+import os
 import pathlib
 import concurrent.futures
+import xml.etree.ElementTree as ET
 
 
 import logzero
@@ -9,7 +13,11 @@ import yaml
 
 from logzero import logger
 
+import check_cache
+import library_scanner
+import migration_state
 import xmp_editing_utils
+import xmp_packet
 # create a function to find all supported image formats in xmp_editing_utils.raw_files or xmp_editing_utils.other_files and identify what the path to the corresponding filename.ext.xmp file would be. Using the function above, conduct two checks on that file. First, if it does not exist, log an error. If the file exists, parse the xmp file to see if it has the darktable:history_end key.
 
 
@@ -40,68 +48,177 @@ else:
 
 mirror_config = config_data.get("mirror",False) # default to not mirroring
 
-def check_dt_xmp_file(image_path):
-    xmp_path = image_path.with_suffix(f"{image_path.suffix}.xmp")
+library_index = config_data.get("library_index", "library_index.json")
+if library_index is not None:
+    library_index = importlib.resources.files("untracked").joinpath(library_index)
+scan_workers = config_data.get("scan_workers", 8)
+
+# processes checking the sidecars, 1 to check in the main process
+check_workers = config_data.get("check_workers", os.cpu_count() or 1)
+
+# one record per image, as json or csv depending on the extension. None to skip
+check_report = config_data.get("check_report", "check_report.json")
+if check_report is not None:
+    check_report = importlib.resources.files("untracked").joinpath(check_report)
+
+# reuse the result of images whose sidecars did not change since the last check
+use_check_cache = config_data.get("check_cache", True)
+check_cache_file = importlib.resources.files("untracked").joinpath(
+    config_data.get("check_cache_file", "check_cache.sqlite")
+)
+
+def new_record(image_path,mirror):
+    # failed lists the names of the checks that failed
+    return {"image":image_path.as_posix(),"failed":[],"orientation":None,"mirror":mirror,"history_end":None}
+
+def sidecar_paths(image_path,entry=None):
+    # the sidecars listed in the library entry regardless of case, else where they are expected
+    base, ext = image_path.with_suffix(".xmp"), image_path.with_suffix(f"{image_path.suffix}.xmp")
+    if entry is None:
+        return base, ext
+    return entry.sidecar or base, entry.ext_sidecar or ext
+
+def read_xmp_fields(xmp_path, keys):
+    # only parse the sidecar until the keys are found. exiv2 reads the whole file but copes with malformed ones
+    try:
+        return xmp_packet.read_properties(xmp_path, keys)
+    except ET.ParseError as e:
+        logger.debug(f"Reading {xmp_path} with exiv2: {e}")
+        with pyexiv2.Image(xmp_path.as_posix()) as img:
+            return img.read_xmp()
+
+def check_dt_xmp_file(image_path,record=None,entry=None):
+    if record is None:
+        record=new_record(image_path,None)
+    xmp_path = sidecar_paths(image_path,entry)[1]
     error=0
     if not xmp_path.exists():
         logger.error(f"XMP file does not exist: {xmp_path}")
+        record["failed"].append("darktable_sidecar_missing")
         error=1
     else:
-        with pyexiv2.Image(xmp_path.as_posix()) as img:
-            xmp_data=img.read_xmp()
-            history_end=xmp_data.get("Xmp.darktable.history_end","0")
-            if int(history_end)<5:
-                error=1
-                logger.error(f"XMP file does not have darktable edit history: {xmp_path}")
+        xmp_data=read_xmp_fields(xmp_path,["Xmp.darktable.history_end"])
+        history_end=xmp_data.get("Xmp.darktable.history_end","0")
+        record["history_end"]=int(history_end)
+        if int(history_end)<5:
+            error=1
+            record["failed"].append("no_darktable_history")
+            logger.error(f"XMP file does not have darktable edit history: {xmp_path}")
     return error
 
-def check_base_xmp_file(image_path,mirror):
-    xmp_path = image_path.with_suffix(".xmp")
+def check_base_xmp_file(image_path,mirror,record=None,entry=None):
+    if record is None:
+        record=new_record(image_path,mirror)
+    xmp_path = sidecar_paths(image_path,entry)[0]
     error=0
     if not xmp_path.exists():
+        error=1
+        record["failed"].append("sidecar_missing")
         logger.error(f"XMP file does not exist: {xmp_path}")
     else:
-        with pyexiv2.Image(xmp_path.as_posix()) as img:
-            xmp_data=img.read_xmp()
-            
-            # Override mirror parameter with "no_mirror" tag
-            if "no_mirror" in xmp_data.get("Xmp.dc.subject",list()):
-                mirror = False
-
-            orientation=xmp_data.get("Xmp.tiff.Orientation","0")
-            mirrored= orientation in ["2","5","7","4"]
-            if orientation=="0":
-                error=1
-                logger.error(f"XMP file has invalid rotation: {xmp_path}")
-            elif mirror and not mirrored:
-                error=1
-                logger.error(f"XMP file not mirrored when it should be: {xmp_path}")
-            elif not mirror and mirrored:
-                error=1
-                logger.error(f"XMP file mirrored when it should NOT be: {xmp_path}")
+        xmp_data=read_xmp_fields(xmp_path,["Xmp.dc.subject","Xmp.tiff.Orientation"])
+
+        # Override mirror parameter with "no_mirror" tag
+        if "no_mirror" in xmp_data.get("Xmp.dc.subject",list()):
+            mirror = False
+        record["mirror"]=mirror
+
+        orientation=xmp_data.get("Xmp.tiff.Orientation","0")
+        record["orientation"]=orientation
+        mirrored= orientation in ["2","5","7","4"]
+        if orientation=="0":
+            error=1
+            record["failed"].append("invalid_rotation")
+            logger.error(f"XMP file has invalid rotation: {xmp_path}")
+        elif mirror and not mirrored:
+            error=1
+            record["failed"].append("not_mirrored")
+            logger.error(f"XMP file not mirrored when it should be: {xmp_path}")
+        elif not mirror and mirrored:
+            error=1
+            record["failed"].append("mirrored")
+            logger.error(f"XMP file mirrored when it should NOT be: {xmp_path}")
     return error
 
+def check_image(entry,mirror):
+    # record of both checks of an image, a sidecar that cannot be read fails the check
+    image_path=entry.image
+    logger.debug(f"Checking {image_path}")
+    record=new_record(image_path,mirror)
+    try:
+        check_base_xmp_file(image_path,mirror,record,entry)
+        check_dt_xmp_file(image_path,record,entry)
+    except Exception as e:
+        record["failed"].append("unreadable")
+        logger.error(f"Could not check {image_path}: {e}")
+    return record
+
+def check_images(entries,mirror):
+    # records in the order of the library entries, checked by check_workers processes
+    if check_workers<=1 or len(entries)<=1:
+        return [check_image(entry,mirror) for entry in entries]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=check_workers) as executor:
+        chunksize=max(1,min(256,len(entries)//(check_workers*4)))
+        return list(executor.map(check_image,entries,[mirror]*len(entries),chunksize=chunksize))
+
+def write_report(path,records):
+    path=pathlib.Path(path)
+    if path.suffix.lower()==".csv":
+        with open(path,"w",newline="",encoding="utf-8") as f:
+            report=csv.writer(f)
+            report.writerow(["image","failed","orientation","mirror","history_end"])
+            for record in records:
+                report.writerow([record["image"],";".join(record["failed"]),record["orientation"],record["mirror"],record["history_end"]])
+    else:
+        with open(path,"w",encoding="utf-8") as f:
+            json.dump(records,f,indent=1)
+
 def main():
 
-    p = root_path.rglob("*")
-    files = [x for x in p if x.is_file()]
+    library = library_scanner.scan_library(root_path, index_file=library_index, workers=scan_workers)
 
     supported_files = set.union(
         set(xmp_editing_utils.raw_files), set(xmp_editing_utils.other_files)
     )
-    files = [x for x in files if x.suffix.upper() in supported_files]
-
-    error_count=0
-    for file in files:
-        error=0
-        logger.debug(f"Checking {file}")
-        error+=check_base_xmp_file(file,mirror=mirror_config)
-        error+=check_dt_xmp_file(file)
-        if error>0:
-            error_count+=1
+    # images with their sidecars, matched regardless of case
+    entries = library.entries(supported_files)
+    files = [entry.image for entry in entries]
+
+    cache = check_cache.CheckCache(check_cache_file) if use_check_cache else None
+    records = {}
+    todo = []
+    for entry in entries:
+        file = entry.image
+        stats = migration_state.file_stats(sidecar_paths(file,entry))
+        record = cache.get(file,stats,mirror_config) if cache is not None else None
+        if record is not None:
+            records[file]=record
+            if record["failed"]:
+                logger.error(f"XMP checks failed on an earlier run, sidecars unchanged: {file}: {', '.join(record['failed'])}")
+        else:
+            todo.append((entry,stats))
+
+    logger.info(f"Checking {len(todo)} of {len(files)} images")
+    checked = check_images([entry for entry,_ in todo],mirror_config)
+    for (entry,stats),record in zip(todo,checked):
+        records[entry.image]=record
+    if cache is not None:
+        # sidecars that could not be read are checked again next time
+        cache.put_many((entry.image,stats,mirror_config,record) for (entry,stats),record in zip(todo,checked) if "unreadable" not in record["failed"])
+        cache.retain(root_path,files)
+        cache.close()
+
+    records=[records[file] for file in files]
+    if check_report is not None:
+        write_report(check_report,records)
+
+    error_count=sum(1 for record in records if record["failed"])
     if error_count>0:
         logger.error(f"Completed with {error_count} errors")
+    return error_count
 
 if __name__ == "__main__":
     logger.info("Running main()")
-    main()
+    # a non-zero exit status if any image failed a check
+    if main()>0:
+        raise SystemExit(1)
@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import pathlib
+import sqlite3
+import time
+
+
+# Local store of the crops generate_crop_xmp detected, so a rerun only decodes the
+# images that changed or were analysed with other parameters. A file is identified
+# by its device, inode, size and mtime, which survive renames but not edits.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS crops (
+    file_key TEXT,
+    params TEXT,
+    path TEXT,
+    xmp_param TEXT,
+    bbox TEXT,
+    control REAL,
+    width INTEGER,
+    height INTEGER,
+    last_used REAL,
+    PRIMARY KEY (file_key, params)
+)
+"""
+
+
+def file_key(path: pathlib.Path) -> str | None:
+    """Identity of the content of a file, None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return f"{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def hash_params(params: dict) -> str:
+    """Hash of the detection parameters a crop depends on."""
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+class CropCache:
+    """SQLite store of detected crops keyed by file identity and parameters.
+    Entries that were not used for the longest time are evicted beyond
+    max_entries. Used from a single thread."""
+
+    def __init__(self, path: pathlib.Path, params: dict, max_entries: int = 200000):
+        self.params = hash_params(params)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.cnx = sqlite3.connect(pathlib.Path(path))
+        self.cnx.execute("PRAGMA journal_mode=WAL")
+        self.cnx.execute(SCHEMA)
+        self.cnx.execute(
+            "CREATE INDEX IF NOT EXISTS crops_last_used ON crops (last_used)"
+        )
+        self.cnx.commit()
+
+    def get(self, path: pathlib.Path) -> dict | None:
+        """The xmp fields detected for the current content of path, None if unknown."""
+        key = file_key(path)
+        row = None
+        if key is not None:
+            row = self.cnx.execute(
+                "SELECT xmp_param FROM crops WHERE file_key = ? AND params = ?",
+                (key, self.params),
+            ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with self.cnx:
+            self.cnx.execute(
+                "UPDATE crops SET last_used = ?, path = ? "
+                "WHERE file_key = ? AND params = ?",
+                (time.time(), str(path), key, self.params),
+            )
+        return json.loads(row[0])
+
+    def put(self, path: pathlib.Path, xmp_param: dict, details: dict) -> None:
+        """Store the xmp fields and the bounding box, control value and image size
+        they were computed from."""
+        key = file_key(path)
+        if key is None:
+            return
+        with self.cnx:
+            self.cnx.execute(
+                "INSERT OR REPLACE INTO crops VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    self.params,
+                    str(path),
+                    json.dumps(xmp_param),
+                    json.dumps(details.get("bbox")),
+                    details.get("control"),
+                    details.get("width"),
+                    details.get("height"),
+                    time.time(),
+                ),
+            )
+
+    def evict(self) -> int:
+        """Remove the least recently used entries beyond max_entries."""
+        with self.cnx:
+            removed = self.cnx.execute(
+                "DELETE FROM crops WHERE rowid IN ("
+                "SELECT rowid FROM crops ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            ).rowcount
+        return removed
+
+    def clear(self) -> None:
+        with self.cnx:
+            self.cnx.execute("DELETE FROM crops")
+
+    def close(self) -> None:
+        self.evict()
+        self.cnx.close()
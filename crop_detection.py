@@ -0,0 +1,223 @@
+import math
+
+import cv2
+import numpy as np
+from PIL import Image
+from PIL import ImageFilter
+
+
+# Crop detection on numpy arrays. The bounding box is the one the blur, gray
+# threshold and getbbox of the PIL implementation give, but the full image is never
+# blurred or thresholded: a gray copy bounds where the blurred image can be above
+# the threshold, and only strips along the edges of that area are blurred exactly.
+
+# columns or rows blurred at once when looking for an edge
+strip_size = 64
+
+
+def crop_array(image: np.ndarray, box) -> np.ndarray:
+    """Crop like PIL's Image.crop: coordinates are rounded and the parts of the box
+    outside of the image are black."""
+    left, top, right, bottom = (int(round(x)) for x in box)
+    height, width = image.shape[:2]
+    inside = image[max(top, 0) : min(bottom, height), max(left, 0) : min(right, width)]
+    if left >= 0 and top >= 0 and right <= width and bottom <= height:
+        return inside
+    cropped = np.zeros((bottom - top, right - left) + image.shape[2:], image.dtype)
+    row, col = max(-top, 0), max(-left, 0)
+    cropped[row : row + inside.shape[0], col : col + inside.shape[1]] = inside
+    return cropped
+
+
+def blur_margin(blur_radius: float) -> int:
+    """Distance over which PIL's GaussianBlur (three box blurs of at most the
+    radius) spreads a pixel, plus one."""
+    return 3 * (math.ceil(blur_radius) + 1) + 1
+
+
+def threshold_mask(
+    rgb: np.ndarray, threshold: float, blur_radius: float, rows: slice, cols: slice
+) -> np.ndarray:
+    """Pixels of a region that are brighter than threshold in the blurred image.
+    Only the region and a margin around it are blurred."""
+    height, width = rgb.shape[:2]
+    margin = blur_margin(blur_radius)
+    top, left = max(rows.start - margin, 0), max(cols.start - margin, 0)
+    bottom, right = min(rows.stop + margin, height), min(cols.stop + margin, width)
+
+    region = Image.fromarray(np.ascontiguousarray(rgb[top:bottom, left:right]))
+    blurred = np.asarray(region.filter(ImageFilter.GaussianBlur(radius=blur_radius)))
+    gray = cv2.cvtColor(blurred, cv2.COLOR_RGB2GRAY)
+    gray = gray[
+        rows.start - top : rows.stop - top, cols.start - left : cols.stop - left
+    ]
+    return gray > threshold
+
+
+def candidates(bright: np.ndarray, margin: int) -> np.ndarray:
+    """Indices within margin of a bright row or column."""
+    spread = np.convolve(bright.astype(np.int32), np.ones(2 * margin + 1, np.int32))
+    return np.flatnonzero(spread[margin:-margin] if margin else spread)
+
+
+def first_edge(positions: np.ndarray, hits, reverse: bool = False) -> int | None:
+    """Scan positions in strips and return the first (last if reverse) for which
+    hits(strip) finds a pixel above the threshold."""
+    if reverse:
+        positions = positions[::-1]
+    for start in range(0, len(positions), strip_size):
+        chunk = positions[start : start + strip_size]
+        low, high = int(chunk.min()), int(chunk.max()) + 1
+        found = np.flatnonzero(hits(slice(low, high)))
+        if len(found):
+            return low + int(found[-1]) + 1 if reverse else low + int(found[0])
+    return None
+
+
+def otsu_threshold(histogram: np.ndarray) -> int:
+    """Threshold separating a gray level histogram in two classes with the largest
+    between-class variance."""
+    levels = np.arange(len(histogram), dtype=np.float64)
+    weight = np.cumsum(histogram, dtype=np.float64)
+    total = weight[-1]
+    if total == 0:
+        return 0
+    cumulative_mean = np.cumsum(histogram * levels)
+    mean = cumulative_mean[-1] / total
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance = (mean * weight - cumulative_mean) ** 2 / (weight * (total - weight))
+    return int(np.argmax(np.nan_to_num(variance)))
+
+
+class CropAnalysis:
+    """Bounding boxes and their validation for one image, at as many thresholds as
+    needed. The gray projections are computed once, the integral image the first
+    time several bounding boxes are validated."""
+
+    def __init__(self, rgb: np.ndarray, blur_radius: float):
+        self.rgb = rgb
+        self.blur_radius = blur_radius
+        self.margin = blur_margin(blur_radius)
+        gray = cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY)
+        self.row_max = gray.max(axis=1)
+        self.col_max = gray.max(axis=0)
+        self.integral = None
+
+    def bbox(self, threshold: float):
+        """Bounding box (left, top, right, bottom) of the area that is brighter than
+        threshold after blurring, None if there is none."""
+        rgb, blur_radius = self.rgb, self.blur_radius
+        # the blur averages, so a blurred pixel is at most as bright as the brightest
+        # pixel around it, give or take the rounding of the blur and gray conversion
+        rows = candidates(self.row_max >= threshold - 3, self.margin)
+        cols = candidates(self.col_max >= threshold - 3, self.margin)
+        if not len(rows) or not len(cols):
+            return None
+        row_span = slice(int(rows[0]), int(rows[-1]) + 1)
+
+        def column_hits(strip):
+            mask = threshold_mask(rgb, threshold, blur_radius, row_span, strip)
+            return mask.any(axis=0)
+
+        left = first_edge(cols, column_hits)
+        if left is None:
+            return None
+        right = first_edge(cols[cols >= left], column_hits, reverse=True)
+        col_span = slice(left, right)
+
+        def row_hits(strip):
+            mask = threshold_mask(rgb, threshold, blur_radius, strip, col_span)
+            return mask.any(axis=1)
+
+        top = first_edge(rows, row_hits)
+        bottom = first_edge(rows[rows >= top], row_hits, reverse=True)
+        return left, top, right, bottom
+
+    def build_integral(self) -> None:
+        """Summed-area table of the channel sums, for outside_mean in O(1)."""
+        if self.integral is not None:
+            return
+        height, width = self.rgb.shape[:2]
+        self.integral = np.zeros((height + 1, width + 1), dtype=np.int64)
+        np.cumsum(
+            self.rgb.sum(axis=2, dtype=np.int64), axis=0, out=self.integral[1:, 1:]
+        )
+        np.cumsum(self.integral[1:, 1:], axis=1, out=self.integral[1:, 1:])
+
+    def outside_mean(self, bbox) -> float:
+        """Mean color value outside of the bounding box, see control_value."""
+        if self.integral is None:
+            return control_value(self.rgb, bbox)
+        height, width = self.rgb.shape[:2]
+        top, left = min(max(bbox[1], 0), height), min(max(bbox[0], 0), width)
+        bottom = max(min(bbox[3] + 1, height), top)
+        right = max(min(bbox[2] + 1, width), left)
+        count = height * width - (bottom - top) * (right - left)
+        if count == 0:
+            return 0.0
+        integral = self.integral
+        inside = (
+            integral[bottom, right]
+            - integral[top, right]
+            - integral[bottom, left]
+            + integral[top, left]
+        )
+        return round(int(integral[-1, -1] - inside) / count / 3, 2)
+
+    def best_crop(self, thresholds):
+        """choose_crop among thresholds and the Otsu threshold of the image."""
+        self.build_integral()
+        gray = cv2.cvtColor(self.rgb, cv2.COLOR_RGB2GRAY)
+        histogram = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel()
+        del gray
+        full = (0, 0, self.rgb.shape[1], self.rgb.shape[0])
+        return choose_crop(
+            {*thresholds, otsu_threshold(histogram)},
+            self.bbox,
+            self.outside_mean,
+            full,
+        )
+
+
+def choose_crop(thresholds, bbox_at, outside_mean, full):
+    """Try the thresholds from the lowest up and return the (bbox, control value,
+    threshold) of the first one giving a crop with a mean outside of it of at most
+    half the threshold. If none does, the crop with the darkest outside relative to
+    its threshold, else the result of the highest threshold."""
+    fallback = None
+    for threshold in sorted(set(thresholds) - {0}):
+        bbox = bbox_at(threshold)
+        if not bbox or bbox == full:
+            if fallback is None or fallback[1] is None:
+                fallback = (bbox, None, threshold)
+            continue
+        control = outside_mean(bbox)
+        if control <= threshold / 2:
+            return bbox, control, threshold
+        if (
+            fallback is None
+            or fallback[1] is None
+            or control / threshold < fallback[1] / fallback[2]
+        ):
+            fallback = (bbox, control, threshold)
+    return fallback
+
+
+def control_value(rgb: np.ndarray, bbox) -> float:
+    """Mean color value outside of the bounding box, averaged over the channels.
+    The closer to 0, the darker the area that is cropped away; a high value hints
+    at a wrong bounding box cutting into the picture. The bounding box is taken as
+    inclusive of its right and bottom edge."""
+    height, width = rgb.shape[:2]
+    inside = rgb[
+        max(bbox[1], 0) : min(bbox[3] + 1, height),
+        max(bbox[0], 0) : min(bbox[2] + 1, width),
+    ]
+    count = height * width - inside.shape[0] * inside.shape[1]
+    if count == 0:
+        return 0.0
+    total = rgb.sum(axis=(0, 1), dtype=np.uint64) - inside.sum(
+        axis=(0, 1), dtype=np.uint64
+    )
+    avg_list = [int(x) / count for x in total]
+    return round(sum(avg_list) / 3, 2)
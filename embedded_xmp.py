@@ -0,0 +1,123 @@
+import mmap
+import os
+import pathlib
+import struct
+
+
+# XMP packets embedded in JPEG and TIFF based images, read from the file structure
+# instead of with exiftool. Only the start of the file is mapped: the JPEG segments
+# before the image data, or the first IFD of a TIFF, so the pixel data is never
+# read. Files of other formats, or laid out in a way not handled here, give None
+# and are left to exiftool.
+
+# the file is only mapped up to this many bytes from its start
+header_bytes = 1 << 20
+
+jpeg_suffixes = {".JPG", ".JPEG"}
+# TIFF based formats with the packet in tag 700 of the first IFD
+tiff_suffixes = {".TIF", ".TIFF", ".DNG", ".CR2"}
+
+xmp_signature = b"http://ns.adobe.com/xap/1.0/\x00"
+extension_signature = b"http://ns.adobe.com/xmp/extension/\x00"
+xmp_tag = 700
+
+
+def read_embedded_xmp(path: pathlib.Path) -> str | None:
+    """The XMP packet embedded in a JPEG or TIFF based file, "" if it has none.
+    None if the file is of another format or could not be read this way."""
+    suffix = pathlib.Path(path).suffix.upper()
+    if suffix in jpeg_suffixes:
+        reader = _jpeg_packet
+    elif suffix in tiff_suffixes:
+        reader = _tiff_packet
+    else:
+        return None
+
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return None
+            with mmap.mmap(
+                f.fileno(), min(size, header_bytes), access=mmap.ACCESS_READ
+            ) as header:
+                packet = reader(f, header, size)
+        if packet is None or (packet and b"<x:xmpmeta" not in packet):
+            return None
+        return packet.decode("utf-8")
+    except (OSError, ValueError, struct.error):
+        # ValueError includes packets that are not utf-8
+        return None
+
+
+def _jpeg_packet(f, header: mmap.mmap, size: int) -> bytes | None:
+    """The payload of the XMP APP1 segment, read up to the start of the scan."""
+    if header[:2] != b"\xff\xd8":
+        return None
+    packet = b""
+    pos = 2
+    while pos + 4 <= len(header):
+        if header[pos] != 0xFF:
+            return None
+        marker = header[pos + 1]
+        if marker == 0xFF:
+            # fill byte
+            pos += 1
+            continue
+        if marker in (0xDA, 0xD9):
+            # start of scan or end of image, no metadata follows
+            return packet
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            # markers without a length
+            pos += 2
+            continue
+        (length,) = struct.unpack_from(">H", header, pos + 2)
+        end = pos + 2 + length
+        if marker == 0xE1:
+            if end > len(header):
+                return None
+            data = header[pos + 4 : end]
+            if data.startswith(xmp_signature):
+                if packet:
+                    return None
+                packet = data[len(xmp_signature) :]
+            elif data.startswith(extension_signature):
+                # extended XMP is split over several segments, exiftool joins them
+                return None
+        pos = end
+    return None
+
+
+def _tiff_packet(f, header: mmap.mmap, size: int) -> bytes | None:
+    """The value of tag 700 in the first IFD of a classic TIFF."""
+    order = {b"II": "<", b"MM": ">"}.get(header[:2])
+    if order is None or len(header) < 8:
+        return None
+    version, offset = struct.unpack_from(order + "HI", header, 2)
+    if version != 42 or offset + 2 > len(header):
+        return None
+    (count,) = struct.unpack_from(order + "H", header, offset)
+    if offset + 2 + count * 12 > len(header):
+        return None
+
+    for i in range(count):
+        tag, kind, n, value = struct.unpack_from(
+            order + "HHI4s", header, offset + 2 + i * 12
+        )
+        if tag != xmp_tag:
+            continue
+        # BYTE or UNDEFINED
+        if kind not in (1, 7):
+            return None
+        if n <= 4:
+            return value[:n]
+        (start,) = struct.unpack(order + "I", value)
+        if start + n > size:
+            return None
+        if start + n <= len(header):
+            return header[start : start + n]
+        # some writers put the packet at the end of the file
+        f.seek(start)
+        data = f.read(n)
+        return data if len(data) == n else None
+    return b""
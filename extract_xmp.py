@@ -1,23 +1,30 @@
+import concurrent.futures
+import csv
 import importlib.resources
+import itertools
+import multiprocessing.util
 import pathlib
-import shutil
-import sqlite3
-import tempfile
+from typing import NamedTuple
 
 import logzero
-import pandas as pd
-import pyexiv2
 import yaml
 from exiftool import ExifTool
 from logzero import logger
 from slpp import slpp as lua
 
-from xmp_editing_utils import copy_xmp_temp
+import instrumentation
+import library_scanner
+import lightroom_catalog
+import lightroom_settings
+import migration_state
+import sidecar_writer
+import xmp_packet
+from xmp_editing_utils import lookup_xmp_packet
+from xmp_editing_utils import read_xmp_packets
 
 # NOTE: After import into darktable, the metadata "write sidecar files" button needs to be pressed
 # This will write from the database (including imported Lightroom date) to the new darktable xmp files
 
-pyexiv2.set_log_level(1)
 logzero.logfile("rotating-logfile.log", maxBytes=1e8, backupCount=3)
 logger.setLevel(level="DEBUG")
 # load settings
@@ -37,76 +44,84 @@ with importlib.resources.files("tags").joinpath("tags_from_darktable.txt").open(
     "r", encoding="utf8"
 ) as f:
     tags = f.read().splitlines()
+settings_keys = frozenset(tags + ["ProcessVersion"])
+# the settings that shape the sidecars, a row is processed again when they change
+settings_hash = migration_state.hash_inputs(*sorted(settings_keys), update_file)
 
-# test query of the view created in img_view.sql
-# limit this to only those filetypes supported by DarkTable
-# https://docs.darktable.org/usermanual/development/en/overview/supported-file-formats/
-sql_query = f"""
-select *
-from IMG
-WHERE 
-    --(
-    --baseName like 'Crystal-0075%'
-    --or baseName like 'Crystals-1600%'
-    --or baseName like 'London-3471%'
-    --or baseName like 'LWP42267%'
-    --or baseName like 'wedding 583%'
-    --or baseName like 'Star Trails-4%'
-    --or baseName like 'Na3Bi-111345%'
-    --) 
-    --(PathFromRoot like '2006%' or PathFromRoot like '2021%' or PathFromRoot like '2013%' or PathFromRoot like '2014%' or PathFromRoot like '2018%' or PathFromRoot like '2010%')
-    RootFolderName = '{RootFolderName}'
-    and 
-    upper(FileType) in (
-    -- Regular formats
-    '3FR', 'ARI', 'ARW', 'BAY', 'BMQ', 'CAP', 'CINE', 'CR2', 'CR3', 'CRW',
-    'CS1', 'DC2', 'DCR', 'DNG', 'GPR', 'ERF', 'FFF', 'EXR', 'IA', 'IIQ',
-    'JPEG', 'JPG', 'K25', 'KC2', 'KDC', 'MDC', 'MEF', 'MOS', 'MRW', 'NEF',
-    'NRW', 'ORF', 'PEF', 'PFM', 'PNG', 'PXN', 'QTK', 'RAF', 'RAW', 'RDC',
-    'RW1', 'RW2', 'SR2', 'SRF', 'SRW', 'STI', 'TIF', 'TIFF', 'X3F',
-    -- Extended Formats
-    'J2C', 'J2K', 'JP2', 'JPC',
-    'BMP', 'DCM', 'GIF', 'JNG', 'JPC', 'JP2', 'MIFF',
-    'MNG', 'PBM', 'PGM', 'PNM', 'PPM', 'WEBP'
-    )
-"""
+# number of catalog rows pulled from the cursor at a time
+batch_size = config_data.get("batch_size", 500)
+# maximum number of rows of one folder whose XMP is read with one exiftool request
+folder_batch_size = config_data.get("folder_batch_size", 100)
+# number of worker processes, each with its own ExifTool process
+workers = config_data.get("workers", 1)
 
 # Creating the path to the lightroom catalog
 catalog = importlib.resources.files("untracked").joinpath(catalog_file)
 
-# Create your connection.
-cnx = sqlite3.connect(catalog)
-# Load all files and their xmp/processing data into memory
-# not very efficient, but probably OK for 100k photos
-df = pd.read_sql_query(sql_query, cnx)
-cnx.close()
-
-
-def reprocess_tuples(xmp_dict: dict) -> None:
-    keys_of_interest = {
-        "Xmp.crs.ToneCurvePV2012",
-        "Xmp.crs.ToneCurve",
-        "Xmp.crs.ToneCurveRed",
-        "Xmp.crs.ToneCurveBlue",
-        "Xmp.crs.ToneCurveGreen",
-    }
-    keys_set = set(xmp_dict.keys())
-    keys_to_fix = keys_of_interest.intersection(keys_set)
+# indexed copy of the catalog's Img view, rebuilt when the catalog changes
+index_file = importlib.resources.files("untracked").joinpath(
+    config_data.get("index_file", "catalog_index.sqlite")
+)
+# optional filters to run on a subset of the catalog
+path_prefix = config_data.get("path_prefix")
+captured_after = config_data.get("captured_after")
+captured_before = config_data.get("captured_before")
+file_types = config_data.get("file_types", lightroom_catalog.SUPPORTED_FILE_TYPES)
+
+# record of processed rows, kept next to the config
+state_file = importlib.resources.files("untracked").joinpath(
+    config_data.get("state_file", "extract_state.sqlite")
+)
+# skip rows that are unchanged since they were last processed successfully
+resume = config_data.get("resume", True)
+# catalog rows whose image is not found, as csv next to the config
+missing_report = config_data.get("missing_report", "missing_files.csv")
+if missing_report is not None:
+    missing_report = importlib.resources.files("untracked").joinpath(missing_report)
+# time the stages of every row, optionally writing one json line per row
+timing = config_data.get("timing", False)
+trace_file = config_data.get("trace_file")
+
+metrics = instrumentation.Metrics(enabled=timing, trace_file=trace_file)
+metrics.watch(logger)
+
+
+# tone curves are stored as a flat list of x, y values in the Lightroom catalog
+tone_curve_keys = {
+    "Xmp.crs.ToneCurvePV2012",
+    "Xmp.crs.ToneCurve",
+    "Xmp.crs.ToneCurveRed",
+    "Xmp.crs.ToneCurveBlue",
+    "Xmp.crs.ToneCurveGreen",
+}
+
+
+def to_xmp_value(key: str, value):
+    """Convert a value decoded from the Lightroom lua table to an XMP value. Tables
+    with named fields become structures with their fields in the crs namespace."""
+    if isinstance(value, dict):
+        fields = {k: v for k, v in value.items() if isinstance(k, str)}
+        if fields:
+            if len(fields) < len(value):
+                logger.warning(f"Values without a name in {key} are not kept")
+            return xmp_packet.XmpStruct(
+                (f"Xmp.crs.{k}", to_xmp_value(f"Xmp.crs.{k}", v))
+                for k, v in fields.items()
+            )
+        # {} or a table of [1] = ... entries
+        value = [value[k] for k in sorted(value)]
 
-    # based on the darktable code, it looks like this is expected to be a list of tuples/lists
-    for key in keys_to_fix:
-        temp_list = xmp_dict[key]
-        if len(temp_list) % 2 == 1:
-            raise ValueError(f"Unexpected length of {key}")
+    if not isinstance(value, list):
+        return value
 
-        new_list = []
-        for i in range(len(temp_list) // 2):
-            # pyexiv2 uses ", " as a separator for multiple values.
-            # So it might automatically split the string you want to write.
-            # https://github.com/LeoHsiao1/pyexiv2/blob/master/docs/Tutorial.md
-            new_list.append(f"{temp_list[2*i]}, {temp_list[2*i+1]}")
+    if key in tone_curve_keys:
+        # based on the darktable code, it looks like this is expected to be a
+        # sequence of "x, y" points
+        if len(value) % 2 == 1:
+            raise ValueError(f"Unexpected length of {key}")
+        value = [f"{value[2*i]}, {value[2*i+1]}" for i in range(len(value) // 2)]
 
-        xmp_dict[key] = new_list
+    return xmp_packet.XmpArray("Seq", [to_xmp_value(key, item) for item in value])
 
 
 def parse_lightroom_processtext(
@@ -119,18 +134,22 @@ def parse_lightroom_processtext(
         # if no process text, return empty dictionary
         return {}
     elif lightroom_processtext[0:4] == "s = ":
-        data = lua.decode(lightroom_processtext[4:])
+        try:
+            # only the values of the tags darktable uses are decoded
+            data = lightroom_settings.decode_cached(
+                lightroom_processtext[4:], keys=settings_keys
+            )
+        except ValueError as e:
+            logger.warning(f"Falling back to slpp for develop settings: {e}")
+            data = lua.decode(lightroom_processtext[4:])
     else:
         logger.critical("unexpected start to lua string")
         raise (BaseException("unexpected start to lua string"))
 
     tagintersect = set(tags).intersection(set(data.keys()))
-    intersect_dict = {f"Xmp.crs.{k}": data[k] for k in tagintersect}
-
-    # Find keys that need to be reprocessed
-    intersect_dict.keys()
-
-    # reprocessing of the tone curve tuples will be handled right before updating xmp to avoid duplicate processing
+    intersect_dict = {
+        f"Xmp.crs.{k}": to_xmp_value(f"Xmp.crs.{k}", data[k]) for k in tagintersect
+    }
 
     # keep process version for future reference, though this does not
     # appear to be used by darktable.
@@ -143,99 +162,68 @@ def parse_lightroom_processtext(
     return intersect_dict
 
 
-def check_and_set_crop(xmp_dict: dict) -> None:
-    required_crop_fields = {
+# crop fields that mark an image as cropped
+crop_keys = frozenset(
+    {
         "Xmp.crs.CropTop",
         "Xmp.crs.CropRight",
         "Xmp.crs.CropLeft",
         "Xmp.crs.CropBottom",
         "Xmp.crs.CropAngle",
     }
-    intersection_size = len(required_crop_fields.intersection(set(xmp_dict.keys())))
-    # if any crop fields are specified, set the crop attribute to True
-    if intersection_size > 0:
-        xmp_dict["Xmp.crs.HasCrop"] = "True"
-        logger.debug("Set HasCrop")
-
-
-def check_drop_modify(file_to_modify, xmp_to_clean):
-    extra_keys_to_drop = []
-
-    with pyexiv2.Image(file_to_modify.as_posix()) as img:
-        img_xmp = img.read_xmp()
-
-        for k, v in img_xmp.items():
-            if v in ['type="Struct"', 'type="Seq"', 'type="Bag"']:
-                extra_keys_to_drop.append(k)
-
-        # drop fields if anything was identified
-        if len(extra_keys_to_drop) > 0:
-            drop_fields(xmp_to_clean, extra_keys=extra_keys_to_drop)
-
-        img.modify_xmp(xmp_to_clean)
-
-
-def extract_xmp(xmp_file: pathlib.PosixPath) -> dict:
-    with pyexiv2.Image(xmp_file.as_posix()) as img:
-        file_xmp = img.read_xmp()
-
-    drop_fields(file_xmp)
-    return file_xmp
-
-
-def drop_fields(xmp_dict: dict, extra_keys: list = None):
-    """Operates in place on the provided XMP dictionary to remove problematic entries.
-    These include accompanying tags for anything with 'type="Struct"' or 'type="Seq"'
-    Drop bad tags like "Xmp.xmpMM.History[x]"
-    history tags cannot be updated per documentation: https://github.com/LeoHsiao1/pyexiv2/blob/master/docs/Tutorial.md
-    when reading in this or anything with ", " in them, it gets messed up
-    """
-    keys_list = list(xmp_dict.keys())
-    bad_keys = []
-    if extra_keys is not None:
-        bad_keys = bad_keys + extra_keys
-    drop_set = set()
-    for k, v in xmp_dict.items():
-        if v in ['type="Struct"', 'type="Seq"']:
-            bad_keys.append(k)
+)
+
+# fields a cropped image needs, matched on the name without the namespace prefix
+required_crop_fields = frozenset(
+    {
+        "CropTop",
+        "CropRight",
+        "CropLeft",
+        "CropBottom",
+        "CropAngle",
+        # NOTE: While testing indicates the below image width/length/orientation
+        # are needed, no missing tags have been observed.
+        "ImageWidth",
+        "ImageLength",
+        "Orientation",
+    }
+)
 
-    for key in bad_keys:
-        bad_temp = [x for x in keys_list if x.startswith(key)]
-        drop_set.update(bad_temp)
 
-    # drop everything from the set
-    [xmp_dict.pop(key) for key in drop_set]
+def normalize_xmp(xmp_dict: dict) -> None:
+    """Apply the fixes needed before the merged xmp is written, in place.
+    The keys are only walked once, all rules work from what that pass collects."""
+    has_crop_field = False
+    short_keys = set()
+    for key in xmp_dict:
+        if key in crop_keys:
+            has_crop_field = True
+        short_keys.add(key[key.rfind(".") + 1 :])
 
-    # return xmp_dict
+    # if any crop fields are specified, set the crop attribute to True
+    if has_crop_field:
+        xmp_dict["Xmp.crs.HasCrop"] = "True"
+        logger.debug("Set HasCrop")
 
+    # if the label is none, remove it. This would otherwise get set as a purple label
+    field_to_delete = "Xmp.xmp.Label"
+    if str(xmp_dict.get(field_to_delete, "")) == "None":
+        del xmp_dict[field_to_delete]
+        logger.info(f"Problematic XMP: {field_to_delete} deleted")
 
-def check_crop_fields(xmp_dict: dict):
+    # check state of crop metadata and fill in what is missing
     if str(xmp_dict.get("Xmp.crs.HasCrop")).lower() == "true":
-        required_fields = {
-            "CropTop",
-            "CropRight",
-            "CropLeft",
-            "CropBottom",
-            "CropAngle",
-            # NOTE: While testing indicates the below image width/length/orientation
-            # are needed, no missing tags have been observed.
-            "ImageWidth",
-            "ImageLength",
-            "Orientation",
-        }
-        for key in xmp_dict.keys():
-            short_key = key.split(".")[-1]
-            required_fields.discard(short_key)
+        missing_fields = required_crop_fields - short_keys
+        if len(missing_fields) > 0:
+            logger.debug(f"XMP - Missing required crop fields: {set(missing_fields)}")
+            crop_fix = crop_fields_from_missing(missing_fields)
 
-        if len(required_fields) > 0:
-            logger.debug(f"XMP - Missing required crop fields: {required_fields}")
-            return required_fields
+            if len(crop_fix) > 0:
+                xmp_dict.update(crop_fix)
+                logger.debug(f"Crop Data - Fixed: {crop_fix.keys()}")
 
-    # return empty set if no problems
-    return set()
 
-
-def crop_fields_from_missing(missing_fields: dict):
+def crop_fields_from_missing(missing_fields: set):
     # look for crop fields in the provided xmp and return a dictionary of the missing fields
     crop_fix = {}
 
@@ -253,67 +241,136 @@ def crop_fields_from_missing(missing_fields: dict):
     return crop_fix
 
 
-def process_file(data_series, et, update_file: bool = True):
-    path_from_root = data_series.loc["PathFromRoot"]
-    temp_path = data_series.loc["BaseName"] + "." + data_series.loc["FileType"]
-    lr_xmp_path = data_series.loc["BaseName"] + ".xmp"
-    darktable_xmp_path = (
-        data_series.loc["BaseName"] + "." + data_series.loc["FileType"] + ".xmp"
-    )
-    lightroom_processtext = data_series.loc["processtext"]
-    process_ver = data_series.loc["processversion"]
-    db_xmp = data_series.loc["xmp"]
+def row_paths(row: lightroom_catalog.CatalogRow):
+    """Return the image, file.xmp and file.ext.xmp paths of a catalog row."""
+    temp_path = row.base_name + "." + row.file_type
+    lr_xmp_path = row.base_name + ".xmp"
+    darktable_xmp_path = row.base_name + "." + row.file_type + ".xmp"
 
     # combine path
-    filepath = pathlib.Path(root_path, path_from_root, temp_path)
-    filepath_lr_xmp = pathlib.Path(root_path, path_from_root, lr_xmp_path)
-    filepath_darktable_xmp = pathlib.Path(root_path, path_from_root, darktable_xmp_path)
+    folder = pathlib.Path(root_path, row.path_from_root)
+    return (
+        pathlib.Path(folder, temp_path),
+        pathlib.Path(folder, lr_xmp_path),
+        pathlib.Path(folder, darktable_xmp_path),
+    )
 
-    # check the file first, abort if it isn't there
-    if not filepath.is_file():
-        logger.error(f"File {filepath} not found")
-        return
-
-    # set up temp folder in tmpfs to keep it in memory
-    # /dev/shm is a ramdisk. Create files here for ephemeral transformations that require writing to disk
-    tempdir = tempfile.TemporaryDirectory(dir="/dev/shm")
-    temp_dir_path = pathlib.Path(tempdir.name)
-
-    # paths: original file xmp copy, database xmp, sidecar file.xmp, sidecar file.ext.xmp,
-    temp_files = {
-        "orig": pathlib.Path(temp_dir_path, "orig.xmp"),
-        "db": pathlib.Path(temp_dir_path, "db.xmp"),
-        "sidecar_lr": pathlib.Path(temp_dir_path, "sidecar.xmp"),
-        "sidecar_darktable": pathlib.Path(temp_dir_path, "sidecar.ext.xmp"),
-    }
 
-    # Create temp files from extracted data
-    copy_xmp_temp(filepath, temp_files["orig"], et=et)
+class RowFiles(NamedTuple):
+    """Files of a catalog row as found in its folder, matched regardless of case."""
 
-    # write database XMP to temp
-    with open(temp_files["db"], "w") as f:
-        f.write(db_xmp)
+    image: pathlib.Path | None  # None if missing
+    sidecar_lr: pathlib.Path  # the existing file.xmp, or where to create it
+    sidecar_lr_exists: bool
+    sidecar_darktable: pathlib.Path | None  # None if missing
 
-    # try sidecar files
-    # # TODO: case insensitive implementation
-    copy_xmp_temp(filepath_lr_xmp, temp_files["sidecar_lr"], et=et, warn=True)
-    if filepath_darktable_xmp.is_file():
-        logger.warning(
-            f"DarkTable XMP Exists: Lightroom data will not be imported: {filepath_darktable_xmp}"
-        )
-        copy_xmp_temp(filepath_darktable_xmp, temp_files["sidecar_darktable"], et=et)
 
-    # prepare data from database for stacking
-    intersect_dict = parse_lightroom_processtext(
-        lightroom_processtext=lightroom_processtext, tags=tags, process_ver=process_ver
+def resolve_row_files(
+    row: lightroom_catalog.CatalogRow, folder: library_scanner.LibraryIndex
+) -> RowFiles:
+    """Join a catalog row with the listing of its folder."""
+    filepath, filepath_lr_xmp, filepath_darktable_xmp = row_paths(row)
+    found_lr_xmp = folder.find(filepath_lr_xmp)
+    return RowFiles(
+        folder.find(filepath),
+        found_lr_xmp or filepath_lr_xmp,
+        found_lr_xmp is not None,
+        folder.find(filepath_darktable_xmp),
+    )
+
+
+def check_row_files(row: lightroom_catalog.CatalogRow) -> RowFiles:
+    """RowFiles of a row from the file system, for rows that were not reconciled."""
+    filepath, filepath_lr_xmp, filepath_darktable_xmp = row_paths(row)
+    return RowFiles(
+        filepath if filepath.is_file() else None,
+        filepath_lr_xmp,
+        filepath_lr_xmp.is_file(),
+        filepath_darktable_xmp if filepath_darktable_xmp.is_file() else None,
+    )
+
+
+def stat_paths(row: lightroom_catalog.CatalogRow, files: RowFiles):
+    """The paths whose stats are recorded in the state, as found on disk."""
+    filepath, _, filepath_darktable_xmp = row_paths(row)
+    return (
+        files.image or filepath,
+        files.sidecar_lr,
+        files.sidecar_darktable or filepath_darktable_xmp,
+    )
+
+
+def existing_files(files: RowFiles) -> list[pathlib.Path]:
+    paths = [files.image, files.sidecar_darktable]
+    if files.sidecar_lr_exists:
+        paths.append(files.sidecar_lr)
+    return [path for path in paths if path is not None]
+
+
+def process_file(
+    row: lightroom_catalog.CatalogRow,
+    et,
+    cnx,
+    update_file: bool = True,
+    prefetched: dict | None = None,
+    develop_data: lightroom_catalog.DevelopData | None = None,
+    writer: sidecar_writer.SidecarWriter | None = None,
+    files: RowFiles | None = None,
+):
+    """Merge the XMP layers of a catalog row into its file.xmp sidecar.
+    prefetched is an optional path to packet mapping from read_xmp_packets,
+    develop_data the already fetched catalog blobs of the row. writer counts
+    the written and unchanged sidecars. files are the files of the row from the
+    folder listing, checked on the file system if not given.
+    Returns whether the sidecar was written (or already held the merged xmp)."""
+    if files is None:
+        files = check_row_files(row)
+    filepath = files.image
+    filepath_lr_xmp = files.sidecar_lr
+    filepath_darktable_xmp = files.sidecar_darktable
+
+    # check the file first, abort if it isn't there
+    if filepath is None:
+        logger.error(f"File {row_paths(row)[0]} not found")
+        return False
+
+    # the blobs are only loaded for rows that are actually processed
+    if develop_data is None:
+        develop_data = lightroom_catalog.fetch_develop_data(cnx, row.image_id)
+    lightroom_processtext = develop_data.processtext
+    process_ver = develop_data.processversion
+
+    # packets: original file xmp, database xmp, sidecar file.xmp, sidecar file.ext.xmp
+    # these are all merged in memory, nothing is written until the final sidecar
+    with metrics.stage("read xmp"):
+        packets = {
+            "orig": lookup_xmp_packet(filepath, prefetched, et=et),
+            "db": develop_data.xmp,
+        }
+        if files.sidecar_lr_exists:
+            packets["sidecar_lr"] = lookup_xmp_packet(
+                filepath_lr_xmp, prefetched, et=et, warn=True
+            )
+        else:
+            logger.warning(f"File {filepath_lr_xmp} not found")
+        if filepath_darktable_xmp is not None:
+            logger.warning(
+                f"DarkTable XMP Exists: Lightroom data will not be imported: {filepath_darktable_xmp}"
+            )
+            packets["sidecar_darktable"] = lookup_xmp_packet(
+                filepath_darktable_xmp, prefetched, et=et
+            )
+    metrics.count(
+        "xmp bytes read", sum(len(p) for p in packets.values() if p is not None)
     )
 
-    # stack data
-    temp_xmp = {}
-    for k, v in temp_files.items():
-        if v.is_file():
-            logger.debug(f"loading {v}")
-            temp_xmp[k] = extract_xmp(v)
+    # prepare data from database for stacking
+    with metrics.stage("develop settings"):
+        intersect_dict = parse_lightroom_processtext(
+            lightroom_processtext=lightroom_processtext,
+            tags=tags,
+            process_ver=process_ver,
+        )
 
     # combine dictionaries
     combined_xmp = {}
@@ -323,104 +380,301 @@ def process_file(data_series, et, update_file: bool = True):
         "sidecar_lr",
         "sidecar_darktable",
     ]
-    for key in order:
-        xmp = temp_xmp.get(key)
-        if xmp is not None:
-            combined_xmp.update(xmp)
-
-    # add data from database
-    combined_xmp.update(intersect_dict)
-
-    check_and_set_crop(combined_xmp)
-
-    # fix any issues with tonecurves in them
-    reprocess_tuples(combined_xmp)
-
-    # if the label is none, remove it. This would otherwise get set as a purple label
-    # field set to none so if modifying existing file the field is removed
-    # to be successful, this must be applied after doing any "fixes" on the xmp
-    field_to_delete = "Xmp.xmp.Label"
-    if (
-        field_to_delete in combined_xmp.keys()
-        and str(combined_xmp[field_to_delete]) == "None"
+    with metrics.stage("merge"):
+        for key in order:
+            packet = packets.get(key)
+            if packet is not None:
+                logger.debug(f"loading {key}")
+                combined_xmp.update(xmp_packet.parse_packet(packet))
+
+        # add data from database
+        combined_xmp.update(intersect_dict)
+
+    with metrics.stage("normalize"):
+        normalize_xmp(combined_xmp)
+
+    if not update_file:
+        logger.info(f"No-Op Mode: {filepath_lr_xmp} not written")
+        return False
+
+    # the merged packet is complete, so the sidecar is written at most once
+    if writer is None:
+        writer = sidecar_writer.SidecarWriter()
+    with metrics.stage("write"):
+        writer.write(filepath_lr_xmp, combined_xmp)
+    # a later row sharing the sidecar merges with what was just written
+    if prefetched is not None:
+        prefetched[filepath_lr_xmp] = xmp_packet.serialize_packet(combined_xmp)
+    return True
+
+
+def process_rows(rows: list, et, cnx, state=None):
+    """Process (index, row) pairs in order.
+    Sidecar groups whose catalog data and files did not change since a successful
+    run recorded in state are skipped. The XMP of all files of the remaining rows
+    is read up front with one exiftool request.
+    Returns the RowState of every processed row, the number of skipped rows and
+    a snapshot of the metrics collected in this process since the last batch."""
+    writer = sidecar_writer.SidecarWriter()
+    todo = []
+    skipped = 0
+    for _, group in itertools.groupby(
+        rows, key=lambda item: lightroom_catalog.sidecar_key(item[1])
     ):
-        # new_xmp.modify_xmp({field_to_delete: None})
-        combined_xmp[field_to_delete] = None
-        logger.info(f"Problematic XMP: {field_to_delete} deleted")
+        entries = []
+        for i, row, files in group:
+            with metrics.stage("catalog"):
+                develop_data = lightroom_catalog.fetch_develop_data(cnx, row.image_id)
+            input_hash = migration_state.hash_inputs(settings_hash, *develop_data)
+            entries.append((i, row, develop_data, input_hash, files))
+
+        # rows sharing a sidecar are skipped or processed together
+        with metrics.stage("state check"):
+            unchanged = state is not None and all(
+                state.is_unchanged(
+                    row.image_id,
+                    row.name,
+                    input_hash,
+                    migration_state.file_stats(stat_paths(row, files)),
+                )
+                for _, row, _, input_hash, files in entries
+            )
+        if unchanged:
+            for i, row, _, _, _ in entries:
+                logger.debug(f"Index: {i}, unchanged: {row.name}")
+            skipped += len(entries)
+        else:
+            todo.extend(entries)
+
+    metrics.count("rows skipped", skipped)
+    if not todo:
+        return [], skipped, metrics.snapshot(reset=True)
+
+    try:
+        paths = [path for *_, files in todo for path in existing_files(files)]
+        with metrics.stage("exiftool"):
+            prefetched = read_xmp_packets(paths, et=et, exist=True)
+    except Exception as e:
+        # fall back to reading the files one at a time
+        logger.warning(f"Batch XMP extraction failed: {e}")
+        prefetched = None
+
+    outcomes = []
+    # sidecars written in this batch by sidecar key, which a later row of the same
+    # group reads even though the folder listing predates them
+    written = {}
+    for i, row, develop_data, _, files in todo:
+        logger.info(f"Index: {i}, name: {row.name}")
+        key = lightroom_catalog.sidecar_key(row)
+        if key in written:
+            files = files._replace(sidecar_lr=written[key], sidecar_lr_exists=True)
+        try:
+            with metrics.item(row.name):
+                wrote = process_file(
+                    row=row,
+                    et=et,
+                    cnx=cnx,
+                    update_file=update_file,
+                    prefetched=prefetched,
+                    develop_data=develop_data,
+                    writer=writer,
+                    files=files,
+                )
+        except Exception as e:
+            logger.error(f"Failed to process: {row.name}")
+            logger.error(f"Exception: {e}")
+            outcomes.append(("failed", str(e)))
+        else:
+            outcomes.append(("ok", ""))
+            if wrote:
+                written[key] = files.sidecar_lr
+
+    # stats are taken once the whole batch is done and shared sidecars are final
+    states = []
+    for (_, row, _, input_hash, files), (outcome, message) in zip(todo, outcomes):
+        stats = migration_state.file_stats(stat_paths(row, files))
+        if outcome == "ok" and stats[0] is None:
+            outcome = "missing"
+        states.append(
+            migration_state.RowState(
+                row.image_id, row.name, input_hash, stats, outcome, message
+            )
+        )
 
-    # before saving changes, check state of crop metadata
-    required_fields = check_crop_fields(xmp_dict=combined_xmp)
-    if len(required_fields) > 0:
-        # create dictionary for missing fields
-        crop_fix = crop_fields_from_missing(required_fields)
+    metrics.count("rows processed", len(todo))
+    metrics.count("sidecars written", writer.written)
+    metrics.count("sidecars unchanged", writer.unchanged)
+    return states, skipped, metrics.snapshot(reset=True)
 
-        if len(crop_fix) > 0:
-            combined_xmp.update(crop_fix)
-            logger.debug(f"Crop Data - Fixed: {crop_fix.keys()}")
 
-    if update_file:
-        # only execute updates if not in No-Op Mode
-        if filepath_lr_xmp.is_file():
-            # updating file
-            # copy data back to LR format file
-            check_drop_modify(file_to_modify=filepath_lr_xmp, xmp_to_clean=combined_xmp)
+# state owned by each worker process of the pool
+_worker_state = {}
 
-            logger.debug(f"updated {filepath_lr_xmp}")
-        else:
-            check_drop_modify(
-                file_to_modify=temp_files["orig"], xmp_to_clean=combined_xmp
-            )
 
-            # copy "original" as this is the file corresponding to new_xmp
-            shutil.copy(temp_files["orig"], filepath_lr_xmp)
-            logger.debug(f"copied file to {filepath_lr_xmp}")
+def _init_worker(use_state: bool):
+    et = ExifTool()
+    et.run()
+    _worker_state["et"] = et
+    _worker_state["cnx"] = lightroom_catalog.connect(catalog)
+    # only the main process writes to the state store
+    if use_state:
+        _worker_state["state"] = migration_state.StateStore(state_file, readonly=True)
+    # pool workers exit without running atexit hooks, finalizers are still run
+    multiprocessing.util.Finalize(None, _close_worker, exitpriority=10)
 
-    if not filepath_lr_xmp.is_file() and not update_file:
-        logger.error(f"No-Op Mode: File {filepath} not found to check")
-        tempdir.cleanup()
-        return
 
-    final_xmp = pyexiv2.Image(filepath_lr_xmp.as_posix())
-    final_xmp_dict = final_xmp.read_xmp()
+def _close_worker():
+    metrics.close()
+    _worker_state.pop("et").terminate()
+    _worker_state.pop("cnx").close()
+    if "state" in _worker_state:
+        _worker_state.pop("state").close()
 
-    # Final check of output file
-    label = final_xmp_dict.get("Xmp.xmp.Label")
-    if label == "None" and update_file:
-        logger.error(f"Final_XMP - Problematic Label: None")
 
-    # check for all crop fields and alert. try one more time to fix
-    required_fields = check_crop_fields(xmp_dict=final_xmp_dict)
+def _process_rows_in_worker(rows: list):
+    return process_rows(
+        rows,
+        et=_worker_state["et"],
+        cnx=_worker_state["cnx"],
+        state=_worker_state.get("state"),
+    )
 
-    if len(required_fields) > 0:
-        logger.warning(f"Final_XMP - Missing required fields: {required_fields}")
 
-        # create dictionary for missing fields
-        crop_fix = crop_fields_from_missing(required_fields)
+def indexed_batches(index_cnx, missing: list | None = None):
+    """Yield lists of (index, row, RowFiles) from a single folder.
+    Rows sharing a sidecar are never split, so every list writes distinct sidecars.
+    Each folder is listed once and its rows joined with the listing. Rows whose
+    image is not found are added to missing, if given, with whether their folder
+    exists."""
+    rows = lightroom_catalog.iter_rows(
+        index_cnx,
+        root_folder_name=RootFolderName,
+        path_prefix=path_prefix,
+        captured_after=captured_after,
+        captured_before=captured_before,
+        file_types=file_types,
+        batch_size=batch_size,
+    )
+    i = 0
+    batch = []
+    folder_path = folder = None
+    for group in lightroom_catalog.group_by_sidecar(rows):
+        path = pathlib.Path(root_path, group[0].path_from_root)
+        if path != folder_path:
+            with metrics.stage("list folder"):
+                folder = library_scanner.scan_folder(path)
+            folder_path = path
+        group_files = [resolve_row_files(row, folder) for row in group]
+        if missing is not None:
+            folder_exists = bool(folder.folders)
+            missing.extend(
+                (row, folder_exists)
+                for row, files in zip(group, group_files)
+                if not files.image
+            )
+
+        if batch and (
+            batch[0][1].path_from_root != group[0].path_from_root
+            or len(batch) + len(group) > folder_batch_size
+        ):
+            yield batch
+            batch = []
+        batch.extend(
+            (i + n, row, files)
+            for n, (row, files) in enumerate(zip(group, group_files))
+        )
+        i += len(group)
+    if batch:
+        yield batch
+
+
+def write_missing_report(path: pathlib.Path, missing: list) -> None:
+    """Write the catalog rows whose image was not found as csv."""
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        report = csv.writer(f)
+        report.writerow(["image_id", "name", "path", "folder_exists"])
+        for row, folder_exists in missing:
+            report.writerow(
+                [row.image_id, row.name, row_paths(row)[0].as_posix(), folder_exists]
+            )
 
-        # disable update in No-Op Mode
-        if update_file and len(crop_fix) > 0:
-            final_xmp.modify_xmp(crop_fix)
-            logger.warning(f"Final_XMP - Fixed: {crop_fix.keys()}")
 
-    final_xmp.close()
+def run_sequential(index_cnx, cnx, state, missing=None):
+    with ExifTool() as et:
+        for batch in indexed_batches(index_cnx, missing):
+            yield process_rows(batch, et=et, cnx=cnx, state=state)
+
+
+def run_parallel(index_cnx, use_state: bool, missing=None):
+    """Distribute batches of rows over a process pool and yield their results.
+    A sidecar group is never split, so two workers never write the same BaseName.xmp.
+    The number of queued batches is bounded to keep memory flat."""
+    max_pending = workers * 4
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(use_state,)
+    ) as executor:
+        pending = set()
+        for batch in indexed_batches(index_cnx, missing):
+            if len(pending) >= max_pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                yield from (future.result() for future in done)
+            pending.add(executor.submit(_process_rows_in_worker, batch))
 
-    # clean up temp folder:
-    tempdir.cleanup()
+        for future in concurrent.futures.as_completed(pending):
+            yield future.result()
 
 
 def main():
-    with ExifTool() as et:
-        for i, data_series in df.iterrows():
+    cnx = lightroom_catalog.connect(catalog)
+    index_cnx = lightroom_catalog.open_index(catalog, index_file)
+    # No-Op runs do not write sidecars, so they are not recorded
+    store = migration_state.StateStore(state_file) if update_file else None
+    use_state = store is not None and resume
+
+    failures = 0
+    skipped = 0
+    # metrics of all batches, including the ones of worker processes
+    run_metrics = instrumentation.Metrics(enabled=timing)
+    missing = []
+    try:
+        if workers > 1:
+            results = run_parallel(index_cnx, use_state=use_state, missing=missing)
+        else:
+            state = store if use_state else None
+            results = run_sequential(index_cnx, cnx, state=state, missing=missing)
+
+        for states, batch_skipped, batch_metrics in results:
+            skipped += batch_skipped
+            run_metrics.merge(batch_metrics)
+            failures += sum(state.outcome == "failed" for state in states)
+            if store is not None:
+                store.record(states)
+        # the folder listings of the main process
+        run_metrics.merge(metrics.snapshot(reset=True))
+        if store is not None:
+            outcomes = store.counts()
             logger.info(
-                f"Index: {i}, name: {data_series.loc['PathFromRoot']}{data_series.loc['BaseName']}.{data_series.loc['FileType']}"
+                "Recorded rows: "
+                + ", ".join(f"{n} {outcome}" for outcome, n in sorted(outcomes.items()))
             )
-            try:
-                process_file(data_series=data_series, et=et, update_file=update_file)
-            except Exception as e:
-                logger.error(
-                    f"Failed to process: {data_series.loc['PathFromRoot']}{data_series.loc['BaseName']}.{data_series.loc['FileType']}"
-                )
-                logger.error(f"Exception: {e}")
+    finally:
+        metrics.close()
+        cnx.close()
+        index_cnx.close()
+        if store is not None:
+            store.close()
+
+    if skipped > 0:
+        logger.info(f"Skipped {skipped} unchanged rows")
+    if missing:
+        logger.warning(f"{len(missing)} catalog rows have no image file")
+    if missing_report is not None:
+        write_missing_report(missing_report, missing)
+    run_metrics.log_summary(logger)
+    if failures > 0:
+        logger.error(f"Completed with {failures} errors")
 
 
 if __name__ == "__main__":
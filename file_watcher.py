@@ -0,0 +1,136 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import pathlib
+import select
+import struct
+import time
+from typing import NamedTuple
+
+
+# File system events of the library folders through Linux inotify, called with
+# ctypes. Every folder is watched on its own (inotify is not recursive), and new
+# folders are added as they appear. A file is reported once it was closed or
+# moved into place and then left alone for a settle time, so files still being
+# written by a scanner or a copy are not picked up half done.
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+watch_mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+
+# struct inotify_event without the name
+event_header = struct.Struct("iIII")
+
+_libc = None
+
+
+def libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(
+            ctypes.util.find_library("c") or "libc.so.6", use_errno=True
+        )
+    return _libc
+
+
+class Event(NamedTuple):
+    path: pathlib.Path | None  # None if the kernel queue overflowed
+    mask: int
+
+
+class Inotify:
+    """An inotify instance with a watch per folder."""
+
+    def __init__(self):
+        self.fd = libc().inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        # watch descriptor: folder
+        self.folders = {}
+
+    def add_watch(self, folder: pathlib.Path, mask: int = watch_mask) -> None:
+        wd = libc().inotify_add_watch(self.fd, os.fsencode(folder), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            message = os.strerror(error)
+            if error == errno.ENOSPC:
+                message += ", raise fs.inotify.max_user_watches"
+            raise OSError(error, message, str(folder))
+        self.folders[wd] = pathlib.Path(folder)
+
+    def read(self, timeout: float | None) -> list[Event]:
+        """The events available within timeout seconds, empty if there are none."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = event_header.unpack_from(data, pos)
+            name = data[pos + event_header.size : pos + event_header.size + length]
+            pos += event_header.size + length
+            if mask & IN_Q_OVERFLOW:
+                events.append(Event(None, mask))
+            elif mask & IN_IGNORED:
+                # the folder was removed or unmounted
+                self.folders.pop(wd, None)
+            elif wd in self.folders:
+                name = os.fsdecode(name.rstrip(b"\x00"))
+                folder = self.folders[wd]
+                events.append(Event(folder / name if name else folder, mask))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class SettleTracker:
+    """Files that changed, reported as ready once they were closed or moved into
+    place and had no further event for settle seconds."""
+
+    def __init__(self, settle: float = 2.0):
+        self.settle = settle
+        # path: (time of the last event, closed since the last write)
+        self.pending = {}
+
+    def update(self, path: pathlib.Path, mask: int) -> None:
+        _, closed = self.pending.get(path, (None, False))
+        if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            closed = True
+        elif mask & IN_MODIFY:
+            closed = False
+        self.pending[path] = (time.monotonic(), closed)
+
+    def ready(self) -> list[pathlib.Path]:
+        """Remove and return the files that settled."""
+        now = time.monotonic()
+        settled = [
+            path
+            for path, (last, closed) in self.pending.items()
+            if closed and now - last >= self.settle
+        ]
+        for path in settled:
+            del self.pending[path]
+        return settled
+
+    def timeout(self) -> float | None:
+        """Seconds until the next closed file settles, None if there is none.
+        Files still open for writing wait for their next event."""
+        closed = [last for last, closed in self.pending.values() if closed]
+        if not closed:
+            return None
+        return max(0.0, min(closed) + self.settle - time.monotonic())
@@ -2,23 +2,30 @@
 # https://github.com/z80z80z80/autocrop
 # https://github.com/smc8050/Dias_Autocrop
 import importlib.resources
+import io
+import os
 import pathlib
-import tempfile
-from shutil import copy2
 import concurrent.futures
 
 import cv2
 import logzero
+import numpy as np
 import pyexiv2
 import rawpy
 import yaml
 from exiftool import ExifTool
 from logzero import logger
 from PIL import Image
-from PIL import ImageChops
-from PIL import ImageFilter
 
+import crop_cache
+import crop_detection
+import instrumentation
+import library_scanner
+import scheduling
+import sidecar_writer
+import tiff_strips
 import xmp_editing_utils
+import xmp_packet
 
 
 logzero.logfile("crop_rotating_logfile.log", maxBytes=1e8, backupCount=3)
@@ -50,10 +57,13 @@ else:
     crop_addition = 5
 
 if config_data.get("threshold") is not None:
-    threshold = config_data["threshold"]  # default 45
+    threshold = config_data["threshold"]  # default 45, "auto" to search
 else:
     threshold = 50
 
+# thresholds tried with threshold: "auto", in addition to the Otsu threshold
+auto_thresholds = config_data.get("auto_thresholds", list(range(20, 101, 10)))
+
 if config_data.get("blur_radius") is not None:
     blur_radius = config_data["blur_radius"]  # default 4, if -1 auto
 else:
@@ -64,6 +74,19 @@ if config_data.get("max_workers") is not None:
 else:
     max_workers = 1
 
+# threads reading images and writing sidecars, max_workers for older configs
+io_workers = config_data.get("io_workers", max_workers)
+# processes decoding images and detecting the crop
+cpu_workers = config_data.get("cpu_workers", os.cpu_count() or 1)
+# let the number of files in flight follow the cpu use and I/O wait
+adaptive_window = config_data.get("adaptive_window", False)
+# files read but not yet analysed, the upper bound in adaptive mode
+max_loaded = config_data.get("max_loaded", (4 if adaptive_window else 2) * cpu_workers)
+# optional bound on their estimated memory use (file content and decoded image)
+max_loaded_mb = config_data.get("max_loaded_mb")
+# start the largest files of each folder first so they do not finish last
+largest_first = config_data.get("largest_first", True)
+
 if config_data.get("raw_crop") is not None:
     raw_crop = config_data["raw_crop"]
 else:
@@ -71,12 +94,47 @@ else:
 
 mirror_config = config_data.get("mirror", False)  # default to not mirroring
 
+# "full", "preview" (embedded jpeg) or "bayer" (sensor data without demosaicing)
+raw_decode = config_data.get("raw_decode", "full")
+
+# time the stages of every file, optionally writing one json line per file
+metrics = instrumentation.Metrics(
+    enabled=config_data.get("timing", False),
+    trace_file=config_data.get("trace_file"),
+)
+metrics.watch(logger)
+
 if debug:
     debug_path = pathlib.Path(root_path, "debug")
     debug_path.mkdir(parents=True, exist_ok=True)
 else:
     debug_path = None
 
+# uncompressed TIFF files from this size on are analysed in bands of rows
+# instead of being read and decoded whole, None to never do so
+stream_tiff_mb = config_data.get("stream_tiff_mb", 100)
+
+# folder listings of earlier runs, folders are listed again when they change
+library_index = config_data.get("library_index", "library_index.json")
+if library_index is not None:
+    library_index = importlib.resources.files("untracked").joinpath(library_index)
+# threads listing folders
+scan_workers = config_data.get("scan_workers", 8)
+
+# crops of earlier runs, reused while the file and detection parameters are the same
+use_crop_cache = config_data.get("crop_cache", True)
+crop_cache_file = importlib.resources.files("untracked").joinpath(
+    config_data.get("crop_cache_file", "crop_cache.sqlite")
+)
+crop_cache_max_entries = config_data.get("crop_cache_max_entries", 200000)
+# drop all cached crops before the run
+clear_crop_cache = config_data.get("clear_crop_cache", False)
+
+# decoded image size relative to the file size, for the memory estimate
+decode_ratio = {".JPG": 10, ".JPEG": 10, ".WEBP": 10, ".PNG": 4, ".TIF": 2, ".TIFF": 2}
+raw_decode_ratio = 3
+default_decode_ratio = 4
+
 # create a mapping from "normal" rotation to horizontally mirrored counterpart
 mirror_map = {
     "1": "2",
@@ -105,20 +163,102 @@ def shrink_image(im, max_size=800):
         return im.resize((small_w, small_h))
 
 
-def process_file(
-    filepath: pathlib.Path,
-    debug_path: pathlib.Path,
-    debug: bool,
-    crop_addition: int,
-    blur_radius: int,
-    mirror: bool,
-):
+def half_size_shape(raw) -> tuple[int, int]:
+    """Height and width of the image postprocess(half_size=True) returns."""
+    height = (raw.sizes.height + 1) // 2
+    width = (raw.sizes.width + 1) // 2
+    if raw.sizes.flip in (5, 6):
+        return width, height
+    return height, width
+
+
+def apply_flip(image: np.ndarray, flip: int) -> np.ndarray:
+    """Rotate an image in sensor orientation the way libraw does when processing."""
+    if flip == 3:
+        return np.rot90(image, 2)
+    if flip == 5:
+        return np.rot90(image, 1)
+    if flip == 6:
+        return np.rot90(image, -1)
+    return image
+
+
+def raw_preview(raw) -> np.ndarray | None:
+    """The embedded preview scaled to the half size frame, None if there is no
+    usable preview."""
+    try:
+        thumb = raw.extract_thumb()
+    except (rawpy.LibRawNoThumbnailError, rawpy.LibRawUnsupportedThumbnailError):
+        return None
+    if thumb.format == rawpy.ThumbFormat.JPEG:
+        preview = cv2.imdecode(
+            np.frombuffer(thumb.data, dtype=np.uint8),
+            cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION,
+        )
+        if preview is None:
+            return None
+        preview = cv2.cvtColor(preview, cv2.COLOR_BGR2RGB)
+    else:
+        preview = thumb.data
+
+    # libraw returns the preview in sensor orientation, also when it is upside down
+    preview = apply_flip(preview, raw.sizes.flip)
+    height, width = half_size_shape(raw)
+    # a preview with another aspect ratio does not cover the same area
+    if abs(preview.shape[1] / preview.shape[0] - width / height) > 0.02:
+        return None
+    return cv2.resize(
+        np.ascontiguousarray(preview), (width, height), interpolation=cv2.INTER_LINEAR
+    )
+
+
+def raw_bayer(raw) -> np.ndarray | None:
+    """Average every 2x2 block of the sensor data, which gives a gray image of the
+    half size frame without demosaicing. Brightness and gamma roughly follow the
+    libraw defaults so the same threshold applies. None if the sensor data is not a
+    2x2 color mosaic (linear DNG, X-Trans, monochrome sensors)."""
+    visible = raw.raw_image_visible
+    pattern = raw.raw_pattern
+    if visible.ndim != 2 or pattern is None or pattern.shape != (2, 2):
+        return None
+    rows, cols = visible.shape[0] // 2 * 2, visible.shape[1] // 2 * 2
+    blocks = visible[:rows, :cols].reshape(rows // 2, 2, cols // 2, 2)
+    averaged = blocks.sum(axis=(1, 3), dtype=np.uint32).astype(np.float32) / 4
+
+    black = float(np.mean(raw.black_level_per_channel))
+    linear = np.clip((averaged - black) / (raw.white_level - black), 0, 1)
+    # like libraw's auto brightness, 1% of the pixels are saturated
+    bright = float(np.percentile(linear[::4, ::4], 99))
+    if bright > 0:
+        linear = np.clip(linear / bright, 0, 1)
+    gray = (255 * linear ** (1 / 2.222)).astype(np.uint8)
+
+    gray = apply_flip(gray, raw.sizes.flip)
+    height, width = half_size_shape(raw)
+    gray = np.pad(
+        gray,
+        ((0, max(0, height - gray.shape[0])), (0, max(0, width - gray.shape[1]))),
+        mode="edge",
+    )[:height, :width]
+    return cv2.cvtColor(np.ascontiguousarray(gray), cv2.COLOR_GRAY2RGB)
+
+
+def load_image(filepath: pathlib.Path, data: bytes, raw_decode: str = "full"):
+    """Decode the content of an image file (raw files at half size) to an RGB array.
+    raw_decode selects how raw files are decoded: "full" demosaics, "preview" uses
+    the embedded preview and "bayer" averages the sensor data, all giving the same
+    frame. Returns the image and whether it is a raw file, None if not supported or
+    if there is no preview."""
     suffix = filepath.suffix.upper()
     rawfile = False
     if suffix in xmp_editing_utils.raw_files:
-        if suffix == ".CR3":
-            with rawpy.imread(filepath.as_posix()) as raw:
-                imcv2 = raw.postprocess(
+        with rawpy.imread(io.BytesIO(data)) as raw:
+            if raw_decode == "preview":
+                img = raw_preview(raw)
+            elif raw_decode == "bayer":
+                img = raw_bayer(raw)
+            elif suffix == ".CR3":
+                img = raw.postprocess(
                     output_color=rawpy.ColorSpace.raw,
                     gamma=(1.1, 3),
                     use_camera_wb=True,
@@ -128,41 +268,168 @@ def process_file(
                     # no_auto_bright=True,
                     demosaic_algorithm=rawpy.DemosaicAlgorithm.LINEAR,
                 )
-        else:
-            with rawpy.imread(filepath.as_posix()) as raw:
-                imcv2 = raw.postprocess(half_size=True)
+            else:
+                img = raw.postprocess(half_size=True)
+        if img is None:
+            return None
         rawfile = True
-        img = Image.fromarray(imcv2)
         if raw_crop:
             # convert to half size:
             raw_crop_half = tuple([x / 2 for x in raw_crop])
-            img = img.crop(raw_crop_half)
-        # convert from cv2 image file to pil image file
+            img = crop_detection.crop_array(img, raw_crop_half)
     elif filepath.suffix.upper() in xmp_editing_utils.other_files:
         # logger.debug("Processing as regular file. Extension not in raw_files list.")
-        imcv2 = cv2.imread(filepath.as_posix())
-        img = Image.fromarray(
-            cv2.cvtColor(imcv2, cv2.COLOR_BGR2RGB)
-        )  # convert from cv2 image file to pil image file
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=img)
     else:
-        logger.error("Filetype not supported")
-        return
+        return None
+
+    return img, rawfile
+
+
+def streams_tiff(filepath: pathlib.Path, size: int) -> bool:
+    """Whether a file is large enough to be analysed in bands, if it is a TIFF with
+    a layout that allows it."""
+    return (
+        stream_tiff_mb is not None
+        and filepath.suffix.upper() in (".TIF", ".TIFF")
+        and size >= stream_tiff_mb * 2**20
+    )
+
+
+def read_image(filepath: pathlib.Path) -> bytes | None:
+    """Read the content of an image file, the I/O part of the crop detection.
+    Returns None for TIFF files that the worker reads in bands itself."""
+    if streams_tiff(filepath, filepath.stat().st_size):
+        if tiff_strips.read_layout(filepath) is not None:
+            return None
+    with metrics.stage("read"):
+        data = filepath.read_bytes()
+    metrics.count("bytes read", len(data))
+    return data
 
-    original_img = img
-    w, h = original_img.size
 
+def image_blur_radius(blur_radius: int, w: int, h: int) -> int:
     if blur_radius == -1:
         blur_radius = min([w, h]) // 400  # number picked based on few tests
         blur_radius = min(
             [blur_radius, 12]
         )  # apply a ceiling so it doesn't get too high
-    blurred_img = img.filter(
-        ImageFilter.GaussianBlur(radius=blur_radius)
-    )  # to remove outlier pixels
-    binary_img = xmp_editing_utils.convert_to_binary(blurred_img, threshold, 255)
-    bg = Image.new(binary_img.mode, binary_img.size)
-    diff = ImageChops.difference(binary_img, bg)
-    bbox = diff.getbbox()
+    return blur_radius
+
+
+def find_crop(img: np.ndarray, blur_radius: int):
+    """Return the bounding box of the non-black area of an image, the mean color
+    outside of it (None if there is no crop) and the threshold used."""
+    h, w = img.shape[:2]
+    blur_radius = image_blur_radius(blur_radius, w, h)
+    analysis = crop_detection.CropAnalysis(img, blur_radius)
+    if threshold == "auto":
+        with metrics.stage("threshold search"):
+            return analysis.best_crop(auto_thresholds)
+
+    with metrics.stage("bbox"):
+        bbox = analysis.bbox(threshold)
+
+    color_control = None
+    if bbox and bbox != (0, 0, w, h):
+        with metrics.stage("control"):
+            color_control = analysis.outside_mean(bbox)
+    return bbox, color_control, threshold
+
+
+def scan_tiff(filepath: pathlib.Path, layout: dict, blur_radius: int, debug: bool):
+    """find_crop for a TIFF read in bands. Also returns the scan, which holds the
+    image size and a reduced copy of the image for debugging."""
+    w, h = layout["width"], layout["height"]
+    scan = tiff_strips.TiffCropScan(
+        filepath,
+        layout,
+        image_blur_radius(blur_radius, w, h),
+        preview_size=800 if debug else None,
+    )
+    if threshold == "auto":
+        bbox, color_control, crop_threshold = crop_detection.choose_crop(
+            {*auto_thresholds, crop_detection.otsu_threshold(scan.histogram)},
+            scan.bbox,
+            scan.outside_mean,
+            (0, 0, w, h),
+        )
+        return bbox, color_control, crop_threshold, scan
+
+    bbox = scan.bbox(threshold)
+    color_control = None
+    if bbox and bbox != (0, 0, w, h):
+        color_control = scan.outside_mean(bbox)
+    return bbox, color_control, threshold, scan
+
+
+def detect_crop(
+    filepath: pathlib.Path,
+    data: bytes,
+    debug_path: pathlib.Path,
+    debug: bool,
+    crop_addition: int,
+    blur_radius: int,
+    details: dict | None = None,
+) -> dict | None:
+    """Detect the crop of an image from the content of its file, or from the file
+    itself if data is None (large TIFF files).
+    Returns the crop and image size as xmp fields, None if the file type is not
+    supported. details, if given, receives the bounding box, control value,
+    threshold and image size."""
+    layout = None
+    if data is None:
+        layout = tiff_strips.read_layout(filepath)
+        if layout is None:
+            data = read_image(filepath)
+
+    # the fast raw decodes are only trusted if they give a clear crop
+    modes = ["full"]
+    if filepath.suffix.upper() in xmp_editing_utils.raw_files and raw_decode != "full":
+        modes = [raw_decode, "full"]
+    if layout is not None:
+        modes = []
+        with metrics.stage("tiff scan"):
+            bbox, color_control, crop_threshold, scan = scan_tiff(
+                filepath, layout, blur_radius, debug
+            )
+        img, rawfile = scan.preview, False
+        w, h = scan.width, scan.height
+
+    for mode in modes:
+        try:
+            with metrics.stage("decode" if mode == "full" else f"decode {mode}"):
+                loaded = load_image(filepath, data, raw_decode=mode)
+            if loaded is not None:
+                img, rawfile = loaded
+                h, w = img.shape[:2]
+                bbox, color_control, crop_threshold = find_crop(img, blur_radius)
+        except Exception as e:
+            if mode == "full":
+                raise
+            logger.debug(
+                f"{mode} decode of {filepath.name} failed, decoding fully: {e}"
+            )
+            metrics.count("raw decode fallbacks")
+            continue
+        if loaded is None:
+            if mode != "full":
+                logger.debug(f"No {mode} image for {filepath.name}, decoding fully")
+                metrics.count("raw decode fallbacks")
+                continue
+            logger.error("Filetype not supported")
+            return None
+
+        if mode == "full" or (
+            bbox and bbox != (0, 0, w, h) and color_control <= crop_threshold / 2
+        ):
+            break
+        logger.debug(
+            f"{mode} decode not conclusive for {filepath.name}, decoding fully"
+        )
+        metrics.count("raw decode fallbacks")
+
     # left, top, right, bottom
     # 0%, 0%, 100%, 100%
 
@@ -171,8 +438,9 @@ def process_file(
     if bbox == (0, 0, w, h):
         logger.warning(f"No cropping detected for {filepath.as_posix()}")
     elif bbox:
-        color_control = xmp_editing_utils.get_control_value(original_img, bbox)
-        if color_control > threshold / 2:
+        if threshold == "auto":
+            logger.debug(f"{filepath.name} threshold: {crop_threshold}")
+        if color_control > crop_threshold / 2:
             logger.warning(f"Crop bounds may be problematic for {filepath.as_posix()}")
         # adjust based on crop_addition
 
@@ -209,12 +477,17 @@ def process_file(
             logger.debug(
                 f"{filepath.name} bbox: left {bbox[0]} top  {bbox[1]} right  {bbox[2]} bottom  {bbox[3]}, w: {w} h: {h}"
             )
-            im = xmp_editing_utils.draw_cropline(original_img, new_box)
+            with metrics.stage("debug image"):
+                # the image of a TIFF read in bands is reduced already
+                scale = img.shape[1] / w
+                im = xmp_editing_utils.draw_cropline(
+                    Image.fromarray(img), [x * scale for x in new_box]
+                )
 
-            im = shrink_image(im, max_size=800)
+                im = shrink_image(im, max_size=800)
 
-            debug_filename = pathlib.Path(debug_path, filepath.name + ".jpg")
-            im.save(debug_filename, quality=100, subsampling=0)
+                debug_filename = pathlib.Path(debug_path, filepath.name + ".jpg")
+                im.save(debug_filename, quality=100, subsampling=0)
 
     else:
         raise RuntimeError("Could not find a bounding box for crop")
@@ -229,46 +502,68 @@ def process_file(
     if filepath.suffix.upper() == ".DNG":
         xmp_param["Xmp.crs.Exposure2012"] = -0.01
 
-    tempdir = tempfile.TemporaryDirectory(suffix=filepath.stem, dir="/dev/shm")
-    temp_dir_path = pathlib.Path(tempdir.name)
-    # logger.debug(f"Using temp directory {temp_dir_path} for {filepath.name}")
-
-    temp_xmp_path = pathlib.Path(temp_dir_path, "orig.xmp")
-    filepath_lr_xmp = filepath.with_suffix(".xmp")
-
-    # Create temp files from extracted data if the lr xmp doesn't already exist
-    with ExifTool() as et:
-        if filepath_lr_xmp.is_file():
-            xmp_editing_utils.copy_xmp_temp(filepath_lr_xmp, temp_xmp_path, et=et)
-        else:
-            xmp_editing_utils.copy_xmp_temp(filepath, temp_xmp_path, et=et)
-
-    # get orientation and write appropriate xmp
-    with pyexiv2.Image(temp_xmp_path.as_posix()) as img:
-        orig_data = img.read_xmp()
-
-        # Override mirror parameter with "no_mirror" tag
-        if "no_mirror" in orig_data.get("Xmp.dc.subject", list()):
-            mirror = False
-
-        # check if orientation tag exists. if not, set to 1
-        xmp_param["Xmp.tiff.Orientation"] = orig_data.get("Xmp.tiff.Orientation", "1")
+    if details is not None:
+        details.update(
+            bbox=list(bbox),
+            control=color_control,
+            threshold=crop_threshold,
+            width=w,
+            height=h,
+        )
+    return xmp_param
 
-        mirrored = xmp_param["Xmp.tiff.Orientation"] in ["2", "5", "7", "4"]
-        # update orientation if mirror parameter is set and not already mirrored
-        if mirror and not mirrored:
-            xmp_param["Xmp.tiff.Orientation"] = mirror_map[
-                xmp_param["Xmp.tiff.Orientation"]
-            ]
-        elif not mirror and mirrored:
-            xmp_param["Xmp.tiff.Orientation"] = mirror_map_invert[
-                xmp_param["Xmp.tiff.Orientation"]
-            ]
-
-        img.modify_xmp(xmp_param)
-        img.read_xmp()
 
-    copy2(temp_xmp_path, filepath_lr_xmp)
+def write_crop_xmp(
+    filepath: pathlib.Path,
+    xmp_param: dict,
+    mirror: bool,
+    source_xmp: str | None = None,
+    writer: sidecar_writer.SidecarWriter | None = None,
+    exiftool_pool: xmp_editing_utils.ExifToolPool | None = None,
+    sidecars: dict | None = None,
+):
+    """Write the detected crop with the appropriate orientation to the file.xmp
+    sidecar and verify it.
+    source_xmp is the already extracted packet of the sidecar (or the image if
+    there is no sidecar yet). It is read with exiftool if not provided, using a
+    process of exiftool_pool if given.
+    sidecars maps files to their listed sidecar, see sidecar_path.
+    The sidecar is left untouched if its content would not change."""
+    if writer is None:
+        writer = sidecar_writer.SidecarWriter()
+    xmp_param = dict(xmp_param)
+    filepath_lr_xmp = sidecar_path(filepath, sidecars)
+
+    # start from the extracted data if the lr xmp doesn't already exist
+    if source_xmp is None:
+        with metrics.stage("exiftool"), checkout_exiftool(exiftool_pool) as et:
+            source_xmp = xmp_editing_utils.read_xmp_packet(
+                xmp_source_path(filepath, sidecars), et=et
+            )
+    orig_data = xmp_packet.parse_packet(source_xmp or "")
+
+    # Override mirror parameter with "no_mirror" tag
+    if "no_mirror" in orig_data.get("Xmp.dc.subject", list()):
+        mirror = False
+
+    # check if orientation tag exists. if not, set to 1
+    xmp_param["Xmp.tiff.Orientation"] = str(orig_data.get("Xmp.tiff.Orientation", "1"))
+
+    mirrored = xmp_param["Xmp.tiff.Orientation"] in ["2", "5", "7", "4"]
+    # update orientation if mirror parameter is set and not already mirrored
+    if mirror and not mirrored:
+        xmp_param["Xmp.tiff.Orientation"] = mirror_map[
+            xmp_param["Xmp.tiff.Orientation"]
+        ]
+    elif not mirror and mirrored:
+        xmp_param["Xmp.tiff.Orientation"] = mirror_map_invert[
+            xmp_param["Xmp.tiff.Orientation"]
+        ]
+
+    # write the updated xmp, the sidecar is left alone if nothing changed
+    orig_data.update(xmp_param)
+    with metrics.stage("write"):
+        writer.write(filepath_lr_xmp, orig_data)
 
     # check new xmp
     error = 0
@@ -276,7 +571,9 @@ def process_file(
         logger.error(f"XMP file does not exist: {filepath_lr_xmp}")
         error = 1
     else:
-        with pyexiv2.Image(filepath_lr_xmp.as_posix()) as new_lr_xmp:
+        with metrics.stage("verify"), pyexiv2.Image(
+            filepath_lr_xmp.as_posix()
+        ) as new_lr_xmp:
             xmp_data = new_lr_xmp.read_xmp()
             orientation = xmp_data.get("Xmp.tiff.Orientation", "0")
             mirrored = orientation in ["2", "5", "7", "4"]
@@ -299,45 +596,280 @@ def process_file(
                     f"XMP expected {xmp_param['Xmp.tiff.Orientation']} but got {orientation} : {filepath_lr_xmp}"
                 )
 
-    tempdir.cleanup()
 
+def sidecar_path(filepath: pathlib.Path, sidecars: dict | None = None) -> pathlib.Path:
+    """The file.xmp sidecar of a file. sidecars maps files to the sidecar found next
+    to them in the library listing regardless of case, or None if there is none."""
+    if sidecars is not None and sidecars.get(filepath) is not None:
+        return sidecars[filepath]
+    return filepath.with_suffix(".xmp")
+
+
+def xmp_source_path(
+    filepath: pathlib.Path, sidecars: dict | None = None
+) -> pathlib.Path:
+    """The xmp to start from: the existing file.xmp sidecar, else the image itself.
+    Without sidecars the file system is checked."""
+    if sidecars is not None and filepath in sidecars:
+        return sidecars[filepath] or filepath
+    filepath_lr_xmp = filepath.with_suffix(".xmp")
+    if filepath_lr_xmp.is_file():
+        return filepath_lr_xmp
+    return filepath
+
+
+def checkout_exiftool(exiftool_pool: xmp_editing_utils.ExifToolPool | None):
+    """A process of the pool, or a new ExifTool if there is no pool."""
+    if exiftool_pool is None:
+        return ExifTool()
+    return exiftool_pool.checkout()
+
+
+def read_source_xmp(
+    files: list[pathlib.Path],
+    exiftool_pool: xmp_editing_utils.ExifToolPool,
+    sidecars: dict | None = None,
+) -> dict:
+    """Extract the starting xmp of each file with one exiftool request per directory."""
+    sources = {filepath: xmp_source_path(filepath, sidecars) for filepath in files}
+    try:
+        with exiftool_pool.checkout() as et:
+            packets = xmp_editing_utils.read_xmp_packets(list(sources.values()), et=et)
+    except Exception as e:
+        # process_file falls back to reading the files one at a time
+        logger.warning(f"Batch XMP extraction failed: {e}")
+        return {}
+    return {filepath: packets.get(source) for filepath, source in sources.items()}
+
+
+def _init_cpu_worker():
+    # drop what a forked worker inherited, its metrics are returned with each result
+    metrics.snapshot(reset=True)
+
+
+def detect_crop_in_worker(filepath: pathlib.Path, data: bytes, **kwargs):
+    """detect_crop in a worker process. Returns the crop, its details and the
+    metrics collected since the last call."""
+    details = {}
+    with metrics.item(filepath.as_posix(), kind="detect"):
+        xmp_param = detect_crop(filepath, data, details=details, **kwargs)
+    return xmp_param, details, metrics.snapshot(reset=True)
+
+
+def write_crop_xmp_traced(filepath: pathlib.Path, *args, **kwargs):
+    """write_crop_xmp, with its stage times collected as one trace record."""
+    with metrics.item(filepath.as_posix(), kind="write"):
+        return write_crop_xmp(filepath, *args, **kwargs)
 
-def main():
-    p = root_path.rglob("*")
-    files = [x for x in p if x.is_file()]
 
+def estimated_memory(filepath: pathlib.Path, size: int) -> int:
+    """Rough memory use of a file in flight: its content plus the decoded image."""
+    suffix = filepath.suffix.upper()
+    if streams_tiff(filepath, size):
+        # read in bands by the worker
+        return 0
+    if suffix in xmp_editing_utils.raw_files:
+        return size * (1 + raw_decode_ratio)
+    return size * (1 + decode_ratio.get(suffix, default_decode_ratio))
+
+
+def iter_sources(
+    files: list,
+    by_directory: dict,
+    exiftool_pool: xmp_editing_utils.ExifToolPool,
+    sidecars: dict | None = None,
+):
+    """Yield (file, starting xmp) in the order of files. The xmp of a folder is read
+    when the first of its files is reached and dropped after the last one."""
+    remaining = {directory: len(f) for directory, f in by_directory.items()}
+    source_xmp = {}
+    for filepath in files:
+        directory = filepath.parent
+        if directory not in source_xmp:
+            with metrics.stage("exiftool"):
+                source_xmp[directory] = read_source_xmp(
+                    by_directory[directory], exiftool_pool, sidecars
+                )
+        yield filepath, source_xmp[directory].get(filepath)
+        remaining[directory] -= 1
+        if not remaining[directory]:
+            del source_xmp[directory]
+
+
+def run_pipeline(
+    by_directory: dict,
+    writer: sidecar_writer.SidecarWriter,
+    cache: crop_cache.CropCache | None = None,
+    sidecars: dict | None = None,
+):
+    """Run the crop detection of all files in three stages: reading the file
+    (io_workers threads), decoding and detecting the crop (cpu_workers processes)
+    and writing the sidecar (io_workers threads). sidecars maps the files to their
+    file.xmp sidecar from the library listing, None if they have none.
+    The files read but not yet analysed are bounded in number and optionally in
+    estimated memory to limit memory use. Files with a crop in the cache go
+    straight to writing, except in debug mode which needs the debug images."""
+    files = [filepath for f in by_directory.values() for filepath in f]
+    window = scheduling.SubmissionWindow(
+        max_loaded,
+        max_bytes=None if max_loaded_mb is None else max_loaded_mb * 2**20,
+        adaptive=adaptive_window,
+        min_items=cpu_workers,
+        cpu_share=min(1.0, cpu_workers / (os.cpu_count() or 1)),
+    )
+    in_flight = {}
+
+    # one exiftool process per io thread, plus one for reading ahead
+    with xmp_editing_utils.ExifToolPool(
+        io_workers + 1
+    ) as exiftool_pool, concurrent.futures.ThreadPoolExecutor(
+        max_workers=io_workers
+    ) as io_executor, concurrent.futures.ProcessPoolExecutor(
+        max_workers=cpu_workers, initializer=_init_cpu_worker
+    ) as cpu_executor:
+        sizes = scheduling.file_sizes(files, io_executor)
+        if largest_first:
+            # folder by folder, so only the starting xmp of the folders in flight
+            # is held in memory
+            files = [
+                filepath
+                for f in by_directory.values()
+                for filepath in scheduling.largest_first(f, sizes)
+            ]
+        sources = iter_sources(files, by_directory, exiftool_pool, sidecars)
+        pending = {}
+
+        def submit_write(filepath, xmp_param, source_xmp):
+            future = io_executor.submit(
+                write_crop_xmp_traced,
+                filepath,
+                xmp_param,
+                mirror=mirror_config,
+                source_xmp=source_xmp,
+                writer=writer,
+                exiftool_pool=exiftool_pool,
+                sidecars=sidecars,
+            )
+            pending[future] = ("write", filepath, source_xmp)
+
+        item = next(sources, None)
+        while True:
+            window.adjust()
+            while item is not None:
+                filepath, source_xmp = item
+                cached = None
+                if cache is not None and not debug:
+                    cached = cache.get(filepath)
+                if cached is not None:
+                    submit_write(filepath, cached, source_xmp)
+                    item = next(sources, None)
+                    continue
+                memory = estimated_memory(filepath, sizes[filepath])
+                if not window.admits(memory):
+                    break
+                future = io_executor.submit(read_image, filepath)
+                pending[future] = ("read", filepath, source_xmp)
+                window.add(memory)
+                in_flight[filepath] = memory
+                item = next(sources, None)
+            if not pending:
+                break
+
+            done, _ = concurrent.futures.wait(
+                pending,
+                timeout=window.timeout(),
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in done:
+                stage, filepath, source_xmp = pending.pop(future)
+                try:
+                    result = future.result()
+                except BaseException as e:
+                    logger.error(f"Failed to process: {filepath.as_posix()}")
+                    logger.error(f"Exception: {e}")
+                    if stage != "write":
+                        window.remove(in_flight.pop(filepath))
+                    continue
+
+                if stage == "read":
+                    future = cpu_executor.submit(
+                        detect_crop_in_worker,
+                        filepath,
+                        result,
+                        debug_path=debug_path,
+                        debug=debug,
+                        crop_addition=crop_addition,
+                        blur_radius=blur_radius,
+                    )
+                    pending[future] = ("detect", filepath, source_xmp)
+                elif stage == "detect":
+                    window.remove(in_flight.pop(filepath))
+                    xmp_param, details, worker_metrics = result
+                    metrics.merge(worker_metrics)
+                    if xmp_param is None:
+                        continue
+                    if cache is not None:
+                        cache.put(filepath, xmp_param, details)
+                    submit_write(filepath, xmp_param, source_xmp)
+                else:
+                    logger.info(f"Completed: {filepath.as_posix()}")
+
+
+def cache_params() -> dict:
+    """The settings a detected crop depends on."""
+    return {
+        "version": 2,
+        "threshold": threshold,
+        "auto_thresholds": auto_thresholds if threshold == "auto" else None,
+        "blur_radius": blur_radius,
+        "crop_addition": crop_addition,
+        "raw_crop": raw_crop,
+        "raw_decode": raw_decode,
+        "stream_tiff_mb": stream_tiff_mb,
+    }
+
+
+def main():
+    library = library_scanner.scan_library(
+        root_path, index_file=library_index, workers=scan_workers
+    )
     supported_files = set.union(
         set(xmp_editing_utils.raw_files), set(xmp_editing_utils.other_files)
     )
-    files = [x for x in files if x.suffix.upper() in supported_files]
+    entries = library.entries(supported_files)
 
     if debug:
         # do not include files in debug directory
-        files = [x for x in files if not x.is_relative_to(debug_path)]
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_path = {}
-        for filepath in files:
-            future = executor.submit(
-                process_file,
-                filepath=filepath,
-                debug_path=debug_path,
-                debug=debug,
-                crop_addition=crop_addition,
-                blur_radius=blur_radius,
-                mirror=mirror_config,
-            )
-            future_to_path[future] = filepath.as_posix()
-
-        for future in concurrent.futures.as_completed(future_to_path):
-            filepath = future_to_path[future]
-            try:
-                data = future.result()
-            except BaseException as e:
-                logger.error(f"Failed to process: {filepath}")
-                logger.error(f"Exception: {e}")
-            else:
-                logger.info(f"Completed: {filepath}")
+        entries = [x for x in entries if not x.image.is_relative_to(debug_path)]
+    files = [entry.image for entry in entries]
+    # sidecars are matched regardless of case, so photo.XMP is used for photo.jpg
+    sidecars = {entry.image: entry.sidecar for entry in entries}
+
+    by_directory = {}
+    for filepath in files:
+        by_directory.setdefault(filepath.parent, []).append(filepath)
+
+    cache = None
+    if use_crop_cache:
+        cache = crop_cache.CropCache(
+            crop_cache_file, cache_params(), max_entries=crop_cache_max_entries
+        )
+        if clear_crop_cache:
+            cache.clear()
+
+    writer = sidecar_writer.SidecarWriter()
+    try:
+        run_pipeline(by_directory, writer, cache, sidecars)
+    finally:
+        if cache is not None:
+            metrics.count("crop cache hits", cache.hits)
+            cache.close()
+
+    metrics.count("files", len(files))
+    metrics.count("sidecars written", writer.written)
+    metrics.count("sidecars unchanged", writer.unchanged)
+    metrics.log_summary(logger)
+    metrics.close()
 
 
 if __name__ == "__main__":
@@ -3,6 +3,7 @@
 -- DROP VIEW Img
 CREATE VIEW Img AS
 SELECT
+Adobe_images.id_local AS ImageId,
 AgLibraryRootFolder.absolutePath AS RootFolderPath,
 AgLibraryRootFolder.name AS RootFolderName,
 AgLibraryFolder.pathFromRoot AS PathFromRoot,
@@ -0,0 +1,190 @@
+import array
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+
+# Stage timers, counters and an optional per-file trace for the migration and crop
+# scripts. Counters are always kept. Timers and the trace cost a perf_counter()
+# call and a dictionary lookup per stage and are only active if enabled.
+
+_disabled = contextlib.nullcontext()
+
+
+class _Stage:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _Item:
+    """Collects the stage times of one file and writes them as a trace line."""
+
+    __slots__ = ("metrics", "name", "kind", "start", "stages", "previous")
+
+    def __init__(self, metrics, name: str, kind: str | None):
+        self.metrics = metrics
+        self.name = name
+        self.kind = kind
+        self.stages = {}
+
+    def __enter__(self):
+        self.previous = getattr(self.metrics._local, "item", None)
+        self.metrics._local.item = self
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        self.metrics._local.item = self.previous
+        self.metrics.add_time(self.kind or "total", elapsed, item=False)
+        self.metrics.trace(
+            {
+                "file": self.name,
+                "kind": self.kind,
+                "seconds": round(elapsed, 6),
+                "stages": {k: round(v, 6) for k, v in self.stages.items()},
+                "error": None if exc is None else str(exc),
+            }
+        )
+        return False
+
+
+class _CountingHandler(logging.Handler):
+    def __init__(self, metrics):
+        super().__init__(level=logging.WARNING)
+        self.metrics = metrics
+
+    def emit(self, record):
+        self.metrics.count("errors" if record.levelno >= logging.ERROR else "warnings")
+
+
+class Metrics:
+    """Per process collection of stage durations and counters.
+    Results of other processes are combined with snapshot() and merge()."""
+
+    def __init__(self, enabled: bool = False, trace_file=None):
+        self.enabled = enabled
+        self.trace_file = None if trace_file is None else os.fspath(trace_file)
+        self.counters = {}
+        # durations in seconds, arrays keep millions of samples compact
+        self.stages = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._trace_fd = None
+
+    def stage(self, name: str):
+        """Context manager timing a stage. Does nothing if timing is disabled."""
+        if not self.enabled:
+            return _disabled
+        return _Stage(self, name)
+
+    def item(self, name: str, kind: str | None = None):
+        """Context manager around the processing of one file. Stages timed inside
+        it are written as one json line to the trace file, if there is one.
+        kind tells apart the records of a file processed in several steps."""
+        if not self.enabled:
+            return _disabled
+        return _Item(self, str(name), kind)
+
+    def add_time(self, name: str, seconds: float, item: bool = True) -> None:
+        with self._lock:
+            samples = self.stages.get(name)
+            if samples is None:
+                samples = self.stages[name] = array.array("d")
+            samples.append(seconds)
+        current = getattr(self._local, "item", None) if item else None
+        if current is not None:
+            current.stages[name] = current.stages.get(name, 0.0) + seconds
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def watch(self, logger: logging.Logger) -> None:
+        """Count the warnings and errors logged by logger."""
+        logger.addHandler(_CountingHandler(self))
+
+    def trace(self, record: dict) -> None:
+        if self.trace_file is None:
+            return
+        if self._trace_fd is None:
+            # appends of a single line are not interleaved between processes
+            self._trace_fd = os.open(
+                self.trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+            )
+        os.write(self._trace_fd, (json.dumps(record) + "\n").encode())
+
+    def snapshot(self, reset: bool = False) -> dict:
+        """Picklable copy of the counters and durations."""
+        with self._lock:
+            data = {"counters": dict(self.counters), "stages": dict(self.stages)}
+            if reset:
+                self.counters = {}
+                self.stages = {}
+            else:
+                data["stages"] = {
+                    k: array.array("d", v) for k, v in self.stages.items()
+                }
+        return data
+
+    def merge(self, data: dict) -> None:
+        with self._lock:
+            for name, n in data["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for name, samples in data["stages"].items():
+                self.stages.setdefault(name, array.array("d")).extend(samples)
+
+    def summary(self) -> list[str]:
+        """Lines with the counters and the n/total/p50/p95/max of every stage."""
+        lines = []
+        if self.counters:
+            lines.append(
+                ", ".join(f"{k}: {v}" for k, v in sorted(self.counters.items()))
+            )
+        if self.stages:
+            lines.append(
+                f"{'stage':<20}{'n':>8}{'total s':>10}"
+                f"{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}"
+            )
+        for name, samples in sorted(
+            self.stages.items(), key=lambda item: -sum(item[1])
+        ):
+            ordered = sorted(samples)
+            lines.append(
+                f"{name:<20}{len(ordered):>8}{sum(ordered):>10.2f}"
+                f"{1000 * percentile(ordered, 50):>10.1f}"
+                f"{1000 * percentile(ordered, 95):>10.1f}"
+                f"{1000 * ordered[-1]:>10.1f}"
+            )
+        return lines
+
+    def log_summary(self, logger: logging.Logger) -> None:
+        for line in self.summary():
+            logger.info(line)
+
+    def close(self) -> None:
+        if self._trace_fd is not None:
+            os.close(self._trace_fd)
+            self._trace_fd = None
+
+
+def percentile(ordered, p: float) -> float:
+    """Nearest rank percentile of sorted values."""
+    if not ordered:
+        return 0.0
+    rank = max(0, -(-len(ordered) * p // 100) - 1)
+    return ordered[int(rank)]
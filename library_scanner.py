@@ -0,0 +1,189 @@
+import concurrent.futures
+import json
+import os
+import pathlib
+import time
+from typing import NamedTuple
+
+from logzero import logger
+
+import sidecar_writer
+
+
+# One walk of the image library for all scripts. Folders are listed with scandir
+# from several threads, which hides the latency of network storage. The listings
+# are kept in an index file and a folder is only listed again if its mtime changed,
+# which happens when entries are added, removed or renamed in it.
+
+INDEX_VERSION = 1
+
+# a folder changed within this many seconds of being listed is listed again, as
+# its mtime may not have moved (coarse timestamps on some file systems)
+mtime_slack = 2
+
+
+class ImageEntry(NamedTuple):
+    image: pathlib.Path
+    sidecar: pathlib.Path | None  # BaseName.xmp
+    ext_sidecar: pathlib.Path | None  # BaseName.EXT.xmp
+
+
+def list_folder(path: str, previous: dict | None):
+    """Listing of a folder and the identity of the folder. The previous listing is
+    returned if the folder did not change since."""
+    stat = os.stat(path)
+    identity = (stat.st_dev, stat.st_ino)
+    if (
+        previous is not None
+        and previous["mtime"] == stat.st_mtime_ns
+        and stat.st_mtime < previous["scanned"] - mtime_slack
+    ):
+        return previous, identity, True
+
+    files, folders = [], []
+    scanned = time.time()
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    folders.append(entry.name)
+                elif entry.is_file():
+                    files.append(entry.name)
+            except OSError as e:
+                logger.debug(f"Could not stat {entry.path}: {e}")
+    listing = {
+        "mtime": stat.st_mtime_ns,
+        "scanned": scanned,
+        "files": sorted(files),
+        "folders": sorted(folders),
+    }
+    return listing, identity, False
+
+
+def load_index(index_file, root: str) -> dict:
+    """Folder listings of root from the index file, empty if there is none."""
+    if index_file is None:
+        return {}
+    try:
+        with open(index_file, encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        logger.warning(f"Ignoring unreadable library index {index_file}: {e}")
+        return {}
+    if data.get("version") != INDEX_VERSION:
+        return {}
+    return data.get("roots", {}).get(root, {})
+
+
+def save_index(index_file, root: str, folders: dict) -> None:
+    """Store the folder listings of root, keeping those of other roots."""
+    data = {"version": INDEX_VERSION, "roots": {}}
+    try:
+        with open(index_file, encoding="utf-8") as f:
+            existing = json.load(f)
+        if existing.get("version") == INDEX_VERSION:
+            data["roots"] = existing.get("roots", {})
+    except (FileNotFoundError, ValueError):
+        pass
+    data["roots"][root] = folders
+    sidecar_writer.atomic_write(pathlib.Path(index_file), json.dumps(data))
+
+
+def scan_library(root, index_file=None, workers: int = 8) -> "LibraryIndex":
+    """List all folders under root, reusing the unchanged listings of index_file and
+    updating it."""
+    root = str(pathlib.Path(root))
+    previous = load_index(index_file, root)
+    folders = {}
+    seen = set()
+    reused = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(list_folder, root, previous.get(root)): root}
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                path = pending.pop(future)
+                try:
+                    listing, identity, unchanged = future.result()
+                except OSError as e:
+                    logger.warning(f"Could not list {path}: {e}")
+                    continue
+                # folders reached twice through symbolic links are listed once
+                if identity in seen:
+                    continue
+                seen.add(identity)
+                folders[path] = listing
+                reused += unchanged
+                for name in listing["folders"]:
+                    child = os.path.join(path, name)
+                    future = executor.submit(list_folder, child, previous.get(child))
+                    pending[future] = child
+
+    logger.info(f"Listed {len(folders)} folders, {reused} unchanged since last scan")
+    if index_file is not None:
+        save_index(index_file, root, folders)
+    return LibraryIndex(folders)
+
+
+def scan_folder(path) -> "LibraryIndex":
+    """The files of a single folder, without its subfolders. Empty if the folder
+    does not exist."""
+    path = str(pathlib.Path(path))
+    try:
+        listing, _, _ = list_folder(path, None)
+    except FileNotFoundError:
+        return LibraryIndex({})
+    return LibraryIndex({path: listing})
+
+
+class LibraryIndex:
+    """The files of a library by folder. Sidecars are matched to their image
+    regardless of case."""
+
+    def __init__(self, folders: dict):
+        self.folders = folders
+        self._lower = {}
+
+    def names(self, folder) -> dict:
+        """Lower case name: name of the files in a folder, empty if not listed."""
+        folder = str(folder)
+        names = self._lower.get(folder)
+        if names is None:
+            listing = self.folders.get(folder)
+            files = listing["files"] if listing is not None else []
+            names = self._lower[folder] = {name.lower(): name for name in files}
+        return names
+
+    def files(self):
+        for folder, listing in self.folders.items():
+            for name in listing["files"]:
+                yield pathlib.Path(folder, name)
+
+    def images(self, suffixes) -> list[pathlib.Path]:
+        """Files with one of the (upper case) suffixes."""
+        suffixes = set(suffixes)
+        return [f for f in self.files() if f.suffix.upper() in suffixes]
+
+    def sidecars(self) -> list[pathlib.Path]:
+        return [f for f in self.files() if f.suffix.lower() == ".xmp"]
+
+    def find(self, path: pathlib.Path) -> pathlib.Path | None:
+        """The listed file matching path regardless of case, None if there is none."""
+        name = self.names(path.parent).get(path.name.lower())
+        return None if name is None else path.with_name(name)
+
+    def entry(self, image: pathlib.Path) -> ImageEntry:
+        return ImageEntry(
+            image,
+            self.find(image.with_suffix(".xmp")),
+            self.find(image.with_name(image.name + ".xmp")),
+        )
+
+    def entries(self, suffixes) -> list[ImageEntry]:
+        """Images with one of the suffixes and their sidecars."""
+        return [self.entry(image) for image in self.images(suffixes)]
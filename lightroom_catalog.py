@@ -0,0 +1,187 @@
+import itertools
+import pathlib
+import sqlite3
+from typing import Iterator
+from typing import NamedTuple
+
+from logzero import logger
+
+
+# limit this to only those filetypes supported by DarkTable
+# https://docs.darktable.org/usermanual/development/en/overview/supported-file-formats/
+# fmt: off
+SUPPORTED_FILE_TYPES = (
+    # Regular formats
+    "3FR", "ARI", "ARW", "BAY", "BMQ", "CAP", "CINE", "CR2", "CR3", "CRW",
+    "CS1", "DC2", "DCR", "DNG", "GPR", "ERF", "FFF", "EXR", "IA", "IIQ",
+    "JPEG", "JPG", "K25", "KC2", "KDC", "MDC", "MEF", "MOS", "MRW", "NEF",
+    "NRW", "ORF", "PEF", "PFM", "PNG", "PXN", "QTK", "RAF", "RAW", "RDC",
+    "RW1", "RW2", "SR2", "SRF", "SRW", "STI", "TIF", "TIFF", "X3F",
+    # Extended Formats
+    "J2C", "J2K", "JP2", "JPC",
+    "BMP", "DCM", "GIF", "JNG", "MIFF",
+    "MNG", "PBM", "PGM", "PNM", "PPM", "WEBP",
+)
+# fmt: on
+
+# bump to rebuild existing index databases when the table definition changes
+INDEX_VERSION = 1
+
+# Only the lightweight columns of the view created in img_view.sql are copied to
+# the index database. The xmp/processtext blobs are fetched per row by
+# fetch_develop_data. Names are qualified as the catalog has an Img view as well.
+MATERIALIZE_STATEMENTS = [
+    "DROP TABLE IF EXISTS main.img",
+    """
+    CREATE TABLE main.img AS
+    SELECT ImageId, RootFolderName, PathFromRoot, BaseName, FileType, CaptureTime
+    FROM catalog.Img
+    """,
+    # serves the root folder/path prefix filters and the sidecar ordering
+    """
+    CREATE INDEX main.img_folder
+    ON img (RootFolderName, PathFromRoot, BaseName COLLATE NOCASE)
+    """,
+    "CREATE INDEX main.img_capture ON img (RootFolderName, CaptureTime)",
+    "DELETE FROM main.meta",
+    "INSERT INTO main.meta VALUES (?, ?, ?, ?)",
+]
+
+DEVELOP_QUERY = """
+select
+    Adobe_AdditionalMetadata.xmp as xmp,
+    Adobe_imageDevelopSettings.processversion as processversion,
+    Adobe_imageDevelopSettings.text as processtext
+from Adobe_images
+LEFT JOIN Adobe_AdditionalMetadata on Adobe_images.id_local = Adobe_AdditionalMetadata.image
+LEFT JOIN Adobe_imageDevelopSettings on Adobe_images.id_local = Adobe_imageDevelopSettings.image
+WHERE Adobe_images.id_local = ?
+"""
+
+
+class CatalogRow(NamedTuple):
+    image_id: int
+    root_folder_name: str
+    path_from_root: str
+    base_name: str
+    file_type: str
+
+    @property
+    def name(self) -> str:
+        return f"{self.path_from_root}{self.base_name}.{self.file_type}"
+
+
+class DevelopData(NamedTuple):
+    xmp: str | None
+    processversion: str | None
+    processtext: str | None
+
+
+def _read_only_uri(path: pathlib.Path) -> str:
+    return pathlib.Path(path).resolve().as_uri() + "?mode=ro"
+
+
+def connect(catalog: pathlib.Path) -> sqlite3.Connection:
+    """Open the Lightroom catalog read-only so it is never modified by accident."""
+    return sqlite3.connect(_read_only_uri(catalog), uri=True)
+
+
+def open_index(catalog: pathlib.Path, index_path: pathlib.Path) -> sqlite3.Connection:
+    """Open the side database holding an indexed copy of the Img view.
+    The copy is only rebuilt when the catalog's mtime or size changed."""
+    catalog = pathlib.Path(catalog).resolve()
+    stat = catalog.stat()
+    signature = (str(catalog), stat.st_mtime_ns, stat.st_size, INDEX_VERSION)
+
+    # a URI connection is needed to attach the catalog read-only
+    cnx = sqlite3.connect(pathlib.Path(index_path).resolve().as_uri(), uri=True)
+    cnx.execute(
+        "CREATE TABLE IF NOT EXISTS meta "
+        "(catalog TEXT, mtime_ns INTEGER, size INTEGER, version INTEGER)"
+    )
+    if cnx.execute("SELECT * FROM meta").fetchone() == signature:
+        return cnx
+
+    logger.info(f"Building catalog index {index_path}")
+    cnx.execute("ATTACH DATABASE ? AS catalog", (_read_only_uri(catalog),))
+    try:
+        cnx.execute("BEGIN")
+        try:
+            for statement in MATERIALIZE_STATEMENTS[:-1]:
+                cnx.execute(statement)
+            cnx.execute(MATERIALIZE_STATEMENTS[-1], signature)
+        except BaseException:
+            cnx.rollback()
+            raise
+        cnx.commit()
+    finally:
+        cnx.execute("DETACH DATABASE catalog")
+    return cnx
+
+
+def iter_rows(
+    cnx: sqlite3.Connection,
+    root_folder_name: str,
+    path_prefix: str | None = None,
+    captured_after: str | None = None,
+    captured_before: str | None = None,
+    file_types=SUPPORTED_FILE_TYPES,
+    batch_size: int = 500,
+) -> Iterator[CatalogRow]:
+    """Stream the rows of the index database matching the filters.
+    Capture times are compared as ISO strings ("2015" or "2015-06-01T12:00:00").
+    Rows are pulled from the cursor batch_size at a time so memory use does not
+    grow with the size of the catalog."""
+    conditions = ["RootFolderName = ?"]
+    params = [root_folder_name]
+    if path_prefix:
+        # a range instead of LIKE so the index can be used
+        conditions.append("PathFromRoot >= ? AND PathFromRoot < ?")
+        params += [path_prefix, path_prefix + "\U0010ffff"]
+    if captured_after is not None:
+        conditions.append("CaptureTime >= ?")
+        params.append(str(captured_after))
+    if captured_before is not None:
+        conditions.append("CaptureTime < ?")
+        params.append(str(captured_before))
+    file_types = [file_type.upper() for file_type in file_types]
+    conditions.append(f"upper(FileType) IN ({', '.join('?' * len(file_types))})")
+    params += file_types
+
+    query = f"""
+    SELECT ImageId, RootFolderName, PathFromRoot, BaseName, FileType
+    FROM img
+    WHERE {" AND ".join(conditions)}
+    -- keep rows sharing a BaseName.xmp sidecar next to each other
+    ORDER BY PathFromRoot, BaseName COLLATE NOCASE
+    """
+    cursor = cnx.execute(query, params)
+    try:
+        while True:
+            batch = cursor.fetchmany(batch_size)
+            if not batch:
+                break
+            for row in batch:
+                yield CatalogRow._make(row)
+    finally:
+        cursor.close()
+
+
+def fetch_develop_data(cnx: sqlite3.Connection, image_id: int | None) -> DevelopData:
+    """Load the xmp and develop settings blobs for a single image."""
+    row = cnx.execute(DEVELOP_QUERY, (image_id,)).fetchone()
+    if row is None:
+        return DevelopData(None, None, None)
+    return DevelopData._make(row)
+
+
+def sidecar_key(row: CatalogRow) -> tuple[str, str]:
+    """Rows with the same key write the same BaseName.xmp sidecar."""
+    return row.path_from_root, row.base_name.lower()
+
+
+def group_by_sidecar(rows: Iterator[CatalogRow]) -> Iterator[list[CatalogRow]]:
+    """Group consecutive rows that write the same BaseName.xmp sidecar,
+    e.g. a raw file and the jpeg shot alongside it."""
+    for _, group in itertools.groupby(rows, key=sidecar_key):
+        yield list(group)
@@ -0,0 +1,202 @@
+import collections
+import hashlib
+import re
+
+
+# Decoder for the lua table Lightroom stores in Adobe_imageDevelopSettings.text
+# ("s = { Exposure2012 = 0.5, ToneCurvePV2012 = { 0, 0, 255, 255, }, ... }").
+# Values are decoded the same way slpp does, but values of keys that are not
+# requested are skipped over without being built. Integers written with leading
+# zeros stay integers, where slpp returns them as floats.
+
+_space = re.compile(r"\s*")
+_name = re.compile(r"([A-Za-z_]\w*)\s*=(?!=)")
+_number = re.compile(r"-?(?:0[xX][0-9a-fA-F]+|\d+(?:\.\d*)?(?:[eE][+-]?\d+)?)")
+_word = re.compile(r"[A-Za-z_]\w*")
+_strings = {
+    '"': re.compile(r'"((?:[^"\\]|\\.)*)"', re.DOTALL),
+    "'": re.compile(r"'((?:[^'\\]|\\.)*)'", re.DOTALL),
+}
+_long_string = re.compile(r"\[(=*)\[(.*?)\]\1\]", re.DOTALL)
+_escape = re.compile(r"\\(.)", re.DOTALL)
+_bare_value = re.compile(r"[^,;}\s]+")
+_table_token = re.compile(r"""[{}"']|\[=*\[""")
+
+_words = {"true": True, "false": False, "nil": None}
+
+
+class _Decoder:
+    def __init__(self, text: str):
+        self.text = text
+        self.pos = 0
+
+    def error(self, message: str):
+        return ValueError(f"{message} at position {self.pos}")
+
+    def skip_space(self):
+        self.pos = _space.match(self.text, self.pos).end()
+
+    def peek(self) -> str:
+        self.skip_space()
+        if self.pos >= len(self.text):
+            raise self.error("unexpected end of lua table")
+        return self.text[self.pos]
+
+    def string(self) -> str:
+        quote = self.text[self.pos]
+        match = _strings[quote].match(self.text, self.pos)
+        if match is None:
+            raise self.error("unterminated string")
+        self.pos = match.end()
+        value = match.group(1)
+        if "\\" in value:
+            # like slpp, only escaped quotes are unescaped
+            value = _escape.sub(
+                lambda m: m.group(1) if m.group(1) == quote else m.group(0), value
+            )
+        return value
+
+    def long_string(self) -> str:
+        match = _long_string.match(self.text, self.pos)
+        if match is None:
+            raise self.error("unterminated long string")
+        self.pos = match.end()
+        return match.group(2)
+
+    def value(self):
+        ch = self.peek()
+        if ch == "{":
+            return self.table()
+        if ch in _strings:
+            return self.string()
+        if ch == "[":
+            return self.long_string()
+
+        match = _number.match(self.text, self.pos)
+        if match is not None:
+            self.pos = match.end()
+            number = match.group()
+            try:
+                return int(number, 0)
+            except ValueError:
+                pass
+            try:
+                # leading zeros, which lua reads as a decimal number
+                return int(number, 10)
+            except ValueError:
+                return float(number)
+
+        match = _word.match(self.text, self.pos)
+        if match is not None and match.group() in _words:
+            self.pos = match.end()
+            return _words[match.group()]
+
+        raise self.error("unexpected value")
+
+    def skip_value(self):
+        ch = self.peek()
+        if ch in _strings:
+            self.string()
+        elif ch == "[":
+            self.long_string()
+        elif ch == "{":
+            depth = 0
+            while True:
+                match = _table_token.search(self.text, self.pos)
+                if match is None:
+                    raise self.error("unterminated table")
+                token = match.group()
+                if token in _strings:
+                    self.pos = match.start()
+                    self.string()
+                elif token[0] == "[":
+                    self.pos = match.start()
+                    self.long_string()
+                else:
+                    self.pos = match.end()
+                    depth += 1 if token == "{" else -1
+                    if depth == 0:
+                        return
+        else:
+            match = _bare_value.match(self.text, self.pos)
+            if match is None:
+                raise self.error("unexpected value")
+            self.pos = match.end()
+
+    def key(self):
+        """Parse "name =" or "[key] =", return None for a positional value."""
+        ch = self.peek()
+        if ch == "[" and not _long_string.match(self.text, self.pos):
+            self.pos += 1
+            key = self.value()
+            if self.peek() != "]":
+                raise self.error("expected ]")
+            self.pos += 1
+            if self.peek() != "=":
+                raise self.error("expected =")
+            self.pos += 1
+            return key
+        match = _name.match(self.text, self.pos)
+        if match is not None:
+            self.pos = match.end()
+            return match.group(1)
+        return None
+
+    def table(self, keys=None):
+        """Parse a table. With keys, only the values of those keys are decoded."""
+        self.pos += 1
+        items = []
+        fields = {}
+        while self.peek() != "}":
+            key = self.key()
+            if key is None:
+                items.append(self.value())
+            elif keys is None or key in keys:
+                fields[key] = self.value()
+            else:
+                self.skip_value()
+
+            ch = self.peek()
+            if ch in ",;":
+                self.pos += 1
+            elif ch != "}":
+                raise self.error("expected , or }")
+        self.pos += 1
+
+        # slpp returns tables without named keys as lists, empty ones as dicts
+        if not fields and keys is None and items:
+            return items
+        return {**dict(enumerate(items)), **fields}
+
+
+def decode(text: str, keys=None):
+    """Decode a lua table. If keys is given, only those top level keys are decoded."""
+    decoder = _Decoder(text)
+    if decoder.peek() != "{":
+        raise decoder.error("expected {")
+    data = decoder.table(keys=keys)
+    decoder.skip_space()
+    if decoder.pos != len(text):
+        raise decoder.error("unexpected data after table")
+    return data
+
+
+# develop settings are often identical (presets, synced edits), decode them once
+_cache = collections.OrderedDict()
+cache_size = 4096
+
+
+def decode_cached(text: str, keys: frozenset) -> dict:
+    """decode() memoized by a hash of the text. Returns a new dict on every call,
+    the values themselves are shared and must not be modified."""
+    digest = hashlib.blake2b(text.encode(), digest_size=16).digest()
+    cache_key = (digest, keys)
+    data = _cache.get(cache_key)
+    if data is None:
+        data = decode(text, keys=keys)
+        _cache[cache_key] = data
+        if len(_cache) > cache_size:
+            _cache.popitem(last=False)
+    else:
+        _cache.move_to_end(cache_key)
+    return dict(data)
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import pathlib
+import sqlite3
+import time
+from typing import NamedTuple
+
+
+# Local record of what extract_xmp has done, so an interrupted or repeated run
+# only processes rows whose catalog data or files changed, plus earlier failures.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS row_state (
+    image_id INTEGER,
+    name TEXT,
+    input_hash TEXT,
+    file_stats TEXT,
+    outcome TEXT,
+    message TEXT,
+    updated REAL,
+    PRIMARY KEY (image_id, name)
+)
+"""
+
+
+class RowState(NamedTuple):
+    image_id: int
+    name: str
+    input_hash: str
+    file_stats: list
+    outcome: str  # "ok", "missing" or "failed"
+    message: str = ""
+
+
+def hash_inputs(*values) -> str:
+    """Hash of the catalog data (xmp, processtext, processversion) of a row and of
+    the settings the sidecar is written with."""
+    digest = hashlib.sha256()
+    for value in values:
+        # distinguish NULL from an empty string
+        digest.update(b"\x00" if value is None else b"\x01" + str(value).encode())
+        digest.update(b"\xff")
+    return digest.hexdigest()
+
+
+def file_stats(paths) -> list:
+    """Size and mtime of each path, None if missing."""
+    stats = []
+    for path in paths:
+        try:
+            stat = pathlib.Path(path).stat()
+        except FileNotFoundError:
+            stats.append(None)
+        else:
+            stats.append([stat.st_size, stat.st_mtime_ns])
+    return stats
+
+
+def _id(image_id: int | None) -> int:
+    # rows without an Adobe_images entry have no id, NULL would not be unique
+    return -1 if image_id is None else image_id
+
+
+class StateStore:
+    """SQLite store of the outcome and inputs of every processed catalog row.
+    Only one process should write; workers open it read-only."""
+
+    def __init__(self, path: pathlib.Path, readonly: bool = False):
+        path = pathlib.Path(path)
+        if readonly:
+            uri = path.resolve().as_uri() + "?mode=ro"
+            self.cnx = sqlite3.connect(uri, uri=True)
+        else:
+            self.cnx = sqlite3.connect(path)
+            # readers in other processes are not blocked while results are written
+            self.cnx.execute("PRAGMA journal_mode=WAL")
+            self.cnx.execute(SCHEMA)
+            self.cnx.commit()
+
+    def is_unchanged(self, image_id: int, name: str, input_hash: str, stats: list):
+        """True if the row was processed successfully with the same inputs."""
+        previous = self.cnx.execute(
+            "SELECT input_hash, file_stats, outcome FROM row_state "
+            "WHERE image_id = ? AND name = ?",
+            (_id(image_id), name),
+        ).fetchone()
+        return previous == (input_hash, json.dumps(stats), "ok")
+
+    def record(self, states: list[RowState]) -> None:
+        now = time.time()
+        with self.cnx:
+            self.cnx.executemany(
+                "INSERT OR REPLACE INTO row_state VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        _id(state.image_id),
+                        state.name,
+                        state.input_hash,
+                        json.dumps(state.file_stats),
+                        state.outcome,
+                        state.message,
+                        now,
+                    )
+                    for state in states
+                ],
+            )
+
+    def counts(self) -> dict:
+        """Number of recorded rows per outcome, of this and earlier runs."""
+        return dict(
+            self.cnx.execute(
+                "SELECT outcome, count(*) FROM row_state GROUP BY outcome"
+            ).fetchall()
+        )
+
+    def close(self) -> None:
+        self.cnx.close()
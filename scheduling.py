@@ -0,0 +1,119 @@
+import os
+import time
+
+from logzero import logger
+
+
+# Limits on the files that are in flight in the crop run: read, decoded or waiting
+# for a worker. The limit is a number of files and optionally an estimate of their
+# memory use. In adaptive mode the number of files changes with the CPU use and
+# I/O wait of the machine, read from /proc/stat.
+
+
+def cpu_times() -> tuple[int, int, int] | None:
+    """Busy, iowait and total jiffies of all cpus since boot, None if unavailable."""
+    try:
+        with open("/proc/stat") as f:
+            fields = [int(x) for x in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    # user nice system idle iowait irq softirq steal ...
+    idle, iowait = fields[3], fields[4] if len(fields) > 4 else 0
+    total = sum(fields[:8])
+    return total - idle - iowait, iowait, total
+
+
+class SubmissionWindow:
+    """Admits files as long as fewer than limit files and fewer than max_bytes
+    (if set) are in flight. A single file is always admitted, however large.
+
+    With adaptive, limit moves between min_items and max_items: it grows while the
+    cpus used by the workers are not busy and the machine waits for I/O, so more
+    files are read ahead, and shrinks while they are busy, which keeps memory low
+    when reading ahead does not help."""
+
+    def __init__(
+        self,
+        max_items: int,
+        max_bytes: int | None = None,
+        adaptive: bool = False,
+        min_items: int = 1,
+        cpu_share: float = 1.0,
+        interval: float = 2.0,
+    ):
+        self.max_items = max_items
+        self.min_items = min(min_items, max_items)
+        self.max_bytes = max_bytes
+        self.adaptive = adaptive and cpu_times() is not None
+        # fraction of the machine the workers can keep busy
+        self.cpu_share = cpu_share
+        self.interval = interval
+        self.limit = self.min_items if self.adaptive else max_items
+        self.items = 0
+        self.bytes = 0
+        self._sample = cpu_times() if self.adaptive else None
+        self._sampled_at = time.monotonic()
+
+    def admits(self, size: int) -> bool:
+        if self.items == 0:
+            return True
+        if self.items >= self.limit:
+            return False
+        return self.max_bytes is None or self.bytes + size <= self.max_bytes
+
+    def add(self, size: int) -> None:
+        self.items += 1
+        self.bytes += size
+
+    def remove(self, size: int) -> None:
+        self.items -= 1
+        self.bytes -= size
+
+    def timeout(self) -> float | None:
+        """How long to wait for a completion before calling adjust again."""
+        return self.interval if self.adaptive else None
+
+    def adjust(self) -> None:
+        """Update limit from the cpu use since the last call, at most every interval."""
+        if not self.adaptive or time.monotonic() - self._sampled_at < self.interval:
+            return
+        sample = cpu_times()
+        busy, iowait, total = (new - old for new, old in zip(sample, self._sample))
+        self._sample = sample
+        self._sampled_at = time.monotonic()
+        if total <= 0:
+            return
+
+        busy_share = busy / total / self.cpu_share
+        if busy_share < 0.8 and iowait / total > 0.05:
+            limit = min(self.limit + 1, self.max_items)
+        elif busy_share > 0.95:
+            limit = max(self.limit - 1, self.min_items)
+        else:
+            return
+        if limit != self.limit:
+            logger.debug(
+                f"cpu {busy_share:.0%} of workers, iowait {iowait / total:.0%}: "
+                f"{limit} files in flight"
+            )
+            self.limit = limit
+
+
+def largest_first(files: list, sizes: dict) -> list:
+    """Files ordered by decreasing size, so the longest ones do not start last."""
+    return sorted(files, key=lambda f: sizes.get(f, 0), reverse=True)
+
+
+def file_size(filepath) -> int:
+    try:
+        return os.stat(filepath).st_size
+    except OSError:
+        return 0
+
+
+def file_sizes(files: list, executor=None) -> dict:
+    """Size of every file, 0 if it cannot be read. With an executor the files are
+    stat'ed by its threads, which hides the latency of network storage."""
+    if executor is None:
+        return {filepath: file_size(filepath) for filepath in files}
+    return dict(zip(files, executor.map(file_size, files)))
@@ -0,0 +1,97 @@
+import os
+import pathlib
+import tempfile
+import threading
+
+from logzero import logger
+
+import xmp_packet
+
+
+# Sidecars are only rewritten when their content changes, so mtimes stay put for
+# darktable and backups. Writes go through a temp file in the same directory that
+# is renamed over the sidecar, so a crash never leaves a half written file.
+
+# permissions of newly created sidecars, as open() would give them
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def read_sidecar(path: pathlib.Path) -> str | None:
+    """Return the content of a sidecar, or None if it does not exist."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def same_content(existing: str | None, packet: str) -> bool:
+    """True if both packets hold the same properties, regardless of formatting."""
+    if existing is None:
+        return False
+    if existing == packet:
+        return True
+    try:
+        return xmp_packet.parse_packet(existing) == xmp_packet.parse_packet(packet)
+    except Exception as e:
+        logger.debug(f"Could not compare with existing sidecar: {e}")
+        return False
+
+
+def atomic_write(path: pathlib.Path, text: str) -> None:
+    """Write text to a temp file next to path and rename it into place."""
+    path = pathlib.Path(path)
+    try:
+        mode = path.stat().st_mode & 0o7777
+    except FileNotFoundError:
+        mode = 0o666 & ~_umask
+
+    fd, temp_name = tempfile.mkstemp(
+        prefix=f".{path.name}.", suffix=".tmp", dir=path.parent
+    )
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp_name, mode)
+        os.replace(temp_name, path)
+    except BaseException:
+        os.unlink(temp_name)
+        raise
+
+
+class SidecarWriter:
+    """Writes XMP sidecars, skipping the ones whose content would not change.
+    Keeps count of written and unchanged files, safe to share between threads."""
+
+    def __init__(self):
+        self.written = 0
+        self.unchanged = 0
+        self._lock = threading.Lock()
+
+    def write(self, path: pathlib.Path, xmp_dict: dict, existing: str | None = None):
+        """Write xmp_dict to path. existing is the current content of the sidecar,
+        read from disk if not given. Returns True if the file was written."""
+        packet = xmp_packet.serialize_packet(xmp_dict)
+        if existing is None:
+            existing = read_sidecar(path)
+
+        if same_content(existing, packet):
+            logger.debug(f"unchanged {path}")
+            with self._lock:
+                self.unchanged += 1
+            return False
+
+        atomic_write(path, packet)
+        logger.debug(f"updated {path}")
+        with self._lock:
+            self.written += 1
+        return True
+
+    def counts(self) -> dict:
+        return {"written": self.written, "unchanged": self.unchanged}
+
+    def log_summary(self) -> None:
+        logger.info(f"Sidecars written: {self.written}, unchanged: {self.unchanged}")
@@ -0,0 +1,209 @@
+import io
+import pathlib
+import shutil
+import struct
+import subprocess
+import sys
+
+import pytest
+from PIL import Image
+
+repo_path = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(repo_path))
+
+import embedded_xmp  # noqa: E402
+
+
+packet = (
+    '<?xpacket begin="﻿" id="W5M0MpCehiHzreSzNTczkc9d"?>\n'
+    '<x:xmpmeta xmlns:x="adobe:ns:meta/">\n'
+    ' <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">\n'
+    '  <rdf:Description rdf:about="" xmlns:tiff="http://ns.adobe.com/tiff/1.0/"'
+    ' tiff:Orientation="6" xmlns:dc="http://purl.org/dc/elements/1.1/"'
+    ' dc:source="Dia été 1975"/>\n'
+    " </rdf:RDF>\n"
+    "</x:xmpmeta>\n"
+    '<?xpacket end="w"?>'
+)
+
+
+def segment(marker: int, payload: bytes) -> bytes:
+    return bytes([0xFF, marker]) + struct.pack(">H", len(payload) + 2) + payload
+
+
+def jpeg(*segments: bytes) -> bytes:
+    """A JPEG file with the segments inserted after the start of image marker."""
+    out = io.BytesIO()
+    Image.new("RGB", (16, 16), (200, 120, 40)).save(out, "JPEG")
+    data = out.getvalue()
+    return data[:2] + b"".join(segments) + data[2:]
+
+
+def xmp_segment(text: str = packet) -> bytes:
+    return segment(0xE1, embedded_xmp.xmp_signature + text.encode())
+
+
+def exif_segment() -> bytes:
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    return segment(0xE1, b"Exif\x00\x00" + exif.tobytes())
+
+
+def tiff(order: str, xmp: bytes | None, padding: int = 0, at_end: bool = False):
+    """A one pixel classic TIFF with the first IFD right after the header and the
+    XMP (tag 700) after the IFD, or at the end of the file after padding bytes."""
+    tags = [
+        (256, 3, 1, 1),  # ImageWidth
+        (257, 3, 1, 1),  # ImageLength
+        (258, 3, 1, 8),  # BitsPerSample
+        (259, 3, 1, 1),  # Compression
+        (262, 3, 1, 1),  # PhotometricInterpretation
+        (273, 4, 1, 0),  # StripOffsets, set below
+        (277, 3, 1, 1),  # SamplesPerPixel
+        (278, 3, 1, 1),  # RowsPerStrip
+        (279, 4, 1, 1),  # StripByteCounts
+    ]
+    if xmp is not None:
+        tags.append((embedded_xmp.xmp_tag, 7, len(xmp), 0))
+    ifd_size = 2 + 12 * len(tags) + 4
+    pixel_offset = 8 + ifd_size
+    xmp_offset = pixel_offset + 1 + (padding if at_end else 0)
+
+    entries = []
+    for tag, kind, count, value in tags:
+        if tag == 273:
+            value = pixel_offset
+        elif tag == embedded_xmp.xmp_tag:
+            value = xmp_offset
+        if kind == 3:
+            field = struct.pack(order + "HH", value, 0)
+        else:
+            field = struct.pack(order + "I", value)
+        entries.append(struct.pack(order + "HHI", tag, kind, count) + field)
+
+    data = (b"II" if order == "<" else b"MM") + struct.pack(order + "HI", 42, 8)
+    data += struct.pack(order + "H", len(tags)) + b"".join(entries)
+    data += struct.pack(order + "I", 0) + b"\x80"
+    if at_end:
+        data += b"\x00" * padding
+    if xmp is not None:
+        data += xmp
+    return data
+
+
+def write(tmp_path, name: str, data: bytes) -> pathlib.Path:
+    path = pathlib.Path(tmp_path, name)
+    path.write_bytes(data)
+    return path
+
+
+def test_jpeg_without_xmp(tmp_path):
+    path = write(tmp_path, "IMG_00001.jpg", jpeg(exif_segment()))
+    assert embedded_xmp.read_embedded_xmp(path) == ""
+
+
+def test_jpeg_with_exif_before_xmp(tmp_path):
+    path = write(tmp_path, "IMG_00001.JPG", jpeg(exif_segment(), xmp_segment()))
+    assert embedded_xmp.read_embedded_xmp(path) == packet
+
+
+def test_jpeg_with_xmp_before_other_segments(tmp_path):
+    comment = segment(0xFE, b"scanned")
+    icc = segment(0xE2, b"ICC_PROFILE\x00" + bytes(64))
+    path = write(tmp_path, "IMG_00001.jpeg", jpeg(xmp_segment(), icc, comment))
+    assert embedded_xmp.read_embedded_xmp(path) == packet
+
+
+def test_jpeg_with_extended_xmp_is_left_to_exiftool(tmp_path):
+    extension = segment(
+        0xE1, embedded_xmp.extension_signature + b"0" * 32 + bytes(8) + b"<rdf/>"
+    )
+    path = write(tmp_path, "IMG_00001.jpg", jpeg(xmp_segment(), extension))
+    assert embedded_xmp.read_embedded_xmp(path) is None
+
+
+def test_jpeg_with_two_xmp_segments_is_left_to_exiftool(tmp_path):
+    path = write(tmp_path, "IMG_00001.jpg", jpeg(xmp_segment(), xmp_segment()))
+    assert embedded_xmp.read_embedded_xmp(path) is None
+
+
+def test_jpeg_xmp_outside_of_the_header_is_left_to_exiftool(tmp_path, monkeypatch):
+    monkeypatch.setattr(embedded_xmp, "header_bytes", 4096)
+    padding = segment(0xE2, bytes(8000))
+    path = write(tmp_path, "IMG_00001.jpg", jpeg(padding, xmp_segment()))
+    assert embedded_xmp.read_embedded_xmp(path) is None
+
+
+def test_not_a_jpeg(tmp_path):
+    path = write(tmp_path, "IMG_00001.jpg", b"GIF89a" + bytes(100))
+    assert embedded_xmp.read_embedded_xmp(path) is None
+
+
+def test_empty_file(tmp_path):
+    path = write(tmp_path, "IMG_00001.jpg", b"")
+    assert embedded_xmp.read_embedded_xmp(path) is None
+
+
+def test_other_formats_are_left_to_exiftool(tmp_path):
+    path = write(tmp_path, "IMG_00001.png", jpeg(xmp_segment()))
+    assert embedded_xmp.read_embedded_xmp(path) is None
+
+
+@pytest.mark.parametrize("order", ["<", ">"], ids=["little endian", "big endian"])
+def test_tiff(tmp_path, order):
+    path = write(tmp_path, "IMG_00001.tif", tiff(order, packet.encode()))
+    assert embedded_xmp.read_embedded_xmp(path) == packet
+
+
+@pytest.mark.parametrize("order", ["<", ">"], ids=["little endian", "big endian"])
+def test_tiff_without_xmp(tmp_path, order):
+    path = write(tmp_path, "IMG_00001.TIFF", tiff(order, None))
+    assert embedded_xmp.read_embedded_xmp(path) == ""
+
+
+@pytest.mark.parametrize("order", ["<", ">"], ids=["little endian", "big endian"])
+def test_tiff_xmp_outside_of_the_header(tmp_path, order):
+    # some writers put the packet at the end of the file, after the pixel data
+    data = tiff(order, packet.encode(), padding=embedded_xmp.header_bytes, at_end=True)
+    path = write(tmp_path, "IMG_00001.dng", data)
+    assert embedded_xmp.read_embedded_xmp(path) == packet
+
+
+def test_tiff_xmp_beyond_the_end_of_the_file(tmp_path):
+    data = tiff("<", packet.encode())
+    path = write(tmp_path, "IMG_00001.tif", data[:-10])
+    assert embedded_xmp.read_embedded_xmp(path) is None
+
+
+def test_packet_that_is_not_xmp(tmp_path):
+    path = write(tmp_path, "IMG_00001.tif", tiff("<", b"<html></html>"))
+    assert embedded_xmp.read_embedded_xmp(path) is None
+
+
+def test_other_app1_segments_are_skipped(tmp_path):
+    other = segment(0xE1, b"http://example.com/other\x00" + packet.encode())
+    path = write(tmp_path, "IMG_00001.jpg", jpeg(other))
+    assert embedded_xmp.read_embedded_xmp(path) == ""
+
+
+def test_packet_that_is_not_utf8(tmp_path):
+    xmp = embedded_xmp.xmp_signature + b"<x:xmpmeta \xff\xfe>"
+    path = write(tmp_path, "IMG_00001.jpg", jpeg(segment(0xE1, xmp)))
+    assert embedded_xmp.read_embedded_xmp(path) is None
+
+
+@pytest.mark.skipif(shutil.which("exiftool") is None, reason="needs exiftool")
+@pytest.mark.parametrize(
+    "name, data",
+    [
+        ("IMG_00001.jpg", jpeg(exif_segment(), xmp_segment())),
+        ("IMG_00002.tif", tiff("<", packet.encode())),
+        ("IMG_00003.tif", tiff(">", packet.encode())),
+    ],
+)
+def test_same_packet_as_exiftool(tmp_path, name, data):
+    path = write(tmp_path, name, data)
+    expected = subprocess.run(
+        ["exiftool", "-xmp", "-b", path.as_posix()], capture_output=True, check=True
+    ).stdout.decode("utf-8")
+    assert embedded_xmp.read_embedded_xmp(path) == expected
@@ -0,0 +1,187 @@
+import json
+import pathlib
+import sys
+
+import pytest
+from PIL import Image
+
+repo_path = pathlib.Path(__file__).resolve().parents[1]
+
+
+class FakeExifTool:
+    """Answers the xmp requests of xmp_editing_utils for sidecars, which are read
+    with exiftool. The images of the tests are read from their header."""
+
+    def execute(self, *args):
+        files = [a for a in args if a.endswith(".xmp")]
+        if "-j" in args:
+            return json.dumps(
+                [{"SourceFile": f, "XMP": pathlib.Path(f).read_text()} for f in files]
+            )
+        return pathlib.Path(files[0]).read_text()
+
+
+@pytest.fixture(scope="module")
+def extract_xmp(tmp_path_factory):
+    # extract_xmp loads untracked/config.yml on import, like in the benchmark
+    workspace = tmp_path_factory.mktemp("workspace")
+    untracked = pathlib.Path(workspace, "untracked")
+    untracked.mkdir()
+    config_data = {
+        "root_path": pathlib.Path(workspace, "library").as_posix(),
+        "update_file": True,
+        "catalog_file": "test.lrcat",
+        "RootFolderName": "test",
+    }
+    with open(pathlib.Path(untracked, "config.yml"), "w") as f:
+        json.dump(config_data, f)
+    sys.path[:0] = [str(workspace), str(repo_path)]
+    import extract_xmp
+
+    return extract_xmp
+
+
+@pytest.fixture
+def library(extract_xmp):
+    root_path = extract_xmp.root_path
+    folder = pathlib.Path(root_path, "2021")
+    folder.mkdir(parents=True, exist_ok=True)
+    for path in folder.iterdir():
+        path.unlink()
+    return folder
+
+
+def develop_data(extract_xmp, processtext):
+    return extract_xmp.lightroom_catalog.DevelopData(None, "11.0", processtext)
+
+
+@pytest.mark.parametrize("existing_sidecar", [True, False])
+def test_rows_sharing_a_sidecar_keep_both_settings(
+    extract_xmp, library, monkeypatch, existing_sidecar
+):
+    image = Image.new("RGB", (8, 8))
+    image.save(pathlib.Path(library, "IMG_00001.jpg"))
+    image.save(pathlib.Path(library, "IMG_00001.tif"))
+    sidecar = pathlib.Path(library, "IMG_00001.xmp")
+    if existing_sidecar:
+        sidecar.write_text(
+            extract_xmp.xmp_packet.serialize_packet({"Xmp.xmp.Rating": "3"})
+        )
+
+    rows = [
+        extract_xmp.lightroom_catalog.CatalogRow(
+            1, "test", "2021/", "IMG_00001", "jpg"
+        ),
+        extract_xmp.lightroom_catalog.CatalogRow(
+            2, "test", "2021/", "IMG_00001", "tif"
+        ),
+    ]
+    settings = {
+        1: develop_data(extract_xmp, "s = { Exposure2012 = 0.7,\n}\n"),
+        2: develop_data(extract_xmp, "s = { Clarity2012 = 10,\n}\n"),
+    }
+    monkeypatch.setattr(
+        extract_xmp.lightroom_catalog,
+        "fetch_develop_data",
+        lambda cnx, image_id: settings[image_id],
+    )
+
+    folder = extract_xmp.library_scanner.scan_folder(library)
+    batch = [
+        (i, row, extract_xmp.resolve_row_files(row, folder))
+        for i, row in enumerate(rows)
+    ]
+    states, _, _ = extract_xmp.process_rows(batch, et=FakeExifTool(), cnx=None)
+
+    assert [state.outcome for state in states] == ["ok", "ok"]
+    xmp_dict = extract_xmp.xmp_packet.parse_packet(sidecar.read_text())
+    assert xmp_dict["Xmp.crs.Exposure2012"] == "0.7"
+    assert xmp_dict["Xmp.crs.Clarity2012"] == "10"
+    if existing_sidecar:
+        assert xmp_dict["Xmp.xmp.Rating"] == "3"
+
+
+def test_row_without_image_does_not_create_the_shared_sidecar(
+    extract_xmp, library, monkeypatch
+):
+    Image.new("RGB", (8, 8)).save(pathlib.Path(library, "IMG_00001.tif"))
+    sidecar = pathlib.Path(library, "IMG_00001.xmp")
+    rows = [
+        extract_xmp.lightroom_catalog.CatalogRow(
+            1, "test", "2021/", "IMG_00001", "jpg"
+        ),
+        extract_xmp.lightroom_catalog.CatalogRow(
+            2, "test", "2021/", "IMG_00001", "tif"
+        ),
+    ]
+    monkeypatch.setattr(
+        extract_xmp.lightroom_catalog,
+        "fetch_develop_data",
+        lambda cnx, image_id: develop_data(extract_xmp, "s = { Clarity2012 = 10,\n}\n"),
+    )
+
+    folder = extract_xmp.library_scanner.scan_folder(library)
+    files = [extract_xmp.resolve_row_files(row, folder) for row in rows]
+    assert not extract_xmp.process_file(rows[0], et=None, cnx=None, files=files[0])
+    assert not sidecar.exists()
+
+    batch = [(i, row, row_files) for i, (row, row_files) in enumerate(zip(rows, files))]
+    states, _, _ = extract_xmp.process_rows(batch, et=FakeExifTool(), cnx=None)
+
+    assert [state.outcome for state in states] == ["missing", "ok"]
+    xmp_dict = extract_xmp.xmp_packet.parse_packet(sidecar.read_text())
+    assert xmp_dict["Xmp.crs.Clarity2012"] == "10"
+
+
+def test_rows_are_processed_again_when_the_settings_change(
+    extract_xmp, library, monkeypatch, tmp_path
+):
+    Image.new("RGB", (8, 8)).save(pathlib.Path(library, "IMG_00001.jpg"))
+    row = extract_xmp.lightroom_catalog.CatalogRow(
+        1, "test", "2021/", "IMG_00001", "jpg"
+    )
+    monkeypatch.setattr(
+        extract_xmp.lightroom_catalog,
+        "fetch_develop_data",
+        lambda cnx, image_id: develop_data(extract_xmp, "s = { Clarity2012 = 10,\n}\n"),
+    )
+    state = extract_xmp.migration_state.StateStore(pathlib.Path(tmp_path, "state"))
+
+    def run():
+        folder = extract_xmp.library_scanner.scan_folder(library)
+        batch = [(0, row, extract_xmp.resolve_row_files(row, folder))]
+        states, skipped, _ = extract_xmp.process_rows(
+            batch, et=FakeExifTool(), cnx=None, state=state
+        )
+        state.record(states)
+        return skipped
+
+    assert run() == 0
+    assert run() == 1
+    monkeypatch.setattr(extract_xmp, "settings_hash", "other tags")
+    assert run() == 0
+    assert state.counts() == {"ok": 1}
+    state.close()
+
+
+def test_lua_tables_are_written_as_xmp(extract_xmp):
+    data = extract_xmp.lightroom_settings.decode(
+        '{ RetouchInfo = {}, Look = { Name = "Adobe Color", Amount = 1, },'
+        " ToneCurvePV2012 = { 0, 0, 255, 255, },"
+        ' GradientBasedCorrections = { { What = "Correction", Exposure = -0.5, }, }, }'
+    )
+    xmp_dict = {
+        f"Xmp.crs.{k}": extract_xmp.to_xmp_value(f"Xmp.crs.{k}", v)
+        for k, v in data.items()
+    }
+    packet = extract_xmp.xmp_packet.serialize_packet(xmp_dict)
+
+    assert "Adobe Color" in packet and "{" not in packet
+    assert extract_xmp.xmp_packet.parse_packet(packet) == {
+        "Xmp.crs.RetouchInfo": [],
+        "Xmp.crs.Look": {"Xmp.crs.Name": "Adobe Color", "Xmp.crs.Amount": "1"},
+        "Xmp.crs.ToneCurvePV2012": ["0, 0", "255, 255"],
+        "Xmp.crs.GradientBasedCorrections": [
+            {"Xmp.crs.What": "Correction", "Xmp.crs.Exposure": "-0.5"}
+        ],
+    }
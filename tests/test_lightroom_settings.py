@@ -0,0 +1,109 @@
+import pathlib
+import sys
+
+import pytest
+from slpp import slpp as lua
+
+repo_path = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(repo_path))
+
+import lightroom_settings  # noqa: E402
+
+
+# develop settings as Lightroom Classic stores them, after the leading "s = "
+develop_settings = [
+    """{ AutoLateralCA = 0,
+	Blacks2012 = -12,
+	CameraProfile = "Adobe Standard",
+	Clarity2012 = 15,
+	Exposure2012 = 0.35,
+	HasSettings = true,
+	LensProfileEnable = 1,
+	ProcessVersion = "11.0",
+	RetouchInfo = {},
+	Temperature = 5150,
+	ToneCurveName2012 = "Linear",
+	ToneCurvePV2012 = { 0, 0, 64, 60, 192, 200, 255, 255, },
+	WhiteBalance = "As Shot",
+}
+""",
+    """{ CropAngle = -1.25,
+	CropBottom = 0.951234,
+	CropConstrainToWarp = 0,
+	CropLeft = 0.012,
+	CropRight = 0.987,
+	CropTop = 0.0405,
+	GradientBasedCorrections = { { CorrectionAmount = 1,
+			CorrectionMasks = { { FullX = 0.5, FullY = 0.9, What = "Mask/Gradient", ZeroX = 0.5, ZeroY = 0.6, }, },
+			LocalExposure2012 = -0.45,
+			What = "Correction", }, },
+	Look = { Amount = 1,
+		Name = "Adobe Color",
+		Parameters = { ConvertToGrayscale = false, ProcessVersion = "11.0", Version = "14.0", }, },
+	PostCropVignetteAmount = -12,
+	ToneCurve = { 0, 0, 32, 22, 64, 56, 128, 128, 192, 196, 255, 255, },
+}
+""",
+    """{ PaintBasedCorrections = { { CorrectionAmount = 1,
+			CorrectionMasks = { { Dabs = { "d 0.412 0.389", "d 0.418 0.391", },
+					Flow = 1, Radius = 0.0625, What = "Mask/Paint", }, },
+			LocalSaturation = -0.3, What = "Correction", }, },
+	RetouchAreas = { { Masks = { { Flipped = false, Radius = 0.01, What = "Mask/Circle", }, },
+			Method = "heal", SourceState = "sourceAutoComputed", }, },
+	Description = "edit \\"b\\" [[kept]]",
+	SplitToningBalance = 0,
+	Nothing = nil,
+	SharpenRadius = 1.0,
+	Shadows2012 = 25;
+	Whites2012 = 10 }
+""",
+]
+
+settings_ids = ["basic", "crop and gradient", "paint and retouch"]
+
+
+@pytest.mark.parametrize("text", develop_settings, ids=settings_ids)
+def test_decode_matches_slpp(text):
+    assert lightroom_settings.decode(text) == lua.decode(text)
+
+
+@pytest.mark.parametrize("text", develop_settings, ids=settings_ids)
+def test_decode_keys_matches_slpp(text):
+    keys = frozenset({"Exposure2012", "ToneCurvePV2012", "Look", "Shadows2012"})
+    expected = {k: v for k, v in lua.decode(text).items() if k in keys}
+    assert lightroom_settings.decode(text, keys=keys) == expected
+
+
+def test_decode_numbers():
+    data = lightroom_settings.decode(
+        "{ a = 010, b = -007, c = 0.5, d = -1.5e+3, e = 0x1F, f = 0, g = 25 }"
+    )
+    assert data == {"a": 10, "b": -7, "c": 0.5, "d": -1500.0, "e": 31, "f": 0, "g": 25}
+    assert [type(data[k]) for k in "abcdefg"] == [int, int, float, float, int, int, int]
+
+
+def test_decode_tables():
+    assert lightroom_settings.decode("{}") == {}
+    assert lightroom_settings.decode('{ "x", "y", Key = 3 }') == {
+        0: "x",
+        1: "y",
+        "Key": 3,
+    }
+    assert lightroom_settings.decode("{ Long = [[two\nlines]], Deep = {{{1}}} }") == {
+        "Long": "two\nlines",
+        "Deep": [[[1]]],
+    }
+
+
+def test_decode_cached_returns_a_new_dict():
+    keys = frozenset({"Exposure2012"})
+    first = lightroom_settings.decode_cached(develop_settings[0], keys)
+    first["Exposure2012"] = 1
+    second = lightroom_settings.decode_cached(develop_settings[0], keys)
+    assert second == {"Exposure2012": 0.35}
+
+
+@pytest.mark.parametrize("text", ["{ a = 1", "{ a = }", "{ a = 1 } b", "a = 1"])
+def test_decode_errors(text):
+    with pytest.raises(ValueError):
+        lightroom_settings.decode(text)
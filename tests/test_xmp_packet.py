@@ -0,0 +1,173 @@
+import pathlib
+import sys
+
+import pytest
+
+repo_path = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(repo_path))
+
+import xmp_packet  # noqa: E402
+from xmp_packet import XmpArray  # noqa: E402
+from xmp_packet import XmpLangAlt  # noqa: E402
+from xmp_packet import XmpResource  # noqa: E402
+from xmp_packet import XmpStruct  # noqa: E402
+
+
+# a sidecar as written by Lightroom, with the value types found in the wild
+sidecar = """<?xpacket begin="﻿" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/" x:xmptk="Adobe XMP Core 7.0-c000">
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:about=""
+    xmlns:xmp="http://ns.adobe.com/xap/1.0/"
+    xmlns:tiff="http://ns.adobe.com/tiff/1.0/"
+    xmlns:dc="http://purl.org/dc/elements/1.1/"
+    xmlns:crs="http://ns.adobe.com/camera-raw-settings/1.0/"
+    xmlns:xmpMM="http://ns.adobe.com/xap/1.0/mm/"
+    xmlns:stEvt="http://ns.adobe.com/xap/1.0/sType/ResourceEvent#"
+    xmlns:xmpRights="http://ns.adobe.com/xap/1.0/rights/"
+    xmlns:scan="http://example.com/scan/1.0/"
+    tiff:Orientation="6"
+    xmp:Rating="3"
+    crs:Exposure2012="+0.35"
+    scan:Slide="A &amp; B &quot;12&quot;">
+   <dc:subject>
+    <rdf:Bag>
+     <rdf:li>slide</rdf:li>
+     <rdf:li>no_mirror</rdf:li>
+    </rdf:Bag>
+   </dc:subject>
+   <dc:creator>
+    <rdf:Seq>
+     <rdf:li>Someone</rdf:li>
+    </rdf:Seq>
+   </dc:creator>
+   <dc:title>
+    <rdf:Alt>
+     <rdf:li xml:lang="x-default">Beach &lt;1975&gt;</rdf:li>
+     <rdf:li xml:lang="de-DE">Strand</rdf:li>
+    </rdf:Alt>
+   </dc:title>
+   <crs:ToneCurvePV2012>
+    <rdf:Seq>
+     <rdf:li>0, 0</rdf:li>
+     <rdf:li>255, 255</rdf:li>
+    </rdf:Seq>
+   </crs:ToneCurvePV2012>
+   <crs:Look rdf:parseType="Resource">
+    <crs:Name>Adobe Color</crs:Name>
+    <crs:Parameters crs:Version="14.0" crs:ConvertToGrayscale="False"/>
+   </crs:Look>
+   <xmpMM:History>
+    <rdf:Seq>
+     <rdf:li rdf:parseType="Resource">
+      <stEvt:action>saved</stEvt:action>
+      <stEvt:when>2021-03-01T10:00:00</stEvt:when>
+     </rdf:li>
+     <rdf:li stEvt:action="derived" stEvt:parameters="converted"/>
+    </rdf:Seq>
+   </xmpMM:History>
+   <xmpRights:WebStatement rdf:resource="https://example.com/license"/>
+  </rdf:Description>
+ </rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>"""
+
+
+def test_parse_packet():
+    xmp_dict = xmp_packet.parse_packet(sidecar)
+    scan = xmp_packet.register_namespace("http://example.com/scan/1.0/", "scan")
+
+    assert xmp_dict["Xmp.tiff.Orientation"] == "6"
+    assert xmp_dict["Xmp.crs.Exposure2012"] == "+0.35"
+    assert xmp_dict[f"Xmp.{scan}.Slide"] == 'A & B "12"'
+    assert xmp_dict["Xmp.dc.subject"] == XmpArray("Bag", ["slide", "no_mirror"])
+    assert xmp_dict["Xmp.dc.creator"] == XmpArray("Seq", ["Someone"])
+    assert xmp_dict["Xmp.dc.title"] == XmpLangAlt(
+        {"x-default": "Beach <1975>", "de-DE": "Strand"}
+    )
+    assert xmp_dict["Xmp.crs.Look"] == XmpStruct(
+        {
+            "Xmp.crs.Name": "Adobe Color",
+            "Xmp.crs.Parameters": {
+                "Xmp.crs.Version": "14.0",
+                "Xmp.crs.ConvertToGrayscale": "False",
+            },
+        }
+    )
+    assert xmp_dict["Xmp.xmpMM.History"] == [
+        {"Xmp.stEvt.action": "saved", "Xmp.stEvt.when": "2021-03-01T10:00:00"},
+        {"Xmp.stEvt.action": "derived", "Xmp.stEvt.parameters": "converted"},
+    ]
+    assert xmp_dict["Xmp.xmpRights.WebStatement"] == "https://example.com/license"
+    assert isinstance(xmp_dict["Xmp.xmpRights.WebStatement"], XmpResource)
+
+
+def test_round_trip():
+    xmp_dict = xmp_packet.parse_packet(sidecar)
+    packet = xmp_packet.serialize_packet(xmp_dict)
+
+    assert xmp_packet.parse_packet(packet) == xmp_dict
+    assert xmp_packet.serialize_packet(xmp_packet.parse_packet(packet)) == packet
+    assert (
+        '<xmpRights:WebStatement rdf:resource="https://example.com/license"/>' in packet
+    )
+    assert "<dc:subject>\n    <rdf:Bag>" in packet
+    assert '<rdf:li xml:lang="de-DE">Strand</rdf:li>' in packet
+
+
+def test_round_trip_keeps_array_kinds():
+    for kind in ("Seq", "Bag", "Alt"):
+        xmp_dict = {"Xmp.dc.subject": XmpArray(kind, ["a", "b"])}
+        parsed = xmp_packet.parse_packet(xmp_packet.serialize_packet(xmp_dict))
+        assert parsed["Xmp.dc.subject"].kind == kind
+        assert parsed == xmp_dict
+
+
+def test_serialize_plain_values():
+    xmp_dict = {
+        "Xmp.crs.HasCrop": True,
+        "Xmp.crs.CropTop": 0.125,
+        "Xmp.tiff.ImageWidth": 1200,
+        "Xmp.dc.description": "line one\nline two",
+        "Xmp.xmp.Label": None,
+        "Xmp.crs.RetouchInfo": [],
+        "Xmp.crs.Look": {"Xmp.crs.Name": "Adobe Color"},
+        "Xmp.crs.Empty": XmpStruct(),
+    }
+    parsed = xmp_packet.parse_packet(xmp_packet.serialize_packet(xmp_dict))
+
+    assert parsed == {
+        "Xmp.crs.HasCrop": "True",
+        "Xmp.crs.CropTop": "0.125",
+        "Xmp.tiff.ImageWidth": "1200",
+        "Xmp.dc.description": "line one\nline two",
+        "Xmp.crs.RetouchInfo": XmpArray("Seq"),
+        "Xmp.crs.Look": {"Xmp.crs.Name": "Adobe Color"},
+        "Xmp.crs.Empty": {},
+    }
+
+
+def test_serialize_rejects_fields_without_namespace():
+    # a lua table that was not converted to XMP keys
+    with pytest.raises(ValueError):
+        xmp_packet.serialize_packet({"Xmp.crs.Look": {"Name": "Adobe Color"}})
+
+
+def test_parse_empty_packet():
+    assert xmp_packet.parse_packet("") == {}
+    assert xmp_packet.parse_packet("\x00\x00") == {}
+
+
+def test_read_properties(tmp_path):
+    path = pathlib.Path(tmp_path, "IMG_00001.xmp")
+    path.write_text(sidecar, encoding="utf-8")
+
+    properties = xmp_packet.read_properties(
+        path,
+        ["Xmp.dc.subject", "Xmp.tiff.Orientation", "Xmp.darktable.history_end"],
+        chunk_size=64,
+    )
+    assert properties == {
+        "Xmp.dc.subject": XmpArray("Bag", ["slide", "no_mirror"]),
+        "Xmp.tiff.Orientation": "6",
+    }
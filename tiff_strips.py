@@ -0,0 +1,266 @@
+import math
+import struct
+
+import cv2
+import numpy as np
+
+
+# Crop detection for large uncompressed TIFF scans without loading them. Only
+# striped files are read this way, tiled ones are loaded whole. The strips are read
+# in bands of rows, and only per row and per column results are kept: the largest
+# gray value of every row and column after blurring, a gray level histogram, and
+# the column sums of each band for the mean color outside of a crop. Besides the
+# band being read, memory grows with the image height only through those column
+# sums, 8 bytes per column and band (1/192 of the file size for 16-bit RGB with
+# bands of 256 rows). 16-bit data is used as is, with the 8-bit thresholds scaled
+# to it.
+
+# tag: name of the baseline tags used
+tags = {
+    256: "width",
+    257: "height",
+    258: "bits",
+    259: "compression",
+    262: "photometric",
+    273: "strip_offsets",
+    274: "orientation",
+    277: "samples",
+    278: "rows_per_strip",
+    279: "strip_byte_counts",
+    284: "planar",
+    322: "tile_width",
+    339: "sample_format",
+}
+
+# field type: struct format of one value
+field_formats = {1: "B", 3: "H", 4: "I", 16: "Q"}
+
+
+def read_layout(path) -> dict | None:
+    """Size and strips of the first image of an uncompressed 8 or 16-bit gray or RGB
+    TIFF, None for any other file."""
+    with open(path, "rb") as f:
+        header = f.read(16)
+        if header[:2] == b"II":
+            order = "<"
+        elif header[:2] == b"MM":
+            order = ">"
+        else:
+            return None
+        version = struct.unpack(order + "H", header[2:4])[0]
+        if version == 42:
+            offset = struct.unpack(order + "I", header[4:8])[0]
+            count_format, entry_format, offset_format = "H", "HHI4s", "I"
+        elif version == 43:
+            offset = struct.unpack(order + "Q", header[8:16])[0]
+            count_format, entry_format, offset_format = "Q", "HHQ8s", "Q"
+        else:
+            return None
+
+        f.seek(offset)
+        count_size = struct.calcsize(count_format)
+        (count,) = struct.unpack(order + count_format, f.read(count_size))
+        entry_size = struct.calcsize(order + entry_format)
+        entries = f.read(count * entry_size)
+
+        fields = {}
+        for i in range(count):
+            tag, kind, n, value = struct.unpack_from(
+                order + entry_format, entries, i * entry_size
+            )
+            if tag not in tags or kind not in field_formats:
+                continue
+            value_format = order + field_formats[kind] * n
+            size = struct.calcsize(value_format)
+            if size <= len(value):
+                data = value[:size]
+            else:
+                f.seek(struct.unpack(order + offset_format, value)[0])
+                data = f.read(size)
+            fields[tags[tag]] = struct.unpack(value_format, data)
+
+    try:
+        width, height = fields["width"][0], fields["height"][0]
+        offsets, byte_counts = fields["strip_offsets"], fields["strip_byte_counts"]
+    except KeyError:
+        return None
+    samples = fields.get("samples", (1,))[0]
+    bits = set(fields.get("bits", (1,)))
+    photometric = fields.get("photometric", (None,))[0]
+    if (
+        len(bits) != 1
+        or not bits <= {8, 16}
+        or fields.get("compression", (1,))[0] != 1
+        or fields.get("orientation", (1,))[0] != 1
+        or set(fields.get("sample_format", (1,))) != {1}
+        or "tile_width" in fields
+        or (samples > 1 and fields.get("planar", (1,))[0] != 1)
+        or not (photometric == 1 or (photometric == 2 and samples >= 3))
+    ):
+        return None
+
+    dtype = np.dtype(np.uint8 if bits == {8} else np.uint16).newbyteorder(order)
+    row_bytes = width * samples * dtype.itemsize
+    rows_per_strip = min(fields.get("rows_per_strip", (height,))[0], height)
+    if len(offsets) != len(byte_counts) or len(offsets) < math.ceil(
+        height / rows_per_strip
+    ):
+        return None
+    for strip, byte_count in enumerate(
+        byte_counts[: math.ceil(height / rows_per_strip)]
+    ):
+        rows = min(rows_per_strip, height - strip * rows_per_strip)
+        if byte_count < rows * row_bytes:
+            return None
+
+    return {
+        "width": width,
+        "height": height,
+        "samples": samples,
+        "channels": 3 if photometric == 2 else 1,
+        "dtype": dtype,
+        "row_bytes": row_bytes,
+        "rows_per_strip": rows_per_strip,
+        "strip_offsets": offsets,
+    }
+
+
+def read_rows(f, layout: dict, start: int, stop: int) -> np.ndarray:
+    """Rows start to stop of the image as an array of (rows, width, samples)."""
+    row_bytes, rows_per_strip = layout["row_bytes"], layout["rows_per_strip"]
+    buffer = bytearray((stop - start) * row_bytes)
+    view = memoryview(buffer)
+    row = start
+    while row < stop:
+        strip, first = divmod(row, rows_per_strip)
+        n = min(rows_per_strip - first, stop - row)
+        f.seek(layout["strip_offsets"][strip] + first * row_bytes)
+        target = view[(row - start) * row_bytes : (row - start + n) * row_bytes]
+        if f.readinto(target) != len(target):
+            raise OSError(f"TIFF strip {strip} is truncated")
+        row += n
+    return np.frombuffer(buffer, dtype=layout["dtype"]).reshape(
+        stop - start, layout["width"], layout["samples"]
+    )
+
+
+class TiffCropScan:
+    """Bounding boxes of a TIFF image at any threshold (on the 8-bit scale), from a
+    single pass over its strips that keeps the largest blurred gray value of every
+    row and column. The gray values are blurred with a true Gaussian of sigma
+    blur_radius, unlike decoded images, whose RGB values get PIL's box blur
+    approximation before the gray conversion, so a bounding box can differ from
+    theirs by a pixel or so at the edges. The gray level histogram of the image
+    gives its Otsu threshold like for decoded images.
+    With preview_size, a copy of the image reduced to fit in it is kept."""
+
+    def __init__(
+        self,
+        path,
+        layout: dict,
+        blur_radius: float,
+        band_rows: int = 256,
+        preview_size: int | None = None,
+    ):
+        self.path = path
+        self.layout = layout
+        self.width, self.height = layout["width"], layout["height"]
+        self.band_rows = band_rows
+        self.scale = 257 if layout["dtype"].itemsize == 2 else 1
+        self.row_max = np.zeros(self.height, dtype=np.float32)
+        self.col_max = np.zeros(self.width, dtype=np.float32)
+        self.histogram = np.zeros(256, dtype=np.int64)
+        self.preview = None
+        self._column_sums = []
+
+        step = None
+        if preview_size:
+            step = max(1, math.ceil(max(self.width, self.height) / preview_size))
+        with open(path, "rb") as f:
+            self._scan(f, blur_radius, step)
+
+    def _gray(self, band: np.ndarray) -> np.ndarray:
+        if self.layout["channels"] == 1:
+            return band[..., 0].astype(np.float32)
+        red, green, blue = (band[..., i].astype(np.float32) for i in range(3))
+        return 0.299 * red + 0.587 * green + 0.114 * blue
+
+    def _scan(self, f, blur_radius: float, step: int | None) -> None:
+        height, band_rows = self.height, self.band_rows
+        channels = self.layout["channels"]
+        # rows above and below a band that the blur reaches into it
+        margin = 4 * math.ceil(blur_radius) + 1 if blur_radius > 0 else 0
+        preview_rows = []
+
+        for start in range(0, height, band_rows):
+            stop = min(start + band_rows, height)
+            top, bottom = max(start - margin, 0), min(stop + margin, height)
+            band = read_rows(f, self.layout, top, bottom)
+            gray = self._gray(band)
+            # of the gray values before blurring, as for decoded images
+            levels = np.rint(gray[start - top : stop - top] / self.scale)
+            self.histogram += np.bincount(
+                levels.astype(np.uint8).ravel(), minlength=256
+            )
+            del levels
+            if margin:
+                gray = cv2.GaussianBlur(
+                    gray, (0, 0), blur_radius, borderType=cv2.BORDER_REPLICATE
+                )
+            gray = gray[start - top : stop - top]
+            self.row_max[start:stop] = gray.max(axis=1)
+            np.maximum(self.col_max, gray.max(axis=0), out=self.col_max)
+
+            core = band[start - top : stop - top, :, :channels]
+            self._column_sums.append(core.sum(axis=(0, 2), dtype=np.uint64))
+            if step:
+                first = -start % step
+                preview_rows.append(core[first::step, ::step].copy())
+
+        if step:
+            preview = np.concatenate(preview_rows)
+            preview = (preview // self.scale).astype(np.uint8)
+            if channels == 1:
+                preview = cv2.cvtColor(preview, cv2.COLOR_GRAY2RGB)
+            self.preview = np.ascontiguousarray(preview)
+
+    def bbox(self, threshold: float):
+        """Bounding box (left, top, right, bottom) of the area that is brighter than
+        threshold after blurring, None if there is none."""
+        rows = np.flatnonzero(self.row_max > threshold * self.scale)
+        cols = np.flatnonzero(self.col_max > threshold * self.scale)
+        if not len(rows) or not len(cols):
+            return None
+        return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+    def _rect_sum(self, f, top: int, bottom: int, left: int, right: int) -> int:
+        """Sum of the channels over rows top to bottom and columns left to right.
+        Bands entirely inside come from the column sums, the others are read."""
+        total = 0
+        band_rows, channels = self.band_rows, self.layout["channels"]
+        for band in range(top // band_rows, (bottom - 1) // band_rows + 1):
+            start = band * band_rows
+            stop = min(start + band_rows, self.height)
+            if top <= start and stop <= bottom:
+                total += int(self._column_sums[band][left:right].sum())
+            else:
+                rows = read_rows(f, self.layout, max(start, top), min(stop, bottom))
+                total += int(rows[:, left:right, :channels].sum(dtype=np.uint64))
+        return total
+
+    def outside_mean(self, bbox) -> float:
+        """Mean color value outside of the bounding box on the 8-bit scale, taking the
+        bounding box as inclusive of its right and bottom edge like control_value."""
+        top, left = min(max(bbox[1], 0), self.height), min(max(bbox[0], 0), self.width)
+        bottom = max(min(bbox[3] + 1, self.height), top)
+        right = max(min(bbox[2] + 1, self.width), left)
+        count = self.width * self.height - (bottom - top) * (right - left)
+        if count == 0:
+            return 0.0
+        total = sum(int(s.sum()) for s in self._column_sums)
+        inside = 0
+        if bottom > top and right > left:
+            with open(self.path, "rb") as f:
+                inside = self._rect_sum(f, top, bottom, left, right)
+        channels = self.layout["channels"]
+        return round((total - inside) / count / channels / self.scale, 2)
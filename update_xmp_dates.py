@@ -1,7 +1,6 @@
 import os
 import re
 import pyexiv2
-import glob
 from pathlib import Path
 import logzero
 from logzero import logger
@@ -9,6 +8,10 @@ import importlib.resources
 import yaml
 import datetime
 
+import library_scanner
+import sidecar_writer
+import xmp_packet
+
 logzero.logfile("update_xmp_logfile.log", maxBytes=1e8, backupCount=3)
 
 # Goals
@@ -36,19 +39,21 @@ SKIP_FIELDS = [
 EXPECTED_FIELDS = DATE_FIELDS + SKIP_FIELDS
 
 
-def update_xmp_dates(directory: Path, dry_run: bool = True):
-    xmp_files = find_xmp_files(directory)
+def update_xmp_dates(directory: Path, dry_run: bool = True, index_file=None):
+    xmp_files = find_xmp_files(directory, index_file=index_file)
+    writer = sidecar_writer.SidecarWriter()
     for file in xmp_files:
         file = Path(file)
         date = get_date_from_path(file)
         if date:
-            update_xmp_date(file=file, date=date, dry_run=dry_run)
+            update_xmp_date(file=file, date=date, dry_run=dry_run, writer=writer)
+    if not dry_run:
+        writer.log_summary()
 
 
-def find_xmp_files(directory: Path) -> list[str]:
-    xmp_files = glob.glob(os.path.join(directory, "**/*.xmp"), recursive=True)
-    xmp_files2 = glob.glob(os.path.join(directory, "**/*.XMP"), recursive=True)
-    return xmp_files + xmp_files2
+def find_xmp_files(directory: Path, index_file=None) -> list[str]:
+    library = library_scanner.scan_library(directory, index_file=index_file)
+    return [str(file) for file in library.sidecars()]
 
 
 def get_date_from_path(file: Path):
@@ -65,9 +70,14 @@ def get_date_from_path(file: Path):
     return None
 
 
-def update_xmp_date(file: Path, date: tuple, dry_run: bool):
-    with pyexiv2.Image(file.as_posix()) as xmp_file:
-        xmp_data = xmp_file.read_xmp()
+def update_xmp_date(
+    file: Path,
+    date: tuple,
+    dry_run: bool,
+    writer: sidecar_writer.SidecarWriter | None = None,
+):
+    existing = sidecar_writer.read_sidecar(file)
+    xmp_data = xmp_packet.parse_packet(existing)
     parsed_time = None
 
     # get all date fields:
@@ -123,9 +133,11 @@ def update_xmp_date(file: Path, date: tuple, dry_run: bool):
     logger.info(f"Before: {time}, After: {new_date_string}")
 
     if not dry_run:
-        # write metadata
-        with pyexiv2.Image(file.as_posix()) as xmp_file:
-            xmp_data = xmp_file.modify_xmp(metadata_update)
+        # write metadata, files that already have these dates are not touched
+        if writer is None:
+            writer = sidecar_writer.SidecarWriter()
+        xmp_data.update(metadata_update)
+        writer.write(file, xmp_data, existing=existing)
 
 
 def combine_date_and_time(date: tuple[int, int, int], time) -> str:
@@ -152,4 +164,8 @@ if config_data.get("dry_run") is not None:
 else:
     dry_run = True
 
-update_xmp_dates(root_path, dry_run=dry_run)
+library_index = config_data.get("library_index", "library_index.json")
+if library_index is not None:
+    library_index = importlib.resources.files("untracked").joinpath(library_index)
+
+update_xmp_dates(root_path, dry_run=dry_run, index_file=library_index)
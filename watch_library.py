@@ -0,0 +1,220 @@
+import pathlib
+import queue
+import threading
+import time
+
+import logzero
+from logzero import logger
+
+import check_xmp
+import crop_cache
+import file_watcher
+import generate_crop_xmp
+import library_scanner
+import sidecar_writer
+import xmp_editing_utils
+
+
+logzero.logfile("watch_rotating_logfile.log", maxBytes=1e8, backupCount=3)
+
+# the watch is configured in crop_config.yml, with the crop detection and checks
+config_data = generate_crop_xmp.config_data
+root_path = generate_crop_xmp.root_path
+
+# seconds a file must be left alone after it was written before it is processed
+settle_seconds = config_data.get("watch_settle_seconds", 2)
+# files waiting to be processed, settled files are held back while it is full
+watch_queue_size = config_data.get("watch_queue_size", 100)
+# settled files held back at most, further ones are left to the next full run
+watch_backlog_size = config_data.get("watch_backlog_size", 10000)
+# files processed together at most, with one crop run
+watch_batch_size = config_data.get(
+    "watch_batch_size", 2 * generate_crop_xmp.cpu_workers
+)
+
+supported_files = set.union(
+    set(xmp_editing_utils.raw_files), set(xmp_editing_utils.other_files)
+)
+
+
+def is_image(path: pathlib.Path) -> bool:
+    """Supported images outside of the folder of the debug images."""
+    if path.suffix.upper() not in supported_files:
+        return False
+    debug_path = generate_crop_xmp.debug_path
+    return debug_path is None or not path.is_relative_to(debug_path)
+
+
+def watch_folders(inotify: file_watcher.Inotify, folders) -> None:
+    for folder in folders:
+        try:
+            inotify.add_watch(folder)
+        except FileNotFoundError:
+            logger.debug(f"Folder {folder} was removed before it was watched")
+        except OSError as e:
+            logger.error(f"Could not watch {folder}: {e}")
+
+
+def watch_new_folder(
+    inotify: file_watcher.Inotify, folder: pathlib.Path
+) -> list[pathlib.Path]:
+    """Watch a folder that appeared and its subfolders, and return the images
+    already in them. Every folder is watched before it is listed, so a file
+    finished in between is listed, reported by an event or both."""
+    images = []
+    folders = [folder]
+    seen = set()
+    while folders:
+        folder = folders.pop()
+        watch_folders(inotify, [folder])
+        try:
+            listing, identity, _ = library_scanner.list_folder(str(folder), None)
+        except OSError as e:
+            logger.debug(f"Could not list {folder}: {e}")
+            continue
+        # folders reached twice through symbolic links are listed once
+        if identity in seen:
+            continue
+        seen.add(identity)
+        library = library_scanner.LibraryIndex({str(folder): listing})
+        images += [path for path in library.images(supported_files) if is_image(path)]
+        folders += [folder / name for name in listing["folders"]]
+    return images
+
+
+def process_batch(
+    batch: list[pathlib.Path],
+    writer: sidecar_writer.SidecarWriter,
+    cache: crop_cache.CropCache | None,
+) -> None:
+    """Detect and write the crop of the files, then check their sidecar."""
+    started = time.monotonic()
+    files = [path for path in dict.fromkeys(batch) if path.is_file()]
+    by_directory = {}
+    for filepath in files:
+        by_directory.setdefault(filepath.parent, []).append(filepath)
+    # the sidecars of the files, matched regardless of case
+    entries = {}
+    for directory, directory_files in by_directory.items():
+        folder = library_scanner.scan_folder(directory)
+        entries.update(
+            (filepath, folder.entry(filepath)) for filepath in directory_files
+        )
+    sidecars = {filepath: entry.sidecar for filepath, entry in entries.items()}
+
+    try:
+        generate_crop_xmp.run_pipeline(by_directory, writer, cache, sidecars)
+    except Exception as e:
+        logger.exception(f"Crop detection of {len(files)} files failed: {e}")
+        return
+    failed = 0
+    for filepath in files:
+        try:
+            # a sidecar created by the crop run is found at its expected path
+            failed += check_xmp.check_base_xmp_file(
+                filepath, mirror=check_xmp.mirror_config, entry=entries[filepath]
+            )
+        except Exception as e:
+            failed += 1
+            logger.error(f"Could not check {filepath}: {e}")
+
+    logger.info(
+        f"Processed {len(files)} files in {time.monotonic() - started:.1f}s, "
+        f"{failed} failed the check"
+    )
+    # nothing is summarised while watching, do not let the samples grow
+    generate_crop_xmp.metrics.snapshot(reset=True)
+
+
+def process_files(work: queue.Queue, stop: threading.Event) -> None:
+    """Take the files of work in batches until stop is set."""
+    cache = None
+    if generate_crop_xmp.use_crop_cache:
+        cache = crop_cache.CropCache(
+            generate_crop_xmp.crop_cache_file,
+            generate_crop_xmp.cache_params(),
+            max_entries=generate_crop_xmp.crop_cache_max_entries,
+        )
+    writer = sidecar_writer.SidecarWriter()
+    try:
+        while not stop.is_set():
+            try:
+                batch = [work.get(timeout=1)]
+            except queue.Empty:
+                continue
+            while len(batch) < watch_batch_size:
+                try:
+                    batch.append(work.get_nowait())
+                except queue.Empty:
+                    break
+            process_batch(batch, writer, cache)
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+def main():
+    library = library_scanner.scan_library(
+        root_path,
+        index_file=generate_crop_xmp.library_index,
+        workers=generate_crop_xmp.scan_workers,
+    )
+    inotify = file_watcher.Inotify()
+    watch_folders(inotify, library.folders)
+    logger.info(f"Watching {len(inotify.folders)} folders under {root_path}")
+
+    tracker = file_watcher.SettleTracker(settle_seconds)
+    work = queue.Queue(maxsize=watch_queue_size)
+    # settled files waiting for room in work, in the order they settled, at most
+    # watch_backlog_size
+    ready = {}
+    dropping = False
+    stop = threading.Event()
+    worker = threading.Thread(target=process_files, args=(work, stop))
+    worker.start()
+    try:
+        while worker.is_alive():
+            timeout = tracker.timeout()
+            if ready:
+                timeout = 1.0 if timeout is None else min(timeout, 1.0)
+            for event in inotify.read(timeout):
+                if event.path is None:
+                    logger.warning(
+                        "File events were lost, run generate_crop_xmp.py and "
+                        "check_xmp.py to process the files changed meanwhile"
+                    )
+                elif event.mask & file_watcher.IN_ISDIR:
+                    if event.mask & (file_watcher.IN_CREATE | file_watcher.IN_MOVED_TO):
+                        for path in watch_new_folder(inotify, event.path):
+                            tracker.update(path, file_watcher.IN_MOVED_TO)
+                elif is_image(event.path):
+                    tracker.update(event.path, event.mask)
+
+            for path in tracker.ready():
+                if path in ready or len(ready) < watch_backlog_size:
+                    ready[path] = None
+                elif not dropping:
+                    dropping = True
+                    logger.warning(
+                        f"More than {watch_backlog_size} files are waiting, run "
+                        "generate_crop_xmp.py and check_xmp.py to process the "
+                        "files left out"
+                    )
+            while ready and not work.full():
+                path = next(iter(ready))
+                del ready[path]
+                work.put_nowait(path)
+            if dropping and len(ready) < watch_backlog_size:
+                dropping = False
+        logger.error("Processing of the files stopped")
+    except KeyboardInterrupt:
+        logger.info("Stopping")
+    finally:
+        stop.set()
+        worker.join()
+        inotify.close()
+
+
+if __name__ == "__main__":
+    logger.info("Running main()")
+    main()
@@ -1,13 +1,14 @@
+import base64
+import contextlib
+import json
 import pathlib
+import queue
 
-import cv2
-import numpy as np
-import pyexiv2
 from exiftool import ExifTool
 from logzero import logger
-from PIL import Image
 from PIL import ImageDraw
-from PIL import ImageStat
+
+import embedded_xmp
 
 
 empty_xml = """<x:xmpmeta xmlns:x="adobe:ns:meta/" x:xmptk="XMP Core 5.5.0">
@@ -20,12 +21,14 @@ empty_xml = """<x:xmpmeta xmlns:x="adobe:ns:meta/" x:xmptk="XMP Core 5.5.0">
 </x:xmpmeta>"""
 
 
-def copy_xmp_temp(
+def read_xmp_packet(
     from_file: pathlib.PosixPath,
-    to_file: pathlib.PosixPath,
     et: ExifTool,
     warn: bool = False,
-):
+) -> str | None:
+    """Return the XMP packet of a file, or None if the file does not exist.
+    The packet of JPEG and TIFF based images is read from the file header, other
+    files are read with exiftool."""
 
     # exiftool implementation. Does not contain much error handling
     # will not raise an error if the file does not exist
@@ -34,44 +37,147 @@ def copy_xmp_temp(
             logger.warning(f"File {from_file} not found")
         else:
             logger.debug(f"File {from_file} not found")
-        return
+        return None
+
+    file_raw_xmp = embedded_xmp.read_embedded_xmp(from_file)
+    if file_raw_xmp is not None:
+        return _decode_packet(from_file, file_raw_xmp)
 
     # run exiftool command on file to return xmp string
     file_raw_xmp = et.execute(
         *["-xmp", "-b", str(from_file.as_posix()), "-api", "LargeFileSupport=1"]
     )
+    return _decode_packet(from_file, file_raw_xmp)
+
+
+def _decode_packet(from_file: pathlib.PosixPath, file_raw_xmp: str) -> str:
+    # exiftool marks binary data it could not output as text
+    if file_raw_xmp.startswith("base64:"):
+        file_raw_xmp = base64.b64decode(file_raw_xmp[7:]).decode("utf-8")
     # strip null characters common in some languages
     file_raw_xmp = file_raw_xmp.strip("\x00")
     if file_raw_xmp == "":
-        # raise ValueError(f"Empty XMP retrieved for {from_file}")
         logger.info(f"Empty XMP retrieved for {from_file}. Using empty XML string")
-        # logger.debug(f"Problem working on {from_file}: {e}")
         file_raw_xmp = empty_xml
+    return file_raw_xmp
 
-    # write data to temp
-    with open(to_file, "w") as f:
-        f.write(file_raw_xmp)
-    # confirm the raw xmp can be opened - this requires the log level is not at 4 (muted)
-    with pyexiv2.Image(to_file.as_posix()) as img:
-        img.read_xmp()
 
+def read_xmp_packets(
+    files: list[pathlib.PosixPath],
+    et: ExifTool,
+    max_files: int = 500,
+    exist: bool = False,
+) -> dict[pathlib.PosixPath, str | None]:
+    """Return the XMP packets of many files, keyed by path.
+    Packets that cannot be read from the file header are read with a single
+    exiftool request per directory.
+    Missing files map to None and files without XMP to empty_xml, as with
+    read_xmp_packet. With exist, the files are known to exist and not checked."""
+    packets = {}
+    by_directory = {}
+    for file in dict.fromkeys(files):
+        if not exist and not file.is_file():
+            logger.debug(f"File {file} not found")
+            packets[file] = None
+            continue
+        file_raw_xmp = embedded_xmp.read_embedded_xmp(file)
+        if file_raw_xmp is not None:
+            packets[file] = _decode_packet(file, file_raw_xmp)
+        else:
+            by_directory.setdefault(file.parent, {})[file.as_posix()] = file
 
-def convert_to_binary(image, lower_threshold, upper_threshold):
-    """
-    This function converts a image to a binary image
-    :param image: OpenCV image array
-    :return: Binary image as OpenCV image array
-    """
-    original_imgcv2 = cv2.cvtColor(np.asarray(image), cv2.COLOR_RGB2BGR)
-    grayImage_imgcv2 = cv2.cvtColor(original_imgcv2, cv2.COLOR_BGR2GRAY)
-    (thresh, blackAndWhiteImage) = cv2.threshold(
-        grayImage_imgcv2, lower_threshold, upper_threshold, cv2.THRESH_BINARY
-    )
-    # cv2.imwrite("binary.jpg", blackAndWhiteImage)
-    image = Image.fromarray(
-        cv2.cvtColor(blackAndWhiteImage, cv2.COLOR_BGR2RGB)
-    )  # convert from cv2 image file to pil image file
-    return image
+    for directory_files in by_directory.values():
+        names = list(directory_files)
+        for start in range(0, len(names), max_files):
+            chunk = names[start : start + max_files]
+            output = et.execute(
+                *["-j", "-b", "-xmp", "-api", "LargeFileSupport=1", *chunk]
+            )
+            found = {}
+            for entry in json.loads(output) if output.strip() else []:
+                found[entry.get("SourceFile")] = entry.get("XMP", "")
+            for name in chunk:
+                file = directory_files[name]
+                packets[file] = _decode_packet(file, str(found.get(name, "")))
+
+    return packets
+
+
+def lookup_xmp_packet(
+    from_file: pathlib.PosixPath,
+    packets: dict | None,
+    et: ExifTool,
+    warn: bool = False,
+) -> str | None:
+    """Get a packet from the result of read_xmp_packets, reading it if not present."""
+    if packets is None or from_file not in packets:
+        return read_xmp_packet(from_file, et=et, warn=warn)
+
+    packet = packets[from_file]
+    if packet is None and warn:
+        logger.warning(f"File {from_file} not found")
+    return packet
+
+
+class ExifToolPool:
+    """Thread-safe pool of long-lived (-stay_open) ExifTool processes.
+    Processes are started on first use, up to size. A process whose call failed
+    is terminated and replaced by a new one on a later checkout."""
+
+    def __init__(self, size: int):
+        self.size = size
+        # None marks a free slot where a process still has to be started
+        self._idle = queue.LifoQueue()
+        for _ in range(size):
+            self._idle.put(None)
+
+    def _acquire(self) -> ExifTool:
+        et = self._idle.get()
+        if et is not None:
+            if et.running:
+                return et
+            logger.warning("ExifTool process died, restarting it")
+        et = ExifTool()
+        try:
+            et.run()
+        except BaseException:
+            self._idle.put(None)
+            raise
+        return et
+
+    def _discard(self, et: ExifTool) -> None:
+        try:
+            et.terminate()
+        except Exception as e:
+            logger.debug(f"Could not terminate ExifTool: {e}")
+
+    @contextlib.contextmanager
+    def checkout(self):
+        """Context manager lending a running ExifTool to the calling thread."""
+        et = self._acquire()
+        try:
+            yield et
+        except BaseException:
+            # the output of a failed call may still be pending, start over
+            self._discard(et)
+            self._idle.put(None)
+            raise
+        else:
+            self._idle.put(et)
+
+    def close(self) -> None:
+        """Terminate the idle processes. Call once all checkouts are returned."""
+        while not self._idle.empty():
+            et = self._idle.get()
+            if et is not None:
+                self._discard(et)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
 
 
 def draw_cropline(im, bbox):
@@ -86,25 +192,6 @@ def draw_cropline(im, bbox):
     return im
 
 
-def get_control_value(im, bbox):
-    """
-    This function gets the mean color value outside of the bounding box (bbox).
-    The closer to 0 the darker is the section that will be removed. If the value is
-    higher than a certain threshold this could indicate an wrong autocrop boundingbox
-    and non black pixels are cropped.
-    :param im: PIL Image
-    :param bbox: PIL bbox array
-    :return: mean color value (float)
-    """
-    control_img = im
-    mask_layer = Image.new("L", control_img.size, 255)
-    draw = ImageDraw.Draw(mask_layer)
-    draw.rectangle(((bbox[0], bbox[1]), (bbox[2], bbox[3])), fill=0)
-    avg_list = ImageStat.Stat(control_img, mask=mask_layer).mean
-    avg = round(sum(avg_list) / 3, 2)
-    return avg
-
-
 raw_files = [".CRW", ".CR2", ".CR3", ".DNG", ".RAW"]
 
 other_files = [
@@ -0,0 +1,322 @@
+import io
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+
+# Parse and serialize XMP packets in memory.
+# Properties are keyed like pyexiv2 ("Xmp.crs.CropTop") so the dictionaries can be
+# handled the same way as before, but arrays and structures are kept as values
+# instead of being flattened into "Xmp.xmpMM.History[1]/stEvt:action" style keys.
+
+RDF_NS = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+XML_NS = "http://www.w3.org/XML/1998/namespace"
+META_NS = "adobe:ns:meta/"
+
+# prefixes as registered by exiv2, so keys match the ones pyexiv2 produces
+_prefix_to_uri = {
+    "dc": "http://purl.org/dc/elements/1.1/",
+    "xmp": "http://ns.adobe.com/xap/1.0/",
+    "xmpRights": "http://ns.adobe.com/xap/1.0/rights/",
+    "xmpMM": "http://ns.adobe.com/xap/1.0/mm/",
+    "xmpBJ": "http://ns.adobe.com/xap/1.0/bj/",
+    "xmpTPg": "http://ns.adobe.com/xap/1.0/t/pg/",
+    "xmpG": "http://ns.adobe.com/xap/1.0/g/",
+    "xmpDM": "http://ns.adobe.com/xmp/1.0/DynamicMedia/",
+    "xmpidq": "http://ns.adobe.com/xmp/Identifier/qual/1.0/",
+    "xmpNote": "http://ns.adobe.com/xmp/note/",
+    "pdf": "http://ns.adobe.com/pdf/1.3/",
+    "photoshop": "http://ns.adobe.com/photoshop/1.0/",
+    "crs": "http://ns.adobe.com/camera-raw-settings/1.0/",
+    "crss": "http://ns.adobe.com/camera-raw-saved-settings/1.0/",
+    "tiff": "http://ns.adobe.com/tiff/1.0/",
+    "exif": "http://ns.adobe.com/exif/1.0/",
+    "exifEX": "http://cipa.jp/exif/1.0/",
+    "aux": "http://ns.adobe.com/exif/1.0/aux/",
+    "iptc": "http://iptc.org/std/Iptc4xmpCore/1.0/xmlns/",
+    "iptcExt": "http://iptc.org/std/Iptc4xmpExt/2008-02-29/",
+    "plus": "http://ns.useplus.org/ldf/xmp/1.0/",
+    "lr": "http://ns.adobe.com/lightroom/1.0/",
+    "digiKam": "http://www.digikam.org/ns/1.0/",
+    "darktable": "http://darktable.sf.net/",
+    "MicrosoftPhoto": "http://ns.microsoft.com/photo/1.0/",
+    "GPano": "http://ns.google.com/photos/1.0/panorama/",
+    "mwg-rs": "http://www.metadataworkinggroup.com/schemas/regions/",
+    "mwg-kw": "http://www.metadataworkinggroup.com/schemas/keywords/",
+    "stArea": "http://ns.adobe.com/xmp/sType/Area#",
+    "stDim": "http://ns.adobe.com/xap/1.0/sType/Dimensions#",
+    "stEvt": "http://ns.adobe.com/xap/1.0/sType/ResourceEvent#",
+    "stRef": "http://ns.adobe.com/xap/1.0/sType/ResourceRef#",
+    "stVer": "http://ns.adobe.com/xap/1.0/sType/Version#",
+}
+_uri_to_prefix = {v: k for k, v in _prefix_to_uri.items()}
+
+
+class XmpArray(list):
+    """rdf:Seq, rdf:Bag or rdf:Alt array. Behaves like the lists pyexiv2 returns."""
+
+    def __init__(self, kind: str = "Seq", items=()):
+        if kind not in ("Seq", "Bag", "Alt"):
+            raise ValueError(f"Unknown XMP array type: {kind}")
+        super().__init__(items)
+        self.kind = kind
+
+    def __eq__(self, other):
+        if isinstance(other, XmpArray) and self.kind != other.kind:
+            return False
+        return list.__eq__(self, other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"XmpArray({self.kind!r}, {list.__repr__(self)})"
+
+
+class XmpLangAlt(dict):
+    """Language alternative (rdf:Alt with xml:lang), mapping language to text."""
+
+
+class XmpStruct(dict):
+    """Structure value, mapping field keys ("Xmp.stEvt.action") to values."""
+
+
+class XmpResource(str):
+    """URI value of a property written as rdf:resource instead of as text."""
+
+    def __repr__(self):
+        return f"XmpResource({str.__repr__(self)})"
+
+
+def register_namespace(uri: str, prefix: str) -> str:
+    """Register a namespace and return the prefix used for it in keys."""
+    existing = _uri_to_prefix.get(uri)
+    if existing is not None:
+        return existing
+    candidate = prefix or "ns"
+    n = 1
+    while candidate in _prefix_to_uri:
+        candidate = f"{prefix or 'ns'}{n}"
+        n += 1
+    _prefix_to_uri[candidate] = uri
+    _uri_to_prefix[uri] = candidate
+    return candidate
+
+
+def _split_tag(tag: str) -> tuple[str, str]:
+    if tag[0] == "{":
+        uri, local = tag[1:].split("}", 1)
+        return uri, local
+    return "", tag
+
+
+def _key(tag: str) -> str:
+    uri, local = _split_tag(tag)
+    return f"Xmp.{register_namespace(uri, '')}.{local}"
+
+
+def _is_property_attribute(name: str) -> bool:
+    uri, _ = _split_tag(name)
+    return uri not in (RDF_NS, XML_NS, "")
+
+
+def _parse_fields(elem: ET.Element) -> XmpStruct:
+    struct = XmpStruct()
+    for name, value in elem.attrib.items():
+        if _is_property_attribute(name):
+            struct[_key(name)] = value
+    for child in elem:
+        if child.tag == f"{{{RDF_NS}}}Description":
+            struct.update(_parse_fields(child))
+        elif _is_property_attribute(child.tag):
+            struct[_key(child.tag)] = _parse_value(child)
+    return struct
+
+
+def _parse_array(container: ET.Element):
+    kind = _split_tag(container.tag)[1]
+    items = container.findall(f"{{{RDF_NS}}}li")
+    lang = f"{{{XML_NS}}}lang"
+    if kind == "Alt" and items and all(lang in li.attrib for li in items):
+        return XmpLangAlt((li.attrib[lang], li.text or "") for li in items)
+    return XmpArray(kind, [_parse_value(li) for li in items])
+
+
+def _parse_value(elem: ET.Element):
+    resource = elem.attrib.get(f"{{{RDF_NS}}}resource")
+    if resource is not None:
+        return XmpResource(resource)
+
+    if elem.attrib.get(f"{{{RDF_NS}}}parseType") == "Resource":
+        return _parse_fields(elem)
+
+    children = list(elem)
+    if len(children) == 1 and _split_tag(children[0].tag) in (
+        (RDF_NS, "Seq"),
+        (RDF_NS, "Bag"),
+        (RDF_NS, "Alt"),
+    ):
+        return _parse_array(children[0])
+
+    if children or any(_is_property_attribute(name) for name in elem.attrib):
+        return _parse_fields(elem)
+
+    return elem.text or ""
+
+
+def parse_packet(packet: str) -> dict:
+    """Parse an XMP packet (sidecar content, exiftool -xmp -b output or the
+    Lightroom database blob) into a dictionary of top level properties."""
+    packet = packet.strip("\x00").strip()
+    if packet == "":
+        return {}
+
+    # collect the prefixes declared in the document for namespaces exiv2 does not know
+    root = None
+    events = ET.iterparse(io.StringIO(packet), events=("start-ns", "start"))
+    for event, item in events:
+        if event == "start-ns":
+            prefix, uri = item
+            if uri not in (RDF_NS, XML_NS, META_NS):
+                register_namespace(uri, prefix)
+        elif root is None:
+            root = item
+
+    rdf_tag = f"{{{RDF_NS}}}RDF"
+    rdf = root if root.tag == rdf_tag else root.find(f".//{rdf_tag}")
+    xmp_dict = {}
+    if rdf is None:
+        return xmp_dict
+    for description in rdf.findall(f"{{{RDF_NS}}}Description"):
+        xmp_dict.update(_parse_fields(description))
+    return xmp_dict
+
+
+def read_properties(file, keys, chunk_size: int = 1 << 14) -> dict:
+    """Read some top level properties of an xmp file, e.g. "Xmp.tiff.Orientation".
+    The file is parsed incrementally and only until all keys were found, so long
+    documents (darktable history stacks) are mostly not parsed. Keys that are not
+    in the file are left out. Raises ET.ParseError for malformed files."""
+    wanted = set(keys)
+    found = {}
+    rdf_tag = f"{{{RDF_NS}}}RDF"
+    description_tag = f"{{{RDF_NS}}}Description"
+    parser = ET.XMLPullParser(events=("start-ns", "start", "end"))
+    # tags of the open elements
+    stack = []
+
+    with open(file, "rb") as f:
+        done = False
+        while not done and not wanted <= found.keys():
+            chunk = f.read(chunk_size)
+            if chunk:
+                parser.feed(chunk)
+            else:
+                parser.close()
+                done = True
+            for event, item in parser.read_events():
+                if event == "start-ns":
+                    prefix, uri = item
+                    if uri not in (RDF_NS, XML_NS, META_NS):
+                        register_namespace(uri, prefix)
+                elif event == "start":
+                    stack.append(item.tag)
+                    if item.tag == description_tag and stack[-2:-1] == [rdf_tag]:
+                        for name, value in item.attrib.items():
+                            if _is_property_attribute(name) and _key(name) in wanted:
+                                found[_key(name)] = value
+                else:
+                    stack.pop()
+                    if stack[-2:] == [rdf_tag, description_tag]:
+                        if (
+                            _is_property_attribute(item.tag)
+                            and _key(item.tag) in wanted
+                        ):
+                            found[_key(item.tag)] = _parse_value(item)
+                        # the rest of the document is not kept
+                        item.clear()
+
+    return {key: found[key] for key in keys if key in found}
+
+
+def _qname(key: str, prefixes: set) -> str:
+    parts = key.split(".", 2)
+    if len(parts) != 3 or parts[0] != "Xmp" or parts[1] not in _prefix_to_uri:
+        raise ValueError(f"Not a key of a registered XMP namespace: {key!r}")
+    _, prefix, name = parts
+    prefixes.add(prefix)
+    return f"{prefix}:{name}"
+
+
+def _attr(value) -> str:
+    entities = {'"': "&quot;", "\n": "&#xA;", "\r": "&#xD;", "\t": "&#x9;"}
+    return escape(str(value), entities)
+
+
+def _write_value(lines: list, qname: str, value, indent: str, prefixes: set):
+    if isinstance(value, XmpResource):
+        lines.append(f'{indent}<{qname} rdf:resource="{_attr(value)}"/>')
+    elif isinstance(value, XmpLangAlt):
+        lines.append(f"{indent}<{qname}>")
+        lines.append(f"{indent} <rdf:Alt>")
+        for lang, text in value.items():
+            li = f'<rdf:li xml:lang="{_attr(lang)}">{escape(str(text))}</rdf:li>'
+            lines.append(f"{indent}  {li}")
+        lines.append(f"{indent} </rdf:Alt>")
+        lines.append(f"{indent}</{qname}>")
+    elif isinstance(value, dict):
+        # any other mapping of field keys is a structure
+        if not value:
+            lines.append(f'{indent}<{qname} rdf:parseType="Resource"/>')
+            return
+        lines.append(f'{indent}<{qname} rdf:parseType="Resource">')
+        for key, field in value.items():
+            _write_value(lines, _qname(key, prefixes), field, indent + " ", prefixes)
+        lines.append(f"{indent}</{qname}>")
+    elif isinstance(value, (list, tuple)):
+        kind = value.kind if isinstance(value, XmpArray) else "Seq"
+        lines.append(f"{indent}<{qname}>")
+        lines.append(f"{indent} <rdf:{kind}>")
+        for item in value:
+            _write_value(lines, "rdf:li", item, indent + "  ", prefixes)
+        lines.append(f"{indent} </rdf:{kind}>")
+        lines.append(f"{indent}</{qname}>")
+    else:
+        lines.append(f"{indent}<{qname}>{escape(str(value))}</{qname}>")
+
+
+def serialize_packet(xmp_dict: dict) -> str:
+    """Serialize a dictionary of properties to a complete XMP sidecar packet.
+    Simple values are written as attributes, arrays, structures and resources as
+    elements. Properties set to None are omitted."""
+    prefixes = set()
+    attributes = []
+    elements = []
+    for key, value in xmp_dict.items():
+        if value is None:
+            continue
+        qname = _qname(key, prefixes)
+        if isinstance(value, (dict, list, tuple, XmpResource)):
+            _write_value(elements, qname, value, "   ", prefixes)
+        else:
+            attributes.append(f'    {qname}="{_attr(value)}"')
+
+    declarations = [
+        f'    xmlns:{prefix}="{_attr(_prefix_to_uri[prefix])}"'
+        for prefix in sorted(prefixes)
+    ]
+    description = "\n".join(
+        ['  <rdf:Description rdf:about=""'] + declarations + attributes
+    )
+
+    lines = [
+        '<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>',
+        '<x:xmpmeta xmlns:x="adobe:ns:meta/" x:xmptk="XMP Core 4.4.0-Exiv2">',
+        ' <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">',
+    ]
+    if elements:
+        lines.append(description + ">")
+        lines.extend(elements)
+        lines.append("  </rdf:Description>")
+    else:
+        lines.append(description + "/>")
+    lines.extend([" </rdf:RDF>", "</x:xmpmeta>", '<?xpacket end="w"?>', ""])
+    return "\n".join(lines)